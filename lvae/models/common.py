@@ -107,6 +107,21 @@ def sinusoidal_embedding(values: torch.Tensor, dim=256, max_period=64):
     return embedding
 
 
+def lmbs_to_tensor(lmbs, n: int, default: float, device=None):
+    """ Lambdas of a batch of `n` images as a float tensor of shape (n,)
+
+    Args:
+        lmbs (torch.Tensor, list, float, or None): lambda for each image. A single value is \
+            shared by all images, and None means `default`.
+    """
+    lmbs = default if (lmbs is None) else lmbs
+    lmbs = torch.as_tensor(lmbs, dtype=torch.float, device=device).view(-1)
+    if lmbs.numel() == 1:
+        lmbs = lmbs.repeat(n)
+    assert lmbs.shape == (n,), f'{lmbs.shape=}, expected ({n},)'
+    return lmbs
+
+
 class Permute(nn.Module):
     def __init__(self, *dims: tuple):
         """ Permute dimensions of a tensor
@@ -1,8 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import math
+import struct
+import warnings
+import numpy as np
 import scipy.stats
 import torch
 import torch.distributions as td
 
+import compressai
 from compressai.ops import LowerBound
 from compressai.entropy_models import GaussianConditional
 
@@ -25,6 +31,482 @@ def _safe_log_prob_mass(distribution, x, bin_size, prob_clamp):
     return log_prob
 
 
+_thread_pools = dict()
+
+def get_thread_pool(num_threads: int, name='entropy'):
+    """ Get a thread pool (shared by all entropy models) with `num_threads` threads. \
+        Pools with different names are independent of each other.
+    """
+    key = (name, num_threads)
+    if key not in _thread_pools:
+        _thread_pools[key] = ThreadPoolExecutor(num_threads, thread_name_prefix=name)
+    return _thread_pools[key]
+
+
+_shared_cdf_tables = dict()
+_persisted_cdf_tables = dict()
+# version of the file format of `save_cdf_tables()`. Increase it when the format or the way the
+# tables are computed changes, such that files written before are not used.
+CDF_TABLES_VERSION = 1
+
+def _cdf_tables_key(entropy_model: GaussianConditional):
+    """ (entropy model type name, scale table, tail mass, precision), which determines the \
+        CDF tables of an entropy model, regardless of the device.
+    """
+    return (type(entropy_model).__qualname__, tuple(entropy_model.scale_table.tolist()),
+            entropy_model.tail_mass, entropy_model.entropy_coder_precision)
+
+
+def default_cdf_tables_path():
+    """ The CDF tables are saved alongside the pre-trained weights, i.e., in the torch hub \
+        checkpoint directory, when persisting them is enabled by `cdf_tables=True`.
+    """
+    return Path(torch.hub.get_dir()) / 'checkpoints' / 'lvae-cdf-tables.pt'
+
+
+def save_cdf_tables(path):
+    """ Save the CDF tables of all entropy models prepared so far (including the ones loaded \
+        by `load_cdf_tables()`) to a file, such that later processes can skip computing them. \
+        The file records `CDF_TABLES_VERSION` and the version of compressai.
+
+    Args:
+        path (str or Path): the file path
+    """
+    tables = dict(_persisted_cdf_tables)
+    for key, (cdf, offset, cdf_length) in _shared_cdf_tables.items():
+        tables[key[:-1]] = (cdf, offset, cdf_length)
+    entries = []
+    for (type_name, scale_table, tail_mass, precision), value in tables.items():
+        entries.append({
+            'type': type_name, 'scale_table': torch.tensor(scale_table, dtype=torch.float64),
+            'tail_mass': tail_mass, 'precision': precision,
+            'tables': [t.cpu().contiguous() for t in value]
+        })
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f'{path.suffix}.tmp')
+    data = {'version': CDF_TABLES_VERSION, 'compressai': compressai.__version__, 'entries': entries}
+    torch.save(data, tmp_path)
+    tmp_path.replace(path) # atomic, in case of concurrent workers
+    return len(entries)
+
+
+def load_cdf_tables(path):
+    """ Load the CDF tables saved by `save_cdf_tables()`. The tensors are memory-mapped, so \
+        loading costs (almost) no time, and `update_shared()` uses them for the entropy models \
+        with the same (type, scale table, tail mass, precision) instead of computing them. \
+        A file of another format version or compressai version is ignored, with a warning.
+
+    Args:
+        path (str or Path): the file path
+
+    Returns:
+        int: number of loaded tables
+    """
+    data = torch.load(path, mmap=True, weights_only=True)
+    saved = (data.get('version'), data.get('compressai')) if isinstance(data, dict) else (None, None)
+    if saved != (CDF_TABLES_VERSION, compressai.__version__):
+        warnings.warn(f'Ignoring the CDF tables in {path}, which are saved by (format version, compressai) '
+                      f'= {saved}, but the current ones are {(CDF_TABLES_VERSION, compressai.__version__)}.')
+        return 0
+    entries = data['entries']
+    for entry in entries:
+        key = (entry['type'], tuple(entry['scale_table'].tolist()), entry['tail_mass'], entry['precision'])
+        _persisted_cdf_tables[key] = tuple(entry['tables'])
+    return len(entries)
+
+
+def update_with_cdf_tables(update_func, path=None):
+    """ Call `update_func()`, which updates a set of entropy models by `update_shared()`, \
+        using the CDF tables persisted in a file. The tables that are not in the file are \
+        computed and then added to the file.
+
+    Args:
+        update_func (callable): e.g., a function that calls `update()` of all entropy models
+        path (str, Path, or bool): the file path. True means `default_cdf_tables_path()`, and \
+            False/None (the default) means not to persist the tables.
+    """
+    if path is True:
+        path = default_cdf_tables_path()
+    if not path:
+        update_func()
+        return
+    num_loaded = load_cdf_tables(path) if Path(path).is_file() else 0
+    update_func()
+    if (num_loaded == 0) or any([k[:-1] not in _persisted_cdf_tables for k in _shared_cdf_tables.keys()]):
+        try:
+            save_cdf_tables(path)
+        except OSError as e: # e.g., read-only file system. Not fatal.
+            warnings.warn(f'Failed to save the CDF tables to {path}: {e}')
+        for key, value in _shared_cdf_tables.items():
+            _persisted_cdf_tables.setdefault(key[:-1], value)
+
+
+def update_shared(entropy_model: GaussianConditional, scale_table=None):
+    """ Same as `entropy_model.update()`, but the CDF tables are computed only once for each \
+        (entropy model type, scale table, tail mass, precision, device), and the same table \
+        tensors are shared by all entropy models with these settings. Tables loaded by \
+        `load_cdf_tables()` are used without computing.
+
+    Args:
+        entropy_model (GaussianConditional): a compressai GaussianConditional or a subclass of it
+        scale_table (torch.Tensor, optional): a new scale table, as in `update_scale_table()`
+    """
+    device = entropy_model.scale_table.device
+    if scale_table is not None:
+        entropy_model.scale_table = entropy_model._prepare_scale_table(scale_table).to(device)
+    key = (*_cdf_tables_key(entropy_model), str(device))
+    if (key not in _shared_cdf_tables) and (key[:-1] in _persisted_cdf_tables):
+        _shared_cdf_tables[key] = tuple([t.to(device=device) for t in _persisted_cdf_tables[key[:-1]]])
+    if key not in _shared_cdf_tables:
+        GaussianConditional.update(entropy_model)
+        _shared_cdf_tables[key] = (entropy_model._quantized_cdf, entropy_model._offset,
+                                   entropy_model._cdf_length)
+    else:
+        (entropy_model._quantized_cdf, entropy_model._offset,
+         entropy_model._cdf_length) = _shared_cdf_tables[key]
+
+
+def build_indexes(entropy_model: GaussianConditional, scales: torch.Tensor):
+    """ Same as `entropy_model.build_indexes()`, but in a single pass by `torch.bucketize`, \
+        instead of one comparison pass over `scales` per scale table entry.
+    """
+    scales = entropy_model.lower_bound_scale(scales)
+    boundaries = entropy_model.scale_table[:-1].to(dtype=scales.dtype)
+    # index = number of scale table entries (except the last one) that are less than the scale
+    return torch.bucketize(scales, boundaries).int()
+
+
+def quantize_means(means: torch.Tensor, frac_bits: int):
+    """ Snap the prior means to a fixed-point grid with `frac_bits` fractional bits. The \
+        result is exact in floating point (as long as |means| < 2^(24 - frac_bits)), so mean \
+        subtraction and addition give the same values on any device or thread count.
+    """
+    step = float(2 ** frac_bits)
+    return torch.round(means * step) / step
+
+
+def build_indexes_fixed_point(entropy_model: GaussianConditional, log_scales: torch.Tensor,
+                              frac_bits: int):
+    """ CDF indexes from the log-scales snapped to a fixed-point grid with `frac_bits` \
+        fractional bits. The index selection itself is integer-only: the log scale table is \
+        converted to integer boundaries on the same grid, so the index of a grid point does \
+        not depend on how `exp()` or the comparison is vectorized.
+
+    Args:
+        entropy_model (GaussianConditional): the entropy model, which provides the scale table
+        log_scales (torch.Tensor): natural log of the scales
+        frac_bits (int): number of fractional bits of the grid
+
+    Returns:
+        torch.Tensor: int32 indexes, the same shape as `log_scales`
+    """
+    step = float(2 ** frac_bits)
+    log_scales_q = torch.round(log_scales.float() * step).long()
+    # grid point q has index k iff exactly k boundaries b satisfy b < q / step, i.e., floor(b * step) < q
+    table = entropy_model.scale_table[:-1].double()
+    boundaries = torch.floor(torch.log(table) * step).long().to(device=log_scales.device)
+    return torch.bucketize(log_scales_q, boundaries).int()
+
+
+def _coding_tables(entropy_model: GaussianConditional):
+    """ The (cdfs, cdf lengths, offsets) of an entropy model as Python lists, which is the \
+        format required by the rANS coder. They are converted once after each `update()` \
+        (or device move), instead of once per image in every call.
+    """
+    cdf = entropy_model._quantized_cdf
+    cache = getattr(entropy_model, '_coding_tables_cache', None)
+    if (cache is None) or (cache[0] is not cdf):
+        tables = (
+            cdf.tolist(),
+            entropy_model._cdf_length.reshape(-1).int().tolist(),
+            entropy_model._offset.reshape(-1).int().tolist()
+        )
+        cache = (cdf, tables)
+        entropy_model._coding_tables_cache = cache
+    return cache[1]
+
+
+def _int32_buffer(x: torch.Tensor):
+    """ A flat int32 memoryview of a tensor (zero-copy if it is already a contiguous int32 \
+        CPU tensor). Note that the rANS coder of compressai is bound with `list[int]` arguments, \
+        so pybind11 still reads the buffer through the sequence protocol and converts every \
+        element to a Python int (one at a time). This avoids `tolist()` and its peak memory, \
+        but not the per-symbol conversion. `InterleavedRansCoder` takes NumPy arrays directly.
+    """
+    return memoryview(x.reshape(-1).to(device='cpu', dtype=torch.int32).contiguous().numpy())
+
+
+def compress_buffers(entropy_model: GaussianConditional, inputs, indexes, means=None):
+    """ Same as `entropy_model.compress()`, and produces the same bit strings, but passes \
+        contiguous int32 buffers to the rANS coder instead of Python lists. The coder still \
+        converts each symbol and index to a Python int (see `_int32_buffer()`).
+
+    Args:
+        entropy_model (GaussianConditional): a compressai entropy model, after `update()`
+        inputs  (torch.Tensor): (N, ...) values to be encoded
+        indexes (torch.Tensor): (N, ...) CDF indexes
+        means   (torch.Tensor, optional): (N, ...) means
+
+    Returns:
+        list[bytes]: N strings
+    """
+    assert inputs.shape == indexes.shape, f'{inputs.shape=}, {indexes.shape=}'
+    assert inputs.dim() >= 2, f'Expected a tensor with at least 2 dimensions, got {inputs.shape=}'
+    symbols = entropy_model.quantize(inputs, 'symbols', means)
+    cdfs, cdf_lengths, offsets = _coding_tables(entropy_model)
+    encode = entropy_model.entropy_coder.encode_with_indexes
+    strings = [
+        encode(_int32_buffer(symbols[i]), _int32_buffer(indexes[i]), cdfs, cdf_lengths, offsets)
+        for i in range(symbols.shape[0])
+    ]
+    return strings
+
+
+def coding_bits(entropy_model: GaussianConditional, inputs, indexes, means=None):
+    """ Number of bits of each symbol when coded by `compress_buffers()`, computed from the \
+        same quantized CDF tables as the rANS coder. A symbol out of the range of its CDF is \
+        coded as the escape (last) symbol of the CDF, followed by its value in 4-bit bypass \
+        chunks, and the number of chunks in 4-bit chunks of at most 15.
+
+    Args:
+        entropy_model (GaussianConditional): a compressai entropy model, after `update()`
+        inputs  (torch.Tensor): values to be encoded
+        indexes (torch.Tensor): CDF indexes, the same shape as `inputs`
+        means   (torch.Tensor, optional): means, the same shape as `inputs`
+
+    Returns:
+        torch.Tensor: bits of each symbol, the same shape as `inputs`, excluding the few bytes \
+            of the final state of the rANS coder
+    """
+    symbols = entropy_model.quantize(inputs, 'symbols', means).long()
+    indexes = indexes.long()
+    cdf = entropy_model._quantized_cdf.to(device=symbols.device, dtype=torch.long)
+    max_value = entropy_model._cdf_length.to(device=symbols.device, dtype=torch.long)[indexes] - 2
+    value = symbols - entropy_model._offset.to(device=symbols.device, dtype=torch.long)[indexes]
+    # escape (bypass) coding, the same as in the rANS coder of CompressAI
+    escape = (value < 0) | (value >= max_value)
+    raw = torch.where(value < 0, -2 * value - 1, 2 * (value - max_value)).clamp(min=0)
+    value = torch.where(escape, max_value, value)
+    freq = cdf[indexes, value + 1] - cdf[indexes, value]
+    bits = entropy_model.entropy_coder_precision - torch.log2(freq.double())
+    raw_bits = torch.where(raw > 0, torch.floor(torch.log2(raw.double().clamp(min=1))) + 1, 0)
+    num_chunks = torch.ceil(raw_bits / 4)
+    bits = bits + torch.where(escape, 4 * (torch.div(num_chunks, 15, rounding_mode='floor') + 1 + num_chunks), 0)
+    return bits.float()
+
+
+def decompress_buffers(entropy_model: GaussianConditional, strings, indexes, dtype=torch.float,
+                       means=None):
+    """ Decode the bit strings given by `compress_buffers()` or `entropy_model.compress()`. \
+        The indexes are passed to the rANS coder as int32 buffers (converted element by \
+        element, see `_int32_buffer()`). The decoded symbols are still returned by the coder \
+        as a list of Python ints, which is then copied into a tensor.
+
+    Args:
+        entropy_model (GaussianConditional): a compressai entropy model, after `update()`
+        strings (list[bytes]): N strings
+        indexes (torch.Tensor): (N, ...) CDF indexes
+        dtype   (torch.dtype): type of the output
+        means   (torch.Tensor, optional): (N, ...) means
+
+    Returns:
+        torch.Tensor: (N, ...) decoded values
+    """
+    assert len(strings) == indexes.shape[0], f'{len(strings)=}, {indexes.shape=}'
+    cdfs, cdf_lengths, offsets = _coding_tables(entropy_model)
+    decode = entropy_model.entropy_coder.decode_with_indexes
+    symbols = torch.empty(indexes.shape, dtype=torch.int32)
+    for i, s in enumerate(strings):
+        # the rANS decoder only accepts bytes. Zero-copy views (e.g., slices of a memory-mapped
+        # file) are copied here, right before entropy decoding.
+        s = s if isinstance(s, bytes) else bytes(s)
+        values = decode(s, _int32_buffer(indexes[i]), cdfs, cdf_lengths, offsets)
+        symbols[i] = torch.tensor(values, dtype=torch.int32).reshape(symbols[i].shape)
+    return entropy_model.dequantize(symbols.to(device=indexes.device), means, dtype)
+
+
+class InterleavedRansCoder():
+    """ A rANS coder with many interleaved lanes, in which the state updates of all lanes are \
+        vectorized in NumPy. Symbol i is coded by lane (i % num_lanes), so the number of \
+        sequential steps is the number of symbols divided by the number of lanes.
+
+    Each string is laid out as:
+        header      number of lanes (uint16), number of escaped symbols (uint32)
+        states      final encoder state of each lane, uint32
+        escapes     raw values of the escaped (i.e., out-of-range) symbols, int32
+        words       16-bit renormalization words, in decoding order
+
+    Args:
+        num_lanes (int): maximum number of interleaved lanes
+        min_lane_symbols (int): use fewer lanes for short inputs, such that each lane codes \
+            at least this many symbols. Each lane costs 4 bytes to flush.
+        precision (int): CDF precision in bits, at most 16. The 16-bit CDFs of the entropy \
+            model are re-quantized if it is lower. Both sides should use the same precision.
+        table_layout (str): how the decoder finds the symbol of a slot. 'lut' uses a \
+            (num_cdfs, 2**precision) slot-to-symbol table, 'search' compares the slot with \
+            the CDF rows, which is slower but uses no extra memory. It does not affect the \
+            bit strings.
+    """
+    coder_id = 1
+    _state_lower = 1 << 16 # rANS states are in [2**16, 2**32), with 16-bit renormalization
+
+    def __init__(self, num_lanes=256, min_lane_symbols=1024, precision=16, table_layout='lut'):
+        assert 1 <= num_lanes < 2**16, f'{num_lanes=}'
+        assert 1 <= precision <= 16, f'{precision=}'
+        assert table_layout in ('lut', 'search'), f'{table_layout=}'
+        self.num_lanes = num_lanes
+        self.min_lane_symbols = min_lane_symbols
+        self.precision = precision
+        self.table_layout = table_layout
+        self._tables_cache = dict()
+
+    def _get_tables(self, entropy_model: GaussianConditional):
+        """ CDF tables of `entropy_model` at `self.precision`, as NumPy arrays. Computed once \
+            after each `update()`.
+        """
+        cdf16 = entropy_model._quantized_cdf
+        key = id(cdf16) # entropy models with shared CDF tables (see `update_shared()`) share these too
+        if (key in self._tables_cache) and (self._tables_cache[key][0] is cdf16):
+            return self._tables_cache[key][1]
+        cdf = cdf16.cpu().numpy().astype(np.int64)
+        lengths = entropy_model._cdf_length.reshape(-1).cpu().numpy().astype(np.int64)
+        offsets = entropy_model._offset.reshape(-1).cpu().numpy().astype(np.int64)
+        total = 1 << self.precision
+        # cdf[i, lengths[i]-1] is the total. pad the rows beyond it with a value > total
+        cols = np.arange(cdf.shape[1])
+        cdf = np.where(cols[None, :] < lengths[:, None], cdf, total + 1)
+        if self.precision < 16: # re-quantize the frequencies, keeping all of them >= 1
+            for i, n in enumerate(lengths):
+                freq = np.maximum(np.diff(cdf[i, :n]) >> (16 - self.precision), 1)
+                freq[np.argmax(freq)] += total - freq.sum()
+                assert freq.min() >= 1, 'The CDF precision is too low for the entropy model'
+                cdf[i, :n] = np.concatenate([[0], np.cumsum(freq)])
+        freq = np.diff(cdf, axis=1, append=total + 1)
+        freq[cdf > total] = 1 # unused; avoid division by zero
+        tables = dict(cdf=cdf, freq=freq, lengths=lengths, offsets=offsets)
+        if self.table_layout == 'lut':
+            lut = np.zeros((cdf.shape[0], total), dtype=np.int16)
+            for i, n in enumerate(lengths):
+                lut[i] = np.repeat(np.arange(n - 1, dtype=np.int16), np.diff(cdf[i, :n]))
+            tables['lut'] = lut
+        self._tables_cache[key] = (cdf16, tables)
+        return tables
+
+    def _num_lanes(self, num_symbols):
+        return int(max(1, min(self.num_lanes, num_symbols // max(self.min_lane_symbols, 1))))
+
+    def encode(self, entropy_model: GaussianConditional, symbols, indexes):
+        """ Encode symbols (given by `entropy_model.quantize(x, 'symbols')`) into a string
+
+        Args:
+            entropy_model (GaussianConditional): a compressai entropy model, after `update()`
+            symbols (np.ndarray): 1-D integer array
+            indexes (np.ndarray): 1-D integer array of CDF indexes
+
+        Returns:
+            bytes: the string
+        """
+        tables = self._get_tables(entropy_model)
+        indexes = indexes.astype(np.int64)
+        values = symbols.astype(np.int64) - tables['offsets'][indexes]
+        max_values = tables['lengths'][indexes] - 2 # the escape symbol
+        is_escape = (values < 0) | (values >= max_values)
+        escapes = symbols[is_escape].astype('<i4')
+        values = np.where(is_escape, max_values, values)
+        starts = tables['cdf'][indexes, values].astype(np.uint64)
+        freqs = tables['freq'][indexes, values].astype(np.uint64)
+
+        nL = self._num_lanes(len(values))
+        num_steps = math.ceil(len(values) / nL)
+        x_max_factor = np.uint64((self._state_lower >> self.precision) << 16)
+        prec, word_bits = np.uint64(self.precision), np.uint64(16)
+
+        x = np.full(nL, self._state_lower, dtype=np.uint64)
+        chunks = []
+        for t in reversed(range(num_steps)): # rANS encodes in reverse order
+            # the active lanes are always a prefix: only the last step may be partial
+            f, c = freqs[t*nL : (t+1)*nL], starts[t*nL : (t+1)*nL]
+            xs = x[:len(f)]
+            renorm = xs >= x_max_factor * f
+            chunks.append(xs[renorm].astype('<u2'))
+            np.right_shift(xs, word_bits, out=xs, where=renorm)
+            q, r = np.divmod(xs, f)
+            xs[:] = (q << prec) + r + c
+        header = struct.pack('<HI', nL, len(escapes))
+        words = b''.join([ch.tobytes() for ch in reversed(chunks)])
+        return header + x.astype('<u4').tobytes() + escapes.tobytes() + words
+
+    def decode(self, entropy_model: GaussianConditional, string, indexes):
+        """ Decode a string given by `encode()`
+
+        Args:
+            entropy_model (GaussianConditional): a compressai entropy model, after `update()`
+            string (bytes or memoryview): the string
+            indexes (np.ndarray): 1-D integer array of CDF indexes
+
+        Returns:
+            np.ndarray: 1-D int32 array of symbols
+        """
+        tables = self._get_tables(entropy_model)
+        nL, num_esc = struct.unpack_from('<HI', string, 0)
+        pos = struct.calcsize('<HI')
+        x = np.frombuffer(string, dtype='<u4', count=nL, offset=pos).astype(np.uint64)
+        pos += 4 * nL
+        escapes = np.frombuffer(string, dtype='<i4', count=num_esc, offset=pos)
+        pos += 4 * num_esc
+        words = np.frombuffer(string, dtype='<u2', offset=pos).astype(np.uint64)
+
+        num_symbols = len(indexes)
+        num_steps = math.ceil(num_symbols / nL)
+        indexes = indexes.astype(np.int64)
+        width = tables['cdf'].shape[1]
+        cdf, freq = tables['cdf'].reshape(-1), tables['freq'].reshape(-1)
+        if self.table_layout == 'lut':
+            lut = tables['lut'].reshape(-1)
+        mask, prec = np.uint64((1 << self.precision) - 1), np.uint64(self.precision)
+        lower, word_bits = np.uint64(self._state_lower), np.uint64(16)
+        values = np.empty(num_symbols, dtype=np.int64)
+        w = 0
+        for t in range(num_steps):
+            idx = indexes[t*nL : (t+1)*nL]
+            xs = x[:len(idx)] # the active lanes are always a prefix
+            slot = (xs & mask).astype(np.int64)
+            if self.table_layout == 'lut':
+                v = lut.take(idx * (1 << self.precision) + slot).astype(np.int64)
+            else:
+                v = (tables['cdf'][idx] <= slot[:, None]).sum(axis=1) - 1
+            pos = idx * width + v
+            xs[:] = freq.take(pos).astype(np.uint64) * (xs >> prec) + slot.astype(np.uint64) \
+                    - cdf.take(pos).astype(np.uint64)
+            renorm = xs < lower
+            k = int(np.count_nonzero(renorm))
+            if k > 0:
+                xs[renorm] = (xs[renorm] << word_bits) | words[w:w+k]
+                w += k
+            values[t*nL : (t+1)*nL] = v
+        symbols = values + tables['offsets'][indexes]
+        is_escape = values == (tables['lengths'][indexes] - 2)
+        assert is_escape.sum() == num_esc, 'Corrupted string: wrong number of escaped symbols'
+        symbols[is_escape] = escapes
+        return symbols.astype(np.int32)
+
+
+_entropy_coders = dict()
+
+def get_entropy_coder(coder_id: int, precision=16):
+    """ Get the (shared) entropy coder for decoding bit strings coded by `coder_id`, as \
+        signaled in the container. 0 is the rANS coder of compressai, for which None is returned.
+    """
+    if coder_id == 0:
+        return None
+    assert coder_id == InterleavedRansCoder.coder_id, f'Unknown entropy coder {coder_id=}'
+    key = (coder_id, precision)
+    if key not in _entropy_coders:
+        _entropy_coders[key] = InterleavedRansCoder(precision=precision)
+    return _entropy_coders[key]
+
+
 def _sanity_check_scale_table(scale_table):
     assert isinstance(scale_table, torch.Tensor)
     assert (scale_table.dim() == 1) and (scale_table.shape[0] >= 1) and (scale_table.min() > 0)
@@ -49,6 +531,27 @@ def gaussian_log_prob_mass(mean, scale, x, bin_size=1.0, prob_clamp=1e-6):
     return log_prob
 
 
+def nats_to_bits(nlls, breakdown=False):
+    """ Sum the negative log-likelihoods (in nats) of a list of blocks into bits per image.
+
+    Args:
+        nlls      (list): a list of (N, C, H, W) tensors, e.g., `fdict['kl_divs']`
+        breakdown (bool): if True, also return bits per block and per channel
+
+    Returns:
+        torch.Tensor: bits of each image, shape (N,), if `breakdown` is False. Otherwise, a dict \
+            with keys 'bits' (N,), 'block_bits' (N, num_blocks), and 'channel_bits' (a list of \
+            (N, C) tensors, one for each block).
+    """
+    log2_e = math.log2(math.e)
+    channel_bits = [nll.sum(dim=(2, 3)) * log2_e for nll in nlls]
+    block_bits = torch.stack([cb.sum(dim=1) for cb in channel_bits], dim=1)
+    bits = block_bits.sum(dim=1)
+    if not breakdown:
+        return bits
+    return dict(bits=bits, block_bits=block_bits, channel_bits=channel_bits)
+
+
 class DiscretizedGaussian(GaussianConditional):
     """ Custom discretized gaussian.
     """
@@ -81,6 +584,90 @@ class DiscretizedGaussian(GaussianConditional):
     def _standardized_cumulative(self, inputs: torch.Tensor):
         return self.standard_gaussian.cdf(inputs)
 
+    def update(self):
+        update_shared(self)
+
+    def build_indexes(self, scales: torch.Tensor):
+        return build_indexes(self, scales)
+
+    def compress(self, inputs, indexes, means=None, coder=None):
+        """ Compress input tensors to strings.
+
+        Args:
+            inputs  (torch.Tensor): (N, ...) values to be encoded
+            indexes (torch.Tensor): (N, ...) CDF indexes
+            means   (torch.Tensor, optional): (N, ...) means
+            coder (InterleavedRansCoder, optional): the entropy coder backend. \
+                Defaults to the rANS coder of compressai.
+        """
+        if inputs.numel() == 0: # nothing to code, e.g., all channels are skipped
+            return [b''] * inputs.shape[0]
+        if coder is None:
+            return compress_buffers(self, inputs, indexes, means=means)
+        symbols = self.quantize(inputs, 'symbols', means).cpu()
+        indexes = indexes.cpu()
+        return [coder.encode(self, symbols[i].reshape(-1).numpy(), indexes[i].reshape(-1).numpy())
+                for i in range(symbols.shape[0])]
+
+    def decompress(self, strings, indexes, dtype=torch.float, means=None, coder=None):
+        if indexes.numel() == 0:
+            return torch.zeros(indexes.shape, dtype=dtype, device=indexes.device)
+        if coder is None:
+            return decompress_buffers(self, strings, indexes, dtype=dtype, means=means)
+        _indexes = indexes.cpu()
+        symbols = torch.stack([
+            torch.from_numpy(coder.decode(self, s, _indexes[i].reshape(-1).numpy()))
+            for i, s in enumerate(strings)
+        ]).reshape(indexes.shape)
+        return self.dequantize(symbols.to(device=indexes.device), means, dtype)
+
+    def compress_substreams(self, inputs, indexes, means=None, num_streams=1, coder=None):
+        """ Split the symbols of each image into `num_streams` contiguous chunks (in the \
+            flattened C,H,W order) and encode each chunk as an independent stream, in parallel.
+
+        Args:
+            inputs  (torch.Tensor): (N, C, H, W) values to be encoded
+            indexes (torch.Tensor): (N, C, H, W) CDF indexes
+            means   (torch.Tensor, optional): (N, C, H, W) means
+            num_streams (int): number of sub-streams per image
+            coder (InterleavedRansCoder, optional): the entropy coder backend
+
+        Returns:
+            list[list[bytes]]: for each image, a list of `num_streams` strings
+        """
+        nB = inputs.shape[0]
+        chunks = [t.reshape(nB, -1).tensor_split(num_streams, dim=1) for t in (inputs, indexes)]
+        mean_chunks = [None] * num_streams if (means is None) else \
+                      means.reshape(nB, -1).tensor_split(num_streams, dim=1)
+        _encode = lambda x, idx, m: self.compress(x, idx, means=m, coder=coder)
+        pool = get_thread_pool(num_streams)
+        results = list(pool.map(_encode, *chunks, mean_chunks)) # stream -> image -> bytes
+        return [list(strs) for strs in zip(*results)] # image -> stream -> bytes
+
+    def decompress_substreams(self, strings, indexes, means=None, coder=None):
+        """ Decode the sub-streams produced by `compress_substreams()`, in parallel.
+
+        Args:
+            strings (list[list[bytes]]): for each image, a list of sub-stream strings
+            indexes (torch.Tensor): (N, C, H, W) CDF indexes
+            means   (torch.Tensor, optional): (N, C, H, W) means
+            coder (InterleavedRansCoder, optional): the entropy coder backend
+
+        Returns:
+            torch.Tensor: (N, C, H, W) decoded values
+        """
+        nB = indexes.shape[0]
+        num_streams = len(strings[0])
+        assert all([len(strs) == num_streams for strs in strings]), 'Inconsistent number of sub-streams'
+        stream_strings = [list(strs) for strs in zip(*strings)] # stream -> image -> bytes
+        idx_chunks = indexes.reshape(nB, -1).tensor_split(num_streams, dim=1)
+        mean_chunks = [None] * num_streams if (means is None) else \
+                      means.reshape(nB, -1).tensor_split(num_streams, dim=1)
+        _decode = lambda strs, idx, m: self.decompress(strs, idx, means=m, coder=coder)
+        pool = get_thread_pool(num_streams)
+        outputs = list(pool.map(_decode, stream_strings, idx_chunks, mean_chunks))
+        return torch.cat(outputs, dim=1).reshape(indexes.shape)
+
 
 def laplace_log_prob_mass(mean, scale, x, bin_size=1.0, prob_clamp=1e-6):
     mean, scale, x = _to_float32(mean, scale, x)
@@ -0,0 +1,224 @@
+'''
+Structured compression of the MLPs (fc1 -> GELU -> fc2) in `common.ConvNeXtBlockAdaLN`.
+
+Two methods:
+- pruning: remove the hidden channels of low importance, where the importance of a hidden
+  channel is its mean activation magnitude on a calibration set times the norm of its
+  (layer-scaled) output weights, normalized by the mean importance within the block. The mean
+  contribution of the removed channels is folded into the bias of fc2.
+- low-rank: factorize fc1 and fc2 by truncated SVD, for the layers where it reduces FLOPs.
+
+A compressed model has the same modules with smaller weights, and `match_mlp_shapes()` rebuilds
+the compressed shapes from a state dict, such that a checkpoint of a compressed model can be
+loaded by the model registry (e.g., `qarv_base(pretrained=path)`).
+'''
+import copy
+import math
+import torch
+import torch.nn as nn
+
+import lvae.models.common as common
+
+
+def mlp_blocks(model: nn.Module):
+    """ (name, block) of all `ConvNeXtBlockAdaLN` blocks in a model """
+    return [(name, m) for name, m in model.named_modules() if isinstance(m, common.ConvNeXtBlockAdaLN)]
+
+
+@torch.no_grad()
+def collect_mlp_activations(model: nn.Module, run_func):
+    """ Mean and mean absolute value of each hidden channel of the MLPs.
+
+    Args:
+        model (nn.Module): the model
+        run_func (callable): runs the model on the calibration set, e.g., `lambda: model(ims)`
+
+    Returns:
+        dict: block name -> dict of 'mean' and 'abs_mean', each a (hidden,) tensor
+    """
+    stats = dict()
+    def _hook(name, module, inputs, output):
+        x = output.flatten(0, -2).float() # (tokens, hidden); the MLP runs in channels-last
+        s = stats.setdefault(name, {'sum': 0.0, 'abs_sum': 0.0, 'count': 0})
+        s['sum'] = s['sum'] + x.sum(dim=0)
+        s['abs_sum'] = s['abs_sum'] + x.abs().sum(dim=0)
+        s['count'] += x.shape[0]
+    handles = [block.mlp.act.register_forward_hook(lambda m, i, o, name=name: _hook(name, m, i, o))
+               for name, block in mlp_blocks(model)]
+    try:
+        run_func()
+    finally:
+        for h in handles:
+            h.remove()
+    return {k: {'mean': s['sum'] / s['count'], 'abs_mean': s['abs_sum'] / s['count']}
+            for k, s in stats.items()}
+
+
+def channel_scores(model: nn.Module, activations: dict):
+    """ Importance of each hidden channel, normalized to mean 1 within each block.
+
+    Args:
+        model (nn.Module): the model
+        activations (dict): given by `collect_mlp_activations()`
+
+    Returns:
+        dict: block name -> (hidden,) tensor
+    """
+    scores = dict()
+    for name, block in mlp_blocks(model):
+        if name not in activations: # not executed on the calibration set
+            continue
+        w2 = block.mlp.fc2.weight # (out, hidden)
+        if block.gamma is not None:
+            w2 = w2 * block.gamma.view(-1, 1)
+        s = activations[name]['abs_mean'].to(w2) * w2.norm(dim=0)
+        scores[name] = s / s.mean().clamp(min=1e-12)
+    return scores
+
+
+def _linear_like(weight, bias):
+    layer = nn.Linear(weight.shape[1], weight.shape[0], bias=(bias is not None))
+    layer = layer.to(device=weight.device, dtype=weight.dtype)
+    layer.weight.data.copy_(weight)
+    if bias is not None:
+        layer.bias.data.copy_(bias)
+    return layer
+
+
+@torch.no_grad()
+def prune_mlp(block, keep: torch.Tensor, mean_act: torch.Tensor = None):
+    """ Keep a subset of the hidden channels of the MLP of a block.
+
+    Args:
+        block (common.ConvNeXtBlockAdaLN): the block, modified in place
+        keep (torch.Tensor): indices of the hidden channels to be kept
+        mean_act (torch.Tensor, optional): (hidden,) mean activations. If given, the mean \
+            contribution of the removed channels is added to the bias of fc2.
+    """
+    fc1, fc2 = block.mlp.fc1, block.mlp.fc2
+    keep = keep.to(fc1.weight.device).sort().values
+    bias2 = fc2.bias.clone() if (fc2.bias is not None) else None
+    if (mean_act is not None) and (bias2 is not None):
+        removed = torch.ones(fc1.weight.shape[0], dtype=torch.bool, device=keep.device)
+        removed[keep] = False
+        bias2 += fc2.weight[:, removed] @ mean_act.to(fc2.weight)[removed]
+    block.mlp.fc1 = _linear_like(fc1.weight[keep], None if (fc1.bias is None) else fc1.bias[keep])
+    block.mlp.fc2 = _linear_like(fc2.weight[:, keep], bias2)
+
+
+def _factorize(fc: nn.Linear, rank: int):
+    """ fc -> Linear(in, rank, bias=False) followed by Linear(rank, out), by truncated SVD """
+    U, S, Vh = torch.linalg.svd(fc.weight.float(), full_matrices=False)
+    sqrt_s = S[:rank].sqrt()
+    first = (sqrt_s.view(-1, 1) * Vh[:rank]).to(fc.weight) # (rank, in)
+    second = (U[:, :rank] * sqrt_s.view(1, -1)).to(fc.weight) # (out, rank)
+    return nn.Sequential(_linear_like(first, None), _linear_like(second, fc.bias))
+
+
+def _reduces_flops(fc: nn.Linear, rank: int):
+    return rank * (fc.in_features + fc.out_features) < fc.in_features * fc.out_features
+
+
+@torch.no_grad()
+def prune_model(model: nn.Module, scores: dict, ratio: float, activations: dict = None, min_hidden=8):
+    """ Remove a fraction `ratio` of all hidden channels, with the lowest normalized scores.
+
+    Args:
+        model (nn.Module): the model, modified in place
+        scores (dict): given by `channel_scores()`
+        ratio (float): fraction of the hidden channels (over all blocks) to be removed
+        activations (dict, optional): given by `collect_mlp_activations()`, for bias correction
+        min_hidden (int): minimum number of hidden channels of a block
+
+    Returns:
+        dict: block name -> (hidden channels before, after)
+    """
+    assert 0 <= ratio < 1, f'{ratio=}'
+    all_scores = torch.cat([s.flatten().float().cpu() for s in scores.values()])
+    num_removed = int(ratio * all_scores.numel())
+    if num_removed == 0:
+        return dict()
+    threshold = all_scores.kthvalue(num_removed).values.item()
+    summary = dict()
+    for name, block in mlp_blocks(model):
+        if name not in scores:
+            continue
+        s = scores[name]
+        num_keep = max(int((s > threshold).sum().item()), min(min_hidden, s.numel()))
+        if num_keep == s.numel():
+            continue
+        keep = torch.topk(s, k=num_keep).indices
+        mean_act = activations[name]['mean'] if (activations is not None) else None
+        prune_mlp(block, keep, mean_act=mean_act)
+        summary[name] = (s.numel(), num_keep)
+    return summary
+
+
+@torch.no_grad()
+def factorize_model(model: nn.Module, ratio: float):
+    """ Factorize fc1 and fc2 of all MLPs to rank `(1 - ratio) * min(in, out)`, for the layers \
+        where the factorization reduces FLOPs.
+
+    Returns:
+        dict: layer name -> (in, out, rank)
+    """
+    assert 0 <= ratio < 1, f'{ratio=}'
+    summary = dict()
+    for name, block in mlp_blocks(model):
+        for fc_name in ['fc1', 'fc2']:
+            fc = getattr(block.mlp, fc_name)
+            if not isinstance(fc, nn.Linear): # already factorized
+                continue
+            rank = max(1, math.ceil((1 - ratio) * min(fc.in_features, fc.out_features)))
+            if _reduces_flops(fc, rank):
+                setattr(block.mlp, fc_name, _factorize(fc, rank))
+                summary[f'{name}.mlp.{fc_name}'] = (fc.in_features, fc.out_features, rank)
+    return summary
+
+
+def compressed_copy(model: nn.Module, method: str, ratio: float, scores: dict = None,
+                    activations: dict = None):
+    """ Compress a copy of the model, by `prune_model()` (method='prune') or `factorize_model()`.
+
+    The copy is trainable, even if the model has been frozen (e.g., as the teacher of a \
+        previous distillation).
+
+    Returns:
+        nn.Module, dict: the compressed copy, and the summary of the changed layers
+    """
+    model = copy.deepcopy(model).requires_grad_(True)
+    if method == 'prune':
+        summary = prune_model(model, scores, ratio, activations=activations)
+    else:
+        summary = factorize_model(model, ratio)
+    return model, summary
+
+
+@torch.no_grad()
+def match_mlp_shapes(model: nn.Module, msd: dict):
+    """ Change the MLPs of a model to the (pruned or factorized) shapes in a state dict, \
+        such that `model.load_state_dict(msd)` works. The weights of the changed layers are \
+        placeholders to be overwritten by the state dict.
+    """
+    for name, block in mlp_blocks(model):
+        prefix = f'{name}.mlp.' if name else 'mlp.'
+        for fc_name in ['fc1', 'fc2']:
+            key = prefix + fc_name
+            if f'{key}.0.weight' in msd: # factorized
+                first, second = msd[f'{key}.0.weight'], msd[f'{key}.1.weight']
+                bias = msd.get(f'{key}.1.bias', None)
+                layer = nn.Sequential(_linear_like(first, None), _linear_like(second, bias))
+            elif f'{key}.weight' in msd:
+                weight, bias = msd[f'{key}.weight'], msd.get(f'{key}.bias', None)
+                if weight.shape == getattr(block.mlp, fc_name).weight.shape:
+                    continue
+                layer = _linear_like(weight, bias)
+            else:
+                continue
+            device = block.conv_dw.weight.device
+            setattr(block.mlp, fc_name, layer.to(device=device))
+
+
+def mlp_parameters(model: nn.Module):
+    """ Number of parameters in the MLPs """
+    return sum([p.numel() for _, block in mlp_blocks(model) for p in block.mlp.parameters()])
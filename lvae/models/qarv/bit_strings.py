@@ -0,0 +1,54 @@
+'''
+Parsing of qarv bit strings and files, shared by all qarv model versions.
+
+A bit string is either a container (see `lvae.utils.container`), or in the legacy format:
+lambda (float32), (1, nH, nW) (3 x uint16), and `coding.pack_byte_strings()` of the latent
+strings. A legacy file has the image size (2 x uint16) before the bit string.
+'''
+import struct
+
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+
+
+def parse_string(string, max_stride):
+    """ Parse a bit string into a dict of lambda, latent grid size, image size, and latent \
+        strings, as well as the other fields given by `container.unpack()` (None for the \
+        legacy format). The latent strings are zero-copy views of `string`.
+
+    Args:
+        string (bytes, memoryview, or mmap.mmap): the bit string
+        max_stride (int): the model's `max_stride`, for the image size of legacy bit strings
+    """
+    if container.is_container(string):
+        return container.unpack(string)
+    # legacy format: lambda, (1, nH, nW), and pack_byte_strings()
+    lmb = struct.unpack_from('f', string, 0)[0]
+    nB, nH, nW = struct.unpack_from('3H', string, 4)
+    assert nB == 1, f'Each bit string should contain a single image, got {nB=}'
+    info = dict(lmb=lmb, grid_hw=(nH, nW), img_hw=(nH*max_stride, nW*max_stride), model_id=None,
+                tiles=None, layers=None, mask_id=None, coder=None, prior_frac_bits=None,
+                strings=coding.unpack_byte_string(memoryview(string)[4 + 2 * 3:]))
+    return info
+
+
+def decompress_file(model, bits_path, **kwargs):
+    """ Decompress a file written by `model.compress_file()`. The file is memory-mapped, \
+        such that the payload is not copied before entropy decoding.
+
+    Args:
+        model: a qarv model
+        bits_path (str or Path): the file
+        kwargs: passed to `model.decompress()`
+
+    Returns:
+        torch.Tensor, tuple: the decompressed (padded) image, and the original (height, width)
+    """
+    with coding.mapped_file(bits_path) as buffer:
+        if container.is_container(buffer):
+            img_hw, offset = container.read_header(buffer.read)['img_hw'], 0
+        else: # legacy format: image size followed by the bit string
+            img_hw, offset = struct.unpack_from('2H', buffer, 0), 4
+        # the view is only referenced during decompression, so the map can be closed after it
+        im_hat = model.decompress(memoryview(buffer)[offset:], **kwargs)
+    return im_hat, img_hw
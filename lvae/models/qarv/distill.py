@@ -0,0 +1,190 @@
+'''
+Teacher-student distillation of variable-rate models (qarv and qarv v2).
+
+The student is trained by its own rate-distortion loss plus
+- the MSE between its reconstruction and the reconstruction of the teacher, and
+- the MSE between the statistics (posterior mean, prior mean, and log prior scale) of its
+  latent blocks and those of the teacher, for the latent blocks of the same latent shape,
+where the teacher and the student run at the same lambda.
+
+The lambda of qarv weights the distortion against the rate in nats per dimension, while the
+lambda of qarv v2 weights it against the rate in bpp. Here all lambdas are converted to the
+latter, i.e., the lambda of `bpp + lambda * mse`, which is called the bpp lambda.
+'''
+import math
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+from lvae.utils.coding import bd_rate
+from lvae.models.qarv.model import mse_loss
+import lvae.models.qarv.model_v2 as qarv_v2
+
+LOG2_E = math.log2(math.e)
+
+
+def bpp_lmb_scale(model):
+    """ The bpp lambda is `bpp_lmb_scale(model)` times the lambda of the model """
+    if isinstance(model, qarv_v2.VariableRateLossyVAE): # loss = bpp + lambda * mse
+        return 1.0
+    # loss = nats per dimension + lambda * mse, where a pixel has 3 dimensions
+    return 3 * LOG2_E
+
+
+def bpp_lmb_range(model):
+    low, high = model.lmb_range
+    scale = bpp_lmb_scale(model)
+    return (low * scale, high * scale)
+
+
+def forward_with_stats(model, im, lmb):
+    """ Forward pass ('trainval' mode) of a qarv or qarv v2 model.
+
+    Args:
+        model (nn.Module): the model
+        im    (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+        lmb   (torch.Tensor): (N,) lambdas of the model (not bpp lambdas)
+
+    Returns:
+        x_hat (torch.Tensor): the reconstruction, values roughly between (-1, 1)
+        x_target (torch.Tensor): the image, values between (-1, 1)
+        bpp (torch.Tensor): (N,) bits per pixel
+        block_stats (list): (posterior mean, prior mean, prior scale) of each latent block
+    """
+    if isinstance(model, qarv_v2.VariableRateLossyVAE):
+        fdict, x_target = model.forward_bottomup(im, lmb)
+        fdict['block_stats'] = []
+        fdict = model.forward_topdown(fdict, mode='trainval')
+    else:
+        fdict = model.forward_end2end(im, lmb, block_stats=True)
+        x_target = model.preprocess_target(im)
+    nH, nW = im.shape[2:4]
+    bpp = sum([kl.sum(dim=(1, 2, 3)) for kl in fdict['kl_divs']]) * LOG2_E / float(nH * nW)
+    return fdict['x_hat'], x_target, bpp, fdict['block_stats']
+
+
+def pair_latent_blocks(teacher_stats, student_stats):
+    """ Pair the latent blocks of the student with those of the teacher that have the same \
+        latent shape, in the coarse-to-fine order. Returns a list of (teacher index, student index).
+    """
+    pairs = []
+    i = 0
+    for j, (qm, _, _) in enumerate(student_stats):
+        while (i < len(teacher_stats)) and (teacher_stats[i][0].shape != qm.shape):
+            i += 1
+        if i == len(teacher_stats):
+            break
+        pairs.append((i, j))
+        i += 1
+    return pairs
+
+
+class Distillation(nn.Module):
+    """ Train a student by distillation from a frozen teacher, which stays in eval mode \
+        (i.e., with quantized latents, the same as in decompression).
+    """
+    def __init__(self, teacher, student, w_recon=1.0, w_stats=0.1):
+        super().__init__()
+        self.teacher = teacher
+        for p in teacher.parameters():
+            p.requires_grad_(False)
+        self.student = student
+        self.w_recon = w_recon
+        self.w_stats = w_stats
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.teacher.eval()
+        return self
+
+    def forward(self, im, lmb=None):
+        """ Distillation loss.
+
+        Args:
+            im  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            lmb (float, optional): the bpp lambda. Sampled by the student if not provided.
+
+        Returns:
+            dict: 'loss' and the metrics of the student and the teacher
+        """
+        teacher, student = self.teacher, self.student
+        im = im.to(student._dummy.device)
+        nB = im.shape[0]
+        if lmb is None:
+            lmb_s = student.sample_lmb(n=nB)
+        else:
+            lmb_s = torch.full((nB,), lmb / bpp_lmb_scale(student), device=im.device)
+        lmb = lmb_s * bpp_lmb_scale(student) # (N,) bpp lambdas
+        low, high = teacher.lmb_range
+        lmb_t = (lmb / bpp_lmb_scale(teacher)).clamp(min=low, max=high)
+
+        with torch.no_grad():
+            x_teacher, _, bpp_t, stats_t = forward_with_stats(teacher, im, lmb_t)
+        x_hat, x_target, bpp, stats_s = forward_with_stats(student, im, lmb_s)
+        # distortion w.r.t. the image and the reconstruction of the teacher
+        mse = mse_loss(x_hat, x_target) # (N,)
+        mse_teacher = mse_loss(x_hat, x_teacher) # (N,)
+        # statistics of the latent blocks
+        pairs = pair_latent_blocks(stats_t, stats_s)
+        stats_loss = torch.zeros_like(bpp)
+        for i, j in pairs:
+            (qm_t, pm_t, pv_t), (qm_s, pm_s, pv_s) = stats_t[i], stats_s[j]
+            stats_loss = stats_loss + mse_loss(qm_s, qm_t) + mse_loss(pm_s, pm_t) \
+                       + mse_loss(torch.log(pv_s), torch.log(pv_t))
+        stats_loss = stats_loss / max(len(pairs), 1)
+        loss = bpp + lmb * (mse + self.w_recon * mse_teacher) + self.w_stats * stats_loss
+
+        metrics = OrderedDict()
+        metrics['loss'] = loss.mean(0)
+        with torch.no_grad():
+            # pixel values in (-1, 1), so the mse in (0, 1) is 1/4 of it
+            _psnr = lambda x: -10 * math.log10(mse_loss(x.clamp(-1, 1), x_target).mean().item() / 4)
+            metrics['bpp'] = bpp.mean(0).item()
+            metrics['psnr'] = _psnr(x_hat.detach())
+            metrics['bpp-teacher'] = bpp_t.mean(0).item()
+            metrics['psnr-teacher'] = _psnr(x_teacher)
+            metrics['psnr-to-teacher'] = -10 * math.log10(mse_teacher.mean(0).item() / 4)
+            metrics['stats-mse'] = stats_loss.mean(0).item()
+        return metrics
+
+
+def common_bpp_lambdas(models, steps=6):
+    """ Log-uniform bpp lambdas within the lambda ranges of all models """
+    low = max([bpp_lmb_range(m)[0] for m in models])
+    high = min([bpp_lmb_range(m)[1] for m in models])
+    assert low < high, 'The lambda ranges of the models do not overlap'
+    return torch.linspace(math.log(low), math.log(high), steps=steps).exp().tolist()
+
+
+@torch.no_grad()
+def evaluate_rd(model, ims, bpp_lmbs):
+    """ Rate-distortion curve of a model in eval mode, where the rate is estimated by the \
+        probabilities of the quantized latents.
+
+    Args:
+        model (nn.Module): a qarv or qarv v2 model
+        ims   (list[torch.Tensor]): images, each (1, 3, H, W) with H and W divisible by the \
+            maximum stride of the model
+        bpp_lmbs (list[float]): bpp lambdas
+
+    Returns:
+        dict: lists of 'lambda' (bpp lambdas), 'bpp', and 'psnr', each averaged over images
+    """
+    results = {'lambda': [], 'bpp': [], 'psnr': []}
+    device = model._dummy.device
+    for lmb in bpp_lmbs:
+        lmb_model = torch.full((1,), lmb / bpp_lmb_scale(model), device=device)
+        bpps, psnrs = [], []
+        for im in ims:
+            x_hat, x_target, bpp, _ = forward_with_stats(model, im.to(device), lmb_model)
+            bpps.append(bpp.item())
+            psnrs.append(-10 * math.log10(mse_loss(x_hat.clamp(-1, 1), x_target).item() / 4))
+        results['lambda'].append(lmb)
+        results['bpp'].append(sum(bpps) / len(bpps))
+        results['psnr'].append(sum(psnrs) / len(psnrs))
+    return results
+
+
+def bd_rate_over(anchor_rd, rd):
+    """ BD-rate (%) of an RD curve over an anchor RD curve, both given by `evaluate_rd()` """
+    return float(bd_rate(anchor_rd['bpp'], anchor_rd['psnr'], rd['bpp'], rd['psnr']))
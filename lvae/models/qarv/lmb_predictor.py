@@ -0,0 +1,111 @@
+'''
+Predict the lambda that encodes an image at a target bpp, for one-shot rate control.
+
+The predictor is a small ridge regression of log-lambda on cheap image features and the
+log target bpp. It is fitted, for a given model, from cached (features, lambda, bytes) records
+by `scripts/qarv/calibrate-lmb-predictor.py`, and is used by
+`VariableRateLossyVAE.compress_to_size()` as the first guess of lambda.
+
+Features of an image:
+- log mean absolute gradient of the luma
+- log standard deviation of the luma
+- log estimated bpp (see `VariableRateLossyVAE.estimate_bits()`) of a 4x downsampled image at
+  a reference lambda, i.e., a coarse rate of the image given by the model itself
+'''
+from pathlib import Path
+import math
+import torch
+import torch.nn.functional as tnf
+
+
+@torch.no_grad()
+def image_features(model, im: torch.Tensor, ref_lmb: float, down_rate=4):
+    """ Cheap features of a batch of images.
+
+    Args:
+        model (VariableRateLossyVAE): the model whose coarse rate is used as a feature
+        im (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+        ref_lmb (float): the lambda of the coarse rate
+        down_rate (int): the downsampling rate of the image for the coarse rate
+
+    Returns:
+        torch.Tensor: (N, 3) features, on cpu
+    """
+    luma = (0.299 * im[:, 0] + 0.587 * im[:, 1] + 0.114 * im[:, 2]).float()
+    grad = (luma[:, :, 1:] - luma[:, :, :-1]).abs().mean(dim=(1, 2)) \
+         + (luma[:, 1:, :] - luma[:, :-1, :]).abs().mean(dim=(1, 2))
+    std = luma.flatten(1).std(dim=1)
+    # coarse rate: estimated bpp of a downsampled image
+    thumb = tnf.avg_pool2d(im, kernel_size=down_rate, stride=down_rate)
+    nH, nW = thumb.shape[2:4]
+    div = model.max_stride
+    pad = (0, (div - nW % div) % div, 0, (div - nH % div) % div)
+    thumb = tnf.pad(thumb, pad, mode='replicate') if any(pad) else thumb
+    bpp = model.estimate_bits(thumb, lmbs=ref_lmb) / (nH * nW)
+    features = [torch.log(grad + 1e-4), torch.log(std + 1e-4), torch.log(bpp.to(grad) + 1e-4)]
+    return torch.stack(features, dim=1).cpu()
+
+
+class LambdaPredictor():
+    """ log lambda = w @ phi(features, log bpp), where phi is the features, their pairwise \
+        products, the log bpp, the squared log bpp, and the products of the log bpp with the features.
+    """
+    def __init__(self, weights: torch.Tensor, lmb_range, ref_lmb: float, model_name=None):
+        self.weights = weights.double()
+        self.lmb_range = tuple(lmb_range)
+        self.ref_lmb = float(ref_lmb)
+        self.model_name = model_name
+
+    @staticmethod
+    def _design_matrix(features: torch.Tensor, bpps: torch.Tensor):
+        features = features.double()
+        t = torch.log(bpps.double()).view(-1, 1)
+        ones = torch.ones_like(t)
+        i, j = torch.triu_indices(features.shape[1], features.shape[1])
+        pairs = features[:, i] * features[:, j]
+        return torch.cat([ones, features, pairs, t, t * t, t * features], dim=1)
+
+    @classmethod
+    def fit(cls, features, bpps, lmbs, lmb_range, ref_lmb, ridge=1e-3, model_name=None):
+        """ Least-squares fit of log lambda.
+
+        Args:
+            features (torch.Tensor): (M, 3) features of the image of each record
+            bpps     (torch.Tensor): (M,) real bpp of each record
+            lmbs     (torch.Tensor): (M,) lambda of each record
+            lmb_range (tuple): the lambda range of the model
+            ref_lmb  (float): the lambda of the coarse rate feature
+            ridge    (float): weight of the L2 regularization
+        """
+        X = cls._design_matrix(features, bpps)
+        y = torch.log(lmbs.double()).view(-1, 1)
+        A = X.T @ X + ridge * X.shape[0] * torch.eye(X.shape[1], dtype=X.dtype)
+        weights = torch.linalg.solve(A, X.T @ y).view(-1)
+        return cls(weights, lmb_range, ref_lmb, model_name=model_name)
+
+    def predict(self, features: torch.Tensor, bpps):
+        """ Predict lambda given the features and the target bpp of each image.
+
+        Args:
+            features (torch.Tensor): (N, 3) features, see `image_features()`
+            bpps (torch.Tensor or float): (N,) target bpp. A single value is shared by all images.
+
+        Returns:
+            torch.Tensor: (N,) lambdas, clamped to the lambda range of the model
+        """
+        bpps = torch.as_tensor(bpps, dtype=torch.double).expand(features.shape[0])
+        log_lmbs = self._design_matrix(features, bpps) @ self.weights
+        low, high = self.lmb_range
+        return log_lmbs.clamp(min=math.log(low), max=math.log(high)).exp().float()
+
+    def state_dict(self):
+        return {'weights': self.weights, 'lmb_range': self.lmb_range, 'ref_lmb': self.ref_lmb,
+                'model_name': self.model_name}
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        torch.save(self.state_dict(), path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(**torch.load(path))
@@ -2,8 +2,11 @@ from PIL import Image
 from tqdm import tqdm
 from pathlib import Path
 from collections import OrderedDict, defaultdict
+from concurrent.futures import Future
+from functools import partial
 import math
 import struct
+import zlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as tnf
@@ -12,8 +15,11 @@ import torchvision.transforms.functional as tvf
 from timm.utils import AverageMeter
 
 import lvae.utils.coding as coding
+import lvae.utils.container as container
 import lvae.models.common as common
 import lvae.models.entropy_coding as entropy_coding
+from lvae.models.qarv.lmb_predictor import LambdaPredictor, image_features
+import lvae.models.qarv.bit_strings as bit_strings
 
 
 class VRLVBlockBase(nn.Module):
@@ -40,6 +46,12 @@ class VRLVBlockBase(nn.Module):
 
         self.discrete_gaussian = entropy_coding.DiscretizedGaussian()
         self.is_latent_block = True
+        self.num_substreams = 1 # number of independent sub-streams (coded in parallel) per image
+        # (zdim,) bool tensor of the channels to be entropy coded. None means all channels.
+        self.register_buffer('coded_channels', None, persistent=False)
+        # if not None, the prior parameters are snapped to a fixed-point grid with this number
+        # of fractional bits before entropy coding. See `VariableRateLossyVAE.set_fixed_point_prior()`.
+        self.prior_frac_bits = None
 
     def transform_prior(self, feature, lmb_embedding):
         """ prior p(z_i | z_<i)
@@ -91,6 +103,21 @@ class VRLVBlockBase(nn.Module):
                 z, probs = self.discrete_gaussian(qm, scales=pv, means=pm)
                 kl = -1.0 * torch.log(probs)
             fdict['kl_divs'].append(kl)
+            if 'block_stats' in fdict: # posterior mean, prior mean and scale, e.g., for distillation
+                fdict['block_stats'].append((qm, pm, pv))
+        elif mode == 'estimate': # same z as in 'compress', but only estimate the rate
+            enc_feature = fdict['enc_features'][self.enc_key]
+            qm = self.transform_posterior(feature, enc_feature, emb)
+            if self.prior_frac_bits is not None: # the prior means snapped to the grid, as in coding
+                pm, _, _ = self._coding_prior(pm, pv)
+            # the rate uses the continuous scale instead of the scale table, in both modes
+            z, probs = self.discrete_gaussian(qm, scales=pv, means=pm)
+            kl = -1.0 * torch.log(probs)
+            if self.coded_channels is not None: # the channels not coded cost no bits
+                mask = self.coded_channels.view(1, -1, 1, 1)
+                z = torch.where(mask, z, pm)
+                kl = kl * mask
+            fdict['kl_divs'].append(kl)
         elif mode == 'sampling':
             if latent is None: # if z is not provided, sample it from the prior
                 z = pm + pv * torch.randn_like(pm) * t + torch.empty_like(pm).uniform_(-0.5, 0.5) * t
@@ -100,14 +127,32 @@ class VRLVBlockBase(nn.Module):
         elif mode == 'compress': # encode z into bits
             enc_feature = fdict['enc_features'][self.enc_key]
             qm = self.transform_posterior(feature, enc_feature, emb)
-            indexes = self.discrete_gaussian.build_indexes(pv)
-            strings = self.discrete_gaussian.compress(qm, indexes, means=pm)
+            pm, pm_c, indexes = self._coding_prior(pm, pv)
+            qm_c, = self._select_coded(qm)
+            if self.num_substreams > 1: # for each image, a list of sub-stream strings
+                job = partial(self.discrete_gaussian.compress_substreams, qm_c, indexes, means=pm_c,
+                              num_streams=self.num_substreams, coder=fdict.get('entropy_coder', None))
+            else:
+                job = partial(self.discrete_gaussian.compress, qm_c, indexes, means=pm_c,
+                              coder=fdict.get('entropy_coder', None))
+            # z does not depend on the bits, so entropy coding can run in the background
+            coding_pool = fdict.get('coding_pool', None)
+            strings = job() if (coding_pool is None) else coding_pool.submit(job)
             z = self.discrete_gaussian.quantize(qm, mode='dequantize', means=pm)
+            if self.coded_channels is not None: # the channels not coded are the prior mean
+                z = torch.where(self.coded_channels.view(1, -1, 1, 1), z, pm)
             fdict['bit_strings'].append(strings)
         elif mode == 'decompress': # decode z from bits
             assert strings is not None
-            indexes = self.discrete_gaussian.build_indexes(pv)
-            z = self.discrete_gaussian.decompress(strings, indexes, means=pm)
+            pm, pm_c, indexes = self._coding_prior(pm, pv)
+            coder = fdict.get('entropy_coder', None)
+            if isinstance(strings[0], (list, tuple)): # sub-streams
+                z = self.discrete_gaussian.decompress_substreams(strings, indexes, means=pm_c, coder=coder)
+            else:
+                z = self.discrete_gaussian.decompress(strings, indexes, means=pm_c, coder=coder)
+            if self.coded_channels is not None: # the channels not coded are the prior mean
+                z_c, z = z, pm.clone()
+                z[:, self.coded_channels] = z_c.to(dtype=pm.dtype)
         else:
             raise ValueError(f'Unknown mode={mode}')
 
@@ -117,10 +162,55 @@ class VRLVBlockBase(nn.Module):
         fdict['zs'].append(z)
         return fdict
 
+    def _select_coded(self, *tensors):
+        """ Select the channels to be entropy coded, if `self.coded_channels` is set """
+        if self.coded_channels is None:
+            return tensors
+        return [None if (t is None) else t[:, self.coded_channels] for t in tensors]
+
+    def _coding_prior(self, pm, pv):
+        """ The prior means and the CDF indexes used for entropy coding.
+
+        Returns:
+            tuple: (pm, pm of the coded channels, CDF indexes of the coded channels). In the \
+                fixed-point mode, pm is snapped to the grid.
+        """
+        if self.prior_frac_bits is not None:
+            pm = entropy_coding.quantize_means(pm, self.prior_frac_bits)
+        _, pm_c, pv_c = self._select_coded(None, pm, pv)
+        if self.prior_frac_bits is None:
+            indexes = self.discrete_gaussian.build_indexes(pv_c)
+        else: # integer-only index selection
+            indexes = entropy_coding.build_indexes_fixed_point(self.discrete_gaussian, torch.log(pv_c),
+                                                               self.prior_frac_bits)
+        return pm, pm_c, indexes
+
     def update(self):
         self.discrete_gaussian.update()
 
 
+class ThumbnailHead(nn.Module):
+    """ A small side head that maps a top-down feature to a downscaled image, such that \
+        thumbnails can be decoded without the remaining (high-resolution) blocks.
+    """
+    def __init__(self, in_ch, width=64, rate=2):
+        super().__init__()
+        self.in_channels = in_ch
+        self.conv_in = common.conv_k1s1(in_ch, width)
+        self.residual = nn.Sequential(
+            common.conv_k3s1(width, width),
+            nn.GELU(),
+            common.conv_k3s1(width, width),
+        )
+        self.conv_out = common.patch_upsample(width, 3, rate=rate)
+
+    def forward(self, x):
+        x = self.conv_in(x)
+        x = x + self.residual(x)
+        x = self.conv_out(x)
+        return x
+
+
 def mse_loss(fake, real):
     assert fake.shape == real.shape
     return tnf.mse_loss(fake, real, reduction='none').mean(dim=(1,2,3))
@@ -140,6 +230,10 @@ class VariableRateLossyVAE(nn.Module):
         self.bias = nn.Parameter(torch.zeros(1, width, 1, 1))
 
         self.num_latents = len([b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)])
+        # optional thumbnail side heads. {scale denominator: (index of the dec block, head)}
+        heads = config.pop('thumbnail_heads', dict())
+        self.thumbnail_heads = nn.ModuleDict({str(d): head for d, (_, head) in heads.items()})
+        self.thumbnail_points = {d: bi for d, (bi, _) in heads.items()}
         # loss function, for computing reconstruction loss
         self.distortion_name = 'mse'
         self.distortion_func = mse_loss
@@ -154,6 +248,13 @@ class VariableRateLossyVAE(nn.Module):
         self._dummy: torch.Tensor
 
         self.compressing = False
+        self.pipelined_coding = False # overlap entropy coding with network computation
+        # entropy coder backend. None: the rANS coder of compressai. See `InterleavedRansCoder`.
+        self.entropy_coder = None
+        # fractional bits of the fixed-point prior parameters. See `set_fixed_point_prior()`.
+        self.prior_frac_bits = None
+        # first guess of lambda in `compress_to_size()`. See `set_lmb_predictor()`.
+        self.lmb_predictor = None
         self._logging_images = config.get('log_images', [])
         self._flops_mode = False
 
@@ -252,7 +353,8 @@ class VariableRateLossyVAE(nn.Module):
         feature = self.bias.expand(nB, -1, nH, nW)
         return feature
 
-    def forward_end2end(self, im: torch.Tensor, lmb: torch.Tensor, mode='trainval'):
+    def forward_end2end(self, im: torch.Tensor, lmb: torch.Tensor, mode='trainval', coding_pool=None,
+                        block_stats=False):
         x = self.preprocess_input(im)
 
         fdict = dict() # a feature dictionary containing all features
@@ -262,19 +364,32 @@ class VariableRateLossyVAE(nn.Module):
         fdict['zs'] = [] # latent variables
         fdict['kl_divs'] = [] # kl (i.e., rate) for each latent variable
         fdict['bit_strings'] = [] # compressed bit strings; only used in 'compress' mode
+        if block_stats: # (posterior mean, prior mean, prior scale) of each latent block; 'trainval' mode
+            fdict['block_stats'] = []
+        if (mode == 'compress') and (coding_pool is None) and self.pipelined_coding:
+            coding_pool = entropy_coding.get_thread_pool(1, name='pipeline')
+        if (mode == 'compress') and (coding_pool is not None):
+            # background worker(s) for entropy coding; 'bit_strings' will contain futures
+            fdict['coding_pool'] = coding_pool
+        if mode == 'compress':
+            fdict['entropy_coder'] = self.entropy_coder
         nB, _, xH, xW = x.shape
         feature = self.get_bias(bhw_repeat=(nB, xH//self.max_stride, xW//self.max_stride))
         fdict['feature'] = feature # main feature; will be updated in the following loop
+        fdict['thumbnail_features'] = dict() # inputs of the thumbnail heads
+        thumbnail_at = {bi: d for d, bi in self.thumbnail_points.items()}
         for i, block in enumerate(self.dec_blocks):
             if getattr(block, 'is_latent_block', False):
                 fdict = block(fdict, mode=mode)
             elif getattr(block, 'requires_embedding', False):
                 fdict['feature'] = block(fdict['feature'], fdict['lmb_emb'])
-            elif isinstance(block, common.CompresionStopFlag) and (mode == 'compress'):
+            elif isinstance(block, common.CompresionStopFlag) and (mode in ('compress', 'estimate')):
                 # no need to execute remaining blocks when compressing
                 return fdict
             else:
                 fdict['feature'] = block(fdict['feature'])
+            if i in thumbnail_at:
+                fdict['thumbnail_features'][thumbnail_at[i]] = fdict['feature']
         fdict['x_hat'] = fdict.pop('feature') # rename 'feature' to 'x_hat'
         return fdict
 
@@ -316,6 +431,69 @@ class VariableRateLossyVAE(nn.Module):
             return metrics, fdict
         return metrics
 
+    def forward_thumbnails(self, im, lmb=None):
+        """ Forward pass for training the thumbnail heads on top of frozen weights. The top-down \
+            path runs without gradients, and the model (except the heads) should be in eval \
+            mode, such that the heads see the same (quantized) features as in decompression.
+
+        Args:
+            im  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            lmb (torch.Tensor or float, optional): lambda. Sampled at random if not provided.
+
+        Returns:
+            dict: 'loss' (sum of the MSE of all heads), and the PSNR of each thumbnail scale
+        """
+        assert len(self.thumbnail_heads) > 0, 'The model has no thumbnail heads'
+        assert not any([b.training for b in self.dec_blocks]), 'The top-down path should be in eval mode'
+        im = im.to(self._dummy.device)
+        nB = im.shape[0]
+        lmb = self.sample_lmb(n=nB) if (lmb is None) else self.expand_to_tensor(lmb, n=nB)
+        with torch.no_grad():
+            fdict = self.forward_end2end(im, lmb)
+            x_target = self.preprocess_target(im)
+
+        metrics = OrderedDict()
+        losses = []
+        for d, feature in fdict['thumbnail_features'].items():
+            x_hat = self.thumbnail_heads[str(d)](feature)
+            mse = tnf.mse_loss(x_hat, tnf.avg_pool2d(x_target, kernel_size=d), reduction='mean')
+            losses.append(mse)
+            # pixel values in (-1, 1), so the mse in (0, 1) is 1/4 of it
+            metrics[f'psnr-1/{d}'] = -10 * math.log10(mse.item() / 4)
+        metrics['loss'] = sum(losses)
+        metrics.move_to_end('loss', last=False)
+        return metrics
+
+    @property
+    def synthesis_tail(self):
+        """ The blocks after `CompresionStopFlag`, i.e., the synthesis blocks that do not affect \
+            the bit strings. Returned as a ModuleList that shares the modules of `self.dec_blocks`, \
+            such that its `state_dict()` and `load_state_dict()` only touch the tail.
+        """
+        flags = [i for i, b in enumerate(self.dec_blocks) if isinstance(b, common.CompresionStopFlag)]
+        assert len(flags) == 1, f'Expect a single CompresionStopFlag, got {len(flags)}'
+        return nn.ModuleList(self.dec_blocks[flags[0]+1:])
+
+    def forward_tail(self, feature, lmb_emb, tail=None):
+        """ Run the synthesis tail on the top-down feature at `CompresionStopFlag`.
+
+        Args:
+            feature (torch.Tensor): fdict['feature'] given by `forward_end2end(mode='estimate')`
+            lmb_emb (torch.Tensor): fdict['lmb_emb']
+            tail (nn.ModuleList, optional): the blocks to be run. Defaults to `self.synthesis_tail`.
+
+        Returns:
+            torch.Tensor: the reconstruction, values roughly between (-1, 1)
+        """
+        tail = self.synthesis_tail if (tail is None) else tail
+        for block in tail:
+            assert not getattr(block, 'is_latent_block', False), 'No latent block is allowed after the stop flag'
+            if getattr(block, 'requires_embedding', False):
+                feature = block(feature, lmb_emb)
+            else:
+                feature = block(feature)
+        return feature
+
     @torch.inference_mode()
     def conditional_sample(self, lmb, latents, emb=None, bhw_repeat=None, t=1.0):
         """ sampling, conditioned on a list of latents variables
@@ -468,62 +646,510 @@ class VariableRateLossyVAE(nn.Module):
                 all_lmb_stats[k].append(v)
         return all_lmb_stats
 
-    def compress_mode(self, mode=True):
+    def compress_mode(self, mode=True, num_substreams=1, cdf_tables=False):
+        """ Prepare the entropy models for compression.
+
+        Args:
+            mode (bool): whether to enter the compression mode
+            num_substreams (int): split the symbols of each latent block into this number of \
+                independent sub-streams, which are encoded and decoded on a thread pool. \
+                Only affects the encoder; the decoder infers it from the bit string.
+            cdf_tables (str, Path, or bool): file of the persisted (memory-mapped) CDF tables, \
+                which is read if it exists and written otherwise. True means \
+                `entropy_coding.default_cdf_tables_path()`. False (default) means to always \
+                compute the tables, without touching any file.
+        """
+        assert num_substreams >= 1, f'{num_substreams=}'
         if mode:
+            def _update_all():
+                for block in self.dec_blocks:
+                    if hasattr(block, 'update'):
+                        block.update()
+            entropy_coding.update_with_cdf_tables(_update_all, path=cdf_tables)
             for block in self.dec_blocks:
-                if hasattr(block, 'update'):
-                    block.update()
+                if getattr(block, 'is_latent_block', False):
+                    block.num_substreams = num_substreams
         self.compressing = mode
 
+    def set_channel_masks(self, masks=None):
+        """ Skip the entropy coding of dead latent channels, i.e., channels that carry \
+            (almost) no information at any lambda. The channels not coded are set to the \
+            prior mean by both the encoder and the decoder.
+
+        Args:
+            masks (list[torch.Tensor], str, or None): for each latent block, a (zdim,) bool \
+                tensor where True means the channel is coded. A str is the path to the masks \
+                saved by `scripts/qarv/calibrate-channel-mask.py`. None codes all channels.
+        """
+        latent_blocks = [b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)]
+        if isinstance(masks, (str, Path)):
+            masks = torch.load(masks)['masks']
+        masks = [None] * len(latent_blocks) if (masks is None) else masks
+        assert len(masks) == len(latent_blocks), f'{len(masks)=}, {len(latent_blocks)=}'
+        for block, mask in zip(latent_blocks, masks):
+            if mask is not None:
+                mask = mask.to(device=self._dummy.device, dtype=torch.bool)
+                assert mask.shape == (block.prior.out_channels // 2,), f'{mask.shape=}'
+            block.coded_channels = mask
+
+    def set_fixed_point_prior(self, frac_bits=8):
+        """ Snap the prior means and log-scales to a fixed-point grid with `frac_bits` \
+            fractional bits before CDF index selection and mean subtraction, and select the \
+            indexes by integer comparison. Floating-point differences between the encoder and \
+            the decoder (e.g., due to the number of threads, the batch size, or the SIMD path) \
+            then only matter when they move a value across a grid point, instead of drifting \
+            through every following latent block.
+
+        Args:
+            frac_bits (int or None): number of fractional bits. None disables the fixed-point \
+                mode, i.e., the floating-point prior parameters are used directly.
+        """
+        assert (frac_bits is None) or (0 <= frac_bits <= 16), f'{frac_bits=}'
+        for block in self.dec_blocks:
+            if getattr(block, 'is_latent_block', False):
+                block.prior_frac_bits = frac_bits
+        self.prior_frac_bits = frac_bits
+
+    def set_lmb_predictor(self, predictor=None):
+        """ Set the lambda predictor, which gives the first guess of lambda in \
+            `compress_to_size()`, such that most images need a single entropy coding pass.
+
+        Args:
+            predictor (LambdaPredictor, str, or None): a str is the path to the predictor saved \
+                by `scripts/qarv/calibrate-lmb-predictor.py`. None disables the prediction.
+        """
+        if isinstance(predictor, (str, Path)):
+            predictor = LambdaPredictor.load(predictor)
+        if predictor is not None:
+            assert tuple(predictor.lmb_range) == tuple(self.lmb_range), f'{predictor.lmb_range=}'
+        self.lmb_predictor = predictor
+
+    @torch.no_grad()
+    def predict_lmb(self, ims, bpps):
+        """ Predict the lambda that encodes each image at the target bpp (see `set_lmb_predictor()`).
+
+        Args:
+            ims  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            bpps (torch.Tensor or float): (N,) target bpp. A single value is shared by all images.
+
+        Returns:
+            torch.Tensor: (N,) lambdas
+        """
+        assert self.lmb_predictor is not None, 'No lambda predictor. See `set_lmb_predictor()`.'
+        features = image_features(self, ims, ref_lmb=self.lmb_predictor.ref_lmb)
+        return self.lmb_predictor.predict(features, bpps)
+
+    def _check_prior_frac_bits(self, frac_bits):
+        assert frac_bits == self.prior_frac_bits, f'The bit string is coded with {frac_bits=} ' \
+            f'fixed-point prior, but the model uses {self.prior_frac_bits}. See `set_fixed_point_prior()`.'
+
+    def channel_mask_id(self):
+        """ A 32-bit id of the channel masks, which is stored in the bit strings, or None \
+            if all channels are coded.
+        """
+        latent_blocks = [b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)]
+        if all([b.coded_channels is None for b in latent_blocks]):
+            return None
+        masks = [
+            torch.ones(b.prior.out_channels // 2, dtype=torch.bool) if (b.coded_channels is None)
+            else b.coded_channels.cpu() for b in latent_blocks
+        ]
+        return zlib.crc32(b''.join([m.numpy().tobytes() for m in masks]))
+
+    def _coder_info(self):
+        """ (coder id, precision) of the entropy coder, which is stored in the bit strings, \
+            or None for the default rANS coder of compressai.
+        """
+        if self.entropy_coder is None:
+            return None
+        return (self.entropy_coder.coder_id, self.entropy_coder.precision)
+
+    def _get_decoder(self, coder_info):
+        """ The entropy coder for decoding bit strings with `coder_info` (see `_coder_info()`). \
+            `self.entropy_coder` is used if it matches, such that its settings are kept.
+        """
+        if coder_info == self._coder_info():
+            return self.entropy_coder
+        return entropy_coding.get_entropy_coder(*coder_info) if (coder_info is not None) else None
+
+    def _check_mask_id(self, mask_id):
+        assert mask_id == self.channel_mask_id(), f'The bit string is coded with channel masks ' \
+            f'{mask_id}, but the model uses {self.channel_mask_id()}. See `set_channel_masks()`.'
+
+    def _lmbs_to_tensor(self, lmbs, n):
+        return common.lmbs_to_tensor(lmbs, n, default=self.default_lmb, device=self._dummy.device)
+
+    @torch.no_grad()
+    def estimate_bits(self, ims, lmbs=None, breakdown=False):
+        """ Estimate the number of bits of each image from the probabilities of the latent \
+            variables, without entropy coding. Only the encoder and the latent blocks (up to \
+            `CompresionStopFlag`) are executed.
+
+        Args:
+            ims  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            lmbs (torch.Tensor, list, or float): lambda for each image, shape (N,). \
+                A single value is shared by all images. Defaults to `self.default_lmb`.
+            breakdown (bool): if True, also return bits per latent block and per channel. \
+                See `entropy_coding.nats_to_bits()`.
+
+        Returns:
+            torch.Tensor: estimated bits of each image, shape (N,), excluding the container header
+        """
+        lmbs = self._lmbs_to_tensor(lmbs, n=ims.shape[0])
+        fdict = self.forward_end2end(ims, lmb=lmbs, mode='estimate')
+        return entropy_coding.nats_to_bits(fdict['kl_divs'], breakdown=breakdown)
+
+    @torch.no_grad()
+    def compress_to_size(self, im, max_bytes, tol=0.02, max_encodes=3, return_info=False):
+        """ Compress an image into at most `max_bytes` bytes, using as much of the budget as \
+            possible. Lambda is searched on the estimated rate (see `estimate_bits()`), by \
+            interpolating log-bytes against log-lambda, and the estimate is corrected by the \
+            real size after each entropy coding pass. Usually one or two passes are needed. \
+            If a lambda predictor is set (see `set_lmb_predictor()`), the first pass uses the \
+            predicted lambda, and the search is only run if it misses the tolerance.
+
+        Args:
+            im  (torch.Tensor): an image, (1, 3, H, W), values between (0, 1)
+            max_bytes (int): the byte budget
+            tol (float): stop when the size is within [(1 - tol) * max_bytes, max_bytes]
+            max_encodes (int): maximum number of entropy coding passes
+            return_info (bool): whether to also return a dict of the search statistics
+
+        Returns:
+            bytes: the bit string. If even the lowest lambda exceeds the budget, the smallest \
+                bit string found is returned.
+        """
+        assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
+        log_lo, log_hi = [math.log(v) for v in self.lmb_range]
+        curve = dict() # log lambda -> log estimated bytes
+        num_estimates = 0
+
+        def _estimate(log_lmbs):
+            nonlocal num_estimates
+            new = [v for v in log_lmbs if v not in curve]
+            if len(new) > 0: # all lambdas in one batched pass
+                lmbs = torch.tensor(new, dtype=torch.float).exp()
+                est = self.estimate_bits(im.expand(len(new), -1, -1, -1), lmbs) / 8
+                curve.update(zip(new, torch.log(est).tolist()))
+                num_estimates += len(new)
+            return [curve[v] for v in log_lmbs]
+
+        def _solve(target):
+            # piece-wise linear interpolation of log lambda given log bytes, clamped to the range
+            xs = sorted(curve.keys())
+            ys = [curve[x] for x in xs]
+            if target <= ys[0]:
+                return log_lo
+            if target >= ys[-1]:
+                return log_hi
+            k = next(i for i in range(1, len(ys)) if ys[i] >= target)
+            w = (target - ys[k-1]) / max(ys[k] - ys[k-1], 1e-8)
+            return xs[k-1] + w * (xs[k] - xs[k-1])
+
+        def _done(string, log_lmb):
+            if len(string) <= max_bytes:
+                return (len(string) >= (1 - tol) * max_bytes) or (log_lmb >= log_hi - 1e-4)
+            return log_lmb <= log_lo + 1e-4 # cannot be any smaller
+
+        coarse = [log_lo, (log_lo + log_hi) / 2, log_hi] # a coarse curve to start with
+        offset = 0.0 # log(real bytes) - log(estimated bytes), updated after each encoding
+        results = [] # (bit string, lambda)
+        done = False
+        if self.lmb_predictor is not None: # one-shot guess
+            bpp = max_bytes * (1 - tol / 2) * 8 / (im.shape[2] * im.shape[3])
+            log_lmb = math.log(self.predict_lmb(im, bpp).item())
+            string = self.compress(im, lmb=math.exp(log_lmb))
+            results.append((string, math.exp(log_lmb)))
+            done = _done(string, log_lmb)
+            if not done:
+                log_est = _estimate(coarse + [log_lmb])[-1]
+                offset = math.log(len(string)) - log_est
+        if not done:
+            _estimate(coarse)
+        while (not done) and (len(results) < max_encodes):
+            # aim at the middle of the tolerance interval
+            target = math.log(max_bytes * (1 - tol / 2)) - offset
+            log_lmb = _solve(target)
+            for i in range(4): # secant steps on the estimated rate
+                log_est, = _estimate([log_lmb])
+                new_log_lmb = _solve(target)
+                if (abs(log_est - target) < tol / 4) or (abs(new_log_lmb - log_lmb) < 1e-4) or (i == 3):
+                    break
+                log_lmb = new_log_lmb
+            string = self.compress(im, lmb=math.exp(log_lmb))
+            results.append((string, math.exp(log_lmb)))
+            offset = math.log(len(string)) - log_est
+            done = _done(string, log_lmb)
+        fits = [r for r in results if len(r[0]) <= max_bytes]
+        string, lmb = max(fits, key=lambda r: len(r[0])) if fits else min(results, key=lambda r: len(r[0]))
+        if return_info:
+            info = dict(lmb=lmb, num_estimates=num_estimates, num_encodes=len(results))
+            return string, info
+        return string
+
     @torch.no_grad()
     def compress(self, im, lmb=None):
-        lmb = lmb or self.default_lmb # if no lmb is provided, use the default one
-        fdict = self.forward_end2end(im, lmb=lmb, mode='compress')
+        assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
+        lmb = self.default_lmb if (lmb is None) else lmb # if no lmb is provided, use the default one
+        return self.compress_batch(im, lmbs=lmb)[0]
+
+    @torch.no_grad()
+    def decompress(self, string, scale=1):
+        return self.decompress_batch([string], scale=scale)
+
+    def _thumbnail_denominator(self, scale):
+        """ 1/scale, checked against the thumbnail heads of the model """
+        d = round(1 / scale)
+        assert abs(d * scale - 1) < 1e-6, f'{scale=} should be 1/d for an integer d'
+        assert (d == 1) or (d in self.thumbnail_points), \
+            f'{scale=} is not supported. Thumbnail scales: {[f"1/{k}" for k in self.thumbnail_points]}'
+        return d
+
+    def _encode_batch(self, ims, lmbs, coding_pool=None):
+        """ Encode a batch of images. Returns the lambdas and, for each image, the list of \
+            latent strings, where the sub-streams of a latent block are stored consecutively.
+        """
+        nB = ims.shape[0]
+        lmbs = self._lmbs_to_tensor(lmbs, n=nB)
+        fdict = self.forward_end2end(ims, lmb=lmbs, mode='compress', coding_pool=coding_pool)
         assert len(fdict['bit_strings']) == self.num_latents
+        # wait for the background entropy coding, if any
+        fdict['bit_strings'] = [s.result() if isinstance(s, Future) else s for s in fdict['bit_strings']]
+        all_lv_strings = []
+        for i in range(nB):
+            lv_strings = []
+            for strs_batch in fdict['bit_strings']:
+                s = strs_batch[i]
+                lv_strings.extend(s if isinstance(s, list) else [s])
+            all_lv_strings.append(lv_strings)
+        return lmbs.tolist(), all_lv_strings
+
+    @torch.no_grad()
+    def encode_ladder(self, im, lmbs, num_threads=4):
+        """ Encode an image at several lambdas (e.g., the rungs of a rate ladder for adaptive \
+            delivery). The image is replicated along the batch dimension with one lambda per \
+            row, so the network runs in a single batched forward pass, and the entropy coding \
+            of all latent blocks runs on a thread pool, overlapped with the forward pass.
+
+        Args:
+            im   (torch.Tensor): an image, (1, 3, H, W), values between (0, 1)
+            lmbs (list[float]): the lambdas of the rungs
+            num_threads (int): number of entropy coding threads
+
+        Returns:
+            list[bytes]: one bit string per lambda, each of which can be decoded by `self.decompress()`
+        """
         assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
-        all_lv_strings = [strings[0] for strings in fdict['bit_strings']]
-        string = coding.pack_byte_strings(all_lv_strings)
-        # encode lambda and image shape in the header
-        nB, _, imH, imW = im.shape
-        header1 = struct.pack('f', lmb)
-        header2 = struct.pack('3H', nB, imH//self.max_stride, imW//self.max_stride)
-        string = header1 + header2 + string
-        return string
+        ims = im.expand(len(lmbs), -1, -1, -1)
+        pool = entropy_coding.get_thread_pool(num_threads, name='ladder')
+        return self.compress_batch(ims, lmbs=list(lmbs), coding_pool=pool)
+
+    @torch.no_grad()
+    def compress_batch(self, ims, lmbs=None, img_hws=None, coding_pool=None):
+        """ Compress a batch of same-size images in one forward pass. Each image can have \
+            its own lambda, and each image is encoded into an independent bit string.
+
+        Args:
+            ims  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            lmbs (torch.Tensor, list, or float): lambda for each image, shape (N,). \
+                A single value is shared by all images. Defaults to `self.default_lmb`.
+            img_hws (list[tuple], optional): original (height, width) of each image before \
+                padding, which is stored in the bit string. Defaults to (H, W).
+            coding_pool (concurrent.futures.Executor, optional): where the entropy coding of \
+                the latent blocks runs. Defaults to the calling thread (or the pipeline \
+                worker if `self.pipelined_coding`).
+
+        Returns:
+            list[bytes]: N bit strings (see `lvae.utils.container`), each of which can be \
+                decoded by `self.decompress()`
+        """
+        nB, _, imH, imW = ims.shape
+        img_hws = [(imH, imW)] * nB if (img_hws is None) else img_hws
+        grid_hw = (imH // self.max_stride, imW // self.max_stride)
+        lmbs, all_lv_strings = self._encode_batch(ims, lmbs, coding_pool=coding_pool)
+        strings = [
+            container.pack(lv_strings, img_hw=img_hw, grid_hw=grid_hw, lmb=lmb,
+                           mask_id=self.channel_mask_id(), coder=self._coder_info(),
+                           prior_frac_bits=self.prior_frac_bits)
+            for lmb, lv_strings, img_hw in zip(lmbs, all_lv_strings, img_hws)
+        ]
+        return strings
+
+    def _parse_string(self, string):
+        """ Parse a bit string, see `bit_strings.parse_string()`. The latent strings are \
+            zero-copy views of `string`.
+        """
+        info = bit_strings.parse_string(string, self.max_stride)
+        self._check_mask_id(info['mask_id'])
+        self._check_prior_frac_bits(info['prior_frac_bits'])
+        return info
 
     @torch.no_grad()
-    def decompress(self, string):
-        # extract lambda
-        _len = 4
-        lmb, string = struct.unpack('f', string[:_len])[0], string[_len:]
-        # extract shape
-        _len = 2 * 3
-        (nB, nH, nW), string = struct.unpack('3H', string[:_len]), string[_len:]
-        all_lv_strings = coding.unpack_byte_string(string)
+    def decompress_batch(self, strings, scale=1):
+        """ Decompress a list of bit strings in one forward pass. All bit strings should \
+            come from images of the same (padded) size.
 
+        Args:
+            strings (list[bytes]): bit strings given by `self.compress()` or `self.compress_batch()`
+            scale (float): 1 for full resolution. A thumbnail scale (e.g., 1/4) decodes the \
+                images at that scale by a thumbnail head, and stops the top-down path there.
+
+        Returns:
+            torch.Tensor: reconstructed images, (N, 3, H*scale, W*scale), values between (0, 1)
+        """
+        infos = [self._parse_string(string) for string in strings]
+        shapes = set([info['grid_hw'] for info in infos])
+        assert len(shapes) == 1, f'All images should have the same size, got {shapes=}'
+        coders = set([info['coder'] for info in infos])
+        assert len(coders) == 1, f'All bit strings should use the same entropy coder, got {coders=}'
+        nB, (nH, nW) = len(strings), shapes.pop()
+        all_lv_strings = [info['strings'] for info in infos]
+        # number of sub-streams per latent block
+        num_strs = set([len(lv_strings) for lv_strings in all_lv_strings])
+        assert len(num_strs) == 1, f'All bit strings should have the same number of sub-streams'
+        num_substreams = num_strs.pop() // self.num_latents
+        assert num_substreams * self.num_latents == len(all_lv_strings[0]), f'{len(all_lv_strings[0])=}'
+
+        block_strings = []
+        for str_i in range(self.num_latents):
+            if num_substreams > 1:
+                _slice = slice(str_i*num_substreams, (str_i+1)*num_substreams)
+                block_strings.append([lv_strings[_slice] for lv_strings in all_lv_strings])
+            else:
+                block_strings.append([lv_strings[str_i] for lv_strings in all_lv_strings])
+        lmbs = [info['lmb'] for info in infos]
+        coder = self._get_decoder(coders.pop())
+        return self._decompress_blocks(lmbs, (nB, nH, nW), block_strings, coder=coder, scale=scale)
+
+    def _decompress_blocks(self, lmbs, bhw, block_strings, t=0.0, coder=None, scale=1):
+        """ Run the top-down path and decode the latent blocks from bit strings.
+
+        Args:
+            lmbs (list[float]): lambda for each image
+            bhw  (tuple): (batch, height, width) for the initial top-down feature
+            block_strings (list): for each latent block, a list of bit strings (one per image). \
+                None means the latent block is not available, in which case its latent \
+                variable is sampled from the prior with temperature `t`.
+            t (float): temprature for the missing latent blocks
+            coder (InterleavedRansCoder, optional): the entropy coder backend
+            scale (float): 1 for full resolution, or a thumbnail scale (e.g., 1/4)
+        """
+        assert len(block_strings) == self.num_latents, f'{len(block_strings)=}'
+        d = self._thumbnail_denominator(scale)
+        stop_at = self.thumbnail_points.get(d, None) # index of the last block to be executed
+        nB, nH, nW = bhw
         fdict = dict() # a feature dictionary containing all features
-        lmb = self.expand_to_tensor(lmb, n=nB)
+        lmb = torch.tensor(lmbs, dtype=torch.float, device=self._dummy.device)
         fdict['lmb_emb'] = self._get_lmb_embedding(lmb, n=nB)
         fdict['dec_features'] = [] # top-down decoder features
         fdict['zs'] = [] # latent variables
         fdict['kl_divs'] = [] # kl (i.e., rate) for each latent variable
         fdict['bit_strings'] = [] # compressed bit strings; only used in 'compress' mode
+        fdict['entropy_coder'] = coder
         feature = self.get_bias(bhw_repeat=(nB, nH, nW))
         fdict['feature'] = feature # main feature; will be updated in the following loop
 
         str_i = 0
         for bi, block in enumerate(self.dec_blocks):
             if getattr(block, 'is_latent_block', False):
-                strs_batch = [all_lv_strings[str_i],]
-                fdict = block(fdict, mode='decompress', strings=strs_batch)
+                strs_batch = block_strings[str_i]
+                if strs_batch is None:
+                    fdict = block(fdict, mode='sampling', latent=None, t=t)
+                else:
+                    fdict = block(fdict, mode='decompress', strings=strs_batch)
                 str_i += 1
             elif getattr(block, 'requires_embedding', False):
                 fdict['feature'] = block(fdict['feature'], fdict['lmb_emb'])
             else:
                 fdict['feature'] = block(fdict['feature'])
-        assert str_i == len(all_lv_strings), f'str_i={str_i}, len={len(all_lv_strings)}'
+            if bi == stop_at: # thumbnail. the remaining latent blocks are not decoded
+                x_hat = self.thumbnail_heads[str(d)](fdict['feature'])
+                return self.process_output(x_hat)
+        assert str_i == self.num_latents, f'{str_i=}, {self.num_latents=}'
         im_hat = self.process_output(fdict['feature'])
         return im_hat
 
+    @torch.no_grad()
+    def compress_scalable(self, im, lmb=None):
+        """ Compress an image into a scalable bit string, which consists of one layer per \
+            latent block in coarse-to-fine order. The bit string can be truncated after any \
+            layer (see `truncate_scalable()`) and still be decoded by `decompress_scalable()`.
+
+        Args:
+            im  (torch.Tensor): an image, (1, 3, H, W), values between (0, 1)
+            lmb (float, optional): lambda. Defaults to `self.default_lmb`.
+
+        Returns:
+            bytes: the scalable bit string, a container with one layer per latent block
+        """
+        assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
+        lmb = self.default_lmb if (lmb is None) else lmb
+        _, _, imH, imW = im.shape
+        lmbs, all_lv_strings = self._encode_batch(im, lmb)
+        num_substreams = len(all_lv_strings[0]) // self.num_latents
+        grid_hw = (imH // self.max_stride, imW // self.max_stride)
+        return container.pack(all_lv_strings[0], img_hw=(imH, imW), grid_hw=grid_hw, lmb=lmbs[0],
+                              layers=num_substreams, mask_id=self.channel_mask_id(),
+                              coder=self._coder_info(), prior_frac_bits=self.prior_frac_bits)
+
+    @staticmethod
+    def truncate_scalable(string, num_layers):
+        """ Keep only the first `num_layers` layers of a scalable bit string. Only the layer \
+            lengths are parsed, so this is cheap enough to run on a server for every request.
+
+        Args:
+            string (bytes): bit string given by `compress_scalable()`
+            num_layers (int): number of layers to keep
+
+        Returns:
+            bytes: the truncated bit string
+        """
+        return container.truncate(string, num_layers)
+
+    @torch.no_grad()
+    def decompress_scalable(self, string, t=0.0):
+        """ Decompress a (possibly truncated) scalable bit string. The missing layers are \
+            filled with the prior mean (when `t=0`), i.e., without sampling noise.
+
+        Args:
+            string (bytes): bit string given by `compress_scalable()` or `truncate_scalable()`
+            t (float): temprature for the missing latent blocks
+
+        Returns:
+            torch.Tensor: reconstructed image, (1, 3, H, W), values between (0, 1)
+        """
+        info = self._parse_string(string)
+        num_substreams = info['layers']
+        assert num_substreams is not None, 'Not a scalable bit string'
+        lv_strings = info['strings']
+        block_strings = []
+        for str_i in range(self.num_latents):
+            layer = lv_strings[str_i*num_substreams : (str_i+1)*num_substreams]
+            if len(layer) < num_substreams: # missing layer
+                block_strings.append(None)
+            else:
+                block_strings.append([layer] if (num_substreams > 1) else layer)
+        return self._decompress_blocks([info['lmb']], (1, *info['grid_hw']), block_strings, t=t,
+                                       coder=self._get_decoder(info['coder']))
+
+    def decompress_progressive(self, string, t=0.0):
+        """ Decode a (possibly truncated) scalable bit string layer by layer, and yield a \
+            preview after each layer. See `ProgressiveDecoder` for finer control.
+
+        Yields:
+            torch.Tensor: preview image, (1, 3, H, W), values between (0, 1)
+        """
+        info = self._parse_string(string)
+        num_substreams = info['layers']
+        assert num_substreams is not None, 'Not a scalable bit string'
+        decoder = ProgressiveDecoder(self, info['lmb'], (1, *info['grid_hw']),
+                                     coder=self._get_decoder(info['coder']))
+        lv_strings = info['strings']
+        for str_i in range(len(lv_strings) // num_substreams):
+            layer = lv_strings[str_i*num_substreams : (str_i+1)*num_substreams]
+            decoder.decode_next(layer if (num_substreams > 1) else layer[0])
+            yield decoder.preview(t=t)
+
     @torch.no_grad()
     def compress_file(self, img_path, output_path, lmb=None):
         # read image
@@ -531,19 +1157,96 @@ class VariableRateLossyVAE(nn.Module):
         img_padded = coding.pad_divisible_by(img, div=self.max_stride)
         im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=self._dummy.device)
         # compress by model
-        body_str = self.compress(im, lmb=lmb)
-        header_str = struct.pack('2H', img.height, img.width)
+        lmb = self.default_lmb if (lmb is None) else lmb
+        string = self.compress_batch(im, lmbs=lmb, img_hws=[(img.height, img.width)])[0]
         # save bits to file
         with open(output_path, 'wb') as f:
-            f.write(header_str + body_str)
+            f.write(string)
 
     @torch.no_grad()
-    def decompress_file(self, bits_path):
-        # read from file
-        with open(bits_path, 'rb') as f:
-            header_str = f.read(4)
-            body_str = f.read()
-        img_h, img_w = struct.unpack('2H', header_str)
-        # decompress by model
-        im_hat = self.decompress(body_str)
-        return im_hat[:, :, :img_h, :img_w]
+    def decompress_file(self, bits_path, scale=1):
+        im_hat, (img_h, img_w) = bit_strings.decompress_file(self, bits_path, scale=scale)
+        d = self._thumbnail_denominator(scale)
+        return im_hat[:, :, :math.ceil(img_h / d), :math.ceil(img_w / d)]
+
+
+class ProgressiveDecoder():
+    """ Decode the layers of a scalable bit string (see `compress_scalable()`) one at a time. \
+        The top-down state is kept between layers, so decoding a new layer only runs the \
+        blocks between the previous latent block and the new one.
+
+    Example:
+        decoder = ProgressiveDecoder(model, lmb, bhw)
+        for layer in layers: # the latent strings (or sub-streams) of a latent block
+            decoder.decode_next(layer)
+            im_preview = decoder.preview() # optional
+    """
+    def __init__(self, model: VariableRateLossyVAE, lmb, bhw, coder=None):
+        """
+        Args:
+            model (VariableRateLossyVAE): the model, in compression mode
+            lmb (float): lambda
+            bhw (tuple): (batch, height, width) for the initial top-down feature
+            coder (InterleavedRansCoder, optional): the entropy coder backend
+        """
+        self.model = model
+        fdict = dict() # a feature dictionary containing all features
+        lmb = torch.tensor([lmb], dtype=torch.float, device=model._dummy.device)
+        fdict['lmb_emb'] = model._get_lmb_embedding(lmb, n=bhw[0])
+        fdict['dec_features'] = [] # top-down decoder features
+        fdict['zs'] = [] # latent variables
+        fdict['kl_divs'] = [] # kl (i.e., rate) for each latent variable
+        fdict['bit_strings'] = [] # compressed bit strings; only used in 'compress' mode
+        fdict['entropy_coder'] = coder
+        fdict['feature'] = model.get_bias(bhw_repeat=bhw)
+        self.fdict = fdict
+        self.block_idx = 0 # index of the next block in `model.dec_blocks` to be executed
+        self.num_decoded = 0 # number of decoded latent blocks
+
+    @property
+    def done(self):
+        return self.num_decoded == self.model.num_latents
+
+    @staticmethod
+    def _run_block(block, fdict, **kwargs):
+        if getattr(block, 'is_latent_block', False):
+            fdict = block(fdict, **kwargs)
+        elif getattr(block, 'requires_embedding', False):
+            fdict['feature'] = block(fdict['feature'], fdict['lmb_emb'])
+        else:
+            fdict['feature'] = block(fdict['feature'])
+        return fdict
+
+    @torch.inference_mode()
+    def decode_next(self, layer):
+        """ Decode the next latent block.
+
+        Args:
+            layer (bytes or list[bytes]): the latent string, or the list of sub-stream strings
+        """
+        assert not self.done, 'All latent blocks have been decoded'
+        dec_blocks = self.model.dec_blocks
+        # run the non-latent blocks before the next latent block
+        while not getattr(dec_blocks[self.block_idx], 'is_latent_block', False):
+            self.fdict = self._run_block(dec_blocks[self.block_idx], self.fdict)
+            self.block_idx += 1
+        self.fdict = self._run_block(dec_blocks[self.block_idx], self.fdict,
+                                     mode='decompress', strings=[layer])
+        self.block_idx += 1
+        self.num_decoded += 1
+
+    @torch.inference_mode()
+    def preview(self, t=0.0):
+        """ Synthesize a full-resolution image from the latent blocks decoded so far. The \
+            remaining latent blocks are filled with the prior mean (when `t=0`). The decoder \
+            state is not modified.
+
+        Returns:
+            torch.Tensor: image, (1, 3, H, W), values between (0, 1)
+        """
+        fdict = dict(self.fdict)
+        for key in ['dec_features', 'zs', 'kl_divs', 'bit_strings']:
+            fdict[key] = list(fdict[key])
+        for block in self.model.dec_blocks[self.block_idx:]:
+            fdict = self._run_block(block, fdict, mode='sampling', latent=None, t=t)
+        return self.model.process_output(fdict['feature'])
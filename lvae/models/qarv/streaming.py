@@ -0,0 +1,118 @@
+'''
+Streaming decoding of qarv bit strings over slow links.
+
+The container written by `VariableRateLossyVAE.compress_file()` stores the lengths of all
+latent strings before any payload (or, for scalable bit strings, right before each string),
+and the payload is in coarse-to-fine order. So the decoder can start as soon as the header
+has arrived, and decode each latent block as soon as its bytes are complete, while the
+remaining bytes are still being received.
+'''
+import asyncio
+
+import lvae.utils.container as container
+from lvae.models.qarv.model import VariableRateLossyVAE, ProgressiveDecoder
+
+
+class _AsyncByteReader():
+    """ A minimal `readexactly()` on top of an async iterator of byte chunks
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = bytearray()
+
+    async def readexactly(self, n):
+        while len(self._buffer) < n:
+            try:
+                self._buffer.extend(await self._chunks.__anext__())
+            except StopAsyncIteration:
+                partial = bytes(self._buffer)
+                self._buffer.clear()
+                raise asyncio.IncompleteReadError(partial, n)
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+
+async def _parse(reader, parser):
+    """ Run an incremental parser of `lvae.utils.container` on an async reader """
+    try:
+        n = next(parser)
+        while True:
+            n = parser.send(await reader.readexactly(n))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def _read_strings(reader, queue: asyncio.Queue):
+    """ Read the container header and the latent strings, and put them into `queue` as they \
+    complete. The end of the stream is marked by None.
+    """
+    try:
+        info = await _parse(reader, container.header_parser())
+        assert info['lmb'] is not None, 'The container should contain lambda'
+        assert info['tiles'] is None, 'Tiled containers are not supported'
+        num, layers = info['num_strings'], info['layers']
+        await queue.put((info['img_hw'], info['lmb'], (1, *info['grid_hw']), num, info['mask_id'],
+                         info['coder'], info['prior_frac_bits']))
+        if layers is None: # all lengths first, then all strings
+            lengths = [await _parse(reader, container.varint_parser()) for _ in range(num)]
+        for i in range(num):
+            length = lengths[i] if (layers is None) else (await _parse(reader, container.varint_parser()))
+            await queue.put(await reader.readexactly(length))
+    except asyncio.IncompleteReadError:
+        pass # truncated stream. decode what has been received
+    finally:
+        await queue.put(None)
+
+
+async def decompress_stream(model: VariableRateLossyVAE, stream, preview=True, t=0.0, executor=None):
+    """ Decode a file produced by `model.compress_file()` while it is being received.
+
+    Args:
+        model (VariableRateLossyVAE): the model, in compression mode
+        stream (asyncio.StreamReader or async iterator of bytes): the incoming file
+        preview (bool): whether to synthesize previews. A preview is synthesized after a \
+            latent block is decoded, unless the next one has already been received. \
+            If False, only the final image is yielded.
+        t (float): temprature for the latent blocks that have not been received
+        executor (concurrent.futures.Executor, optional): where the decoding runs. \
+            Defaults to the event loop's default executor.
+
+    Yields:
+        tuple: (number of decoded latent blocks, image of shape (1, 3, H, W))
+    """
+    loop = asyncio.get_running_loop()
+    reader = stream if hasattr(stream, 'readexactly') else _AsyncByteReader(stream)
+    # receive in the background, so that the network is not idle while decoding
+    queue = asyncio.Queue()
+    receiving = asyncio.ensure_future(_read_strings(reader, queue))
+    try:
+        header = await queue.get()
+        if header is None:
+            raise ValueError('The stream ended before the header is complete')
+        (img_h, img_w), lmb, bhw, num, mask_id, coder, prior_frac_bits = header
+        model._check_mask_id(mask_id)
+        model._check_prior_frac_bits(prior_frac_bits)
+        num_substreams = num // model.num_latents
+        assert num_substreams * model.num_latents == num, f'{num=}, {model.num_latents=}'
+        decoder = ProgressiveDecoder(model, lmb, bhw, coder=model._get_decoder(coder))
+
+        layer, im_hat, last_preview = [], None, 0
+        while (string := await queue.get()) is not None:
+            layer.append(string)
+            if len(layer) < num_substreams:
+                continue
+            layer = layer[0] if (num_substreams == 1) else layer
+            await loop.run_in_executor(executor, decoder.decode_next, layer)
+            layer = []
+            # skip the preview if the next layer has already arrived
+            next_layer_ready = (queue.qsize() >= num_substreams)
+            if (preview and not next_layer_ready) or decoder.done:
+                im_hat = await loop.run_in_executor(executor, decoder.preview, t)
+                last_preview = decoder.num_decoded
+                yield decoder.num_decoded, im_hat[:, :, :img_h, :img_w]
+        if (not decoder.done) and (im_hat is None or decoder.num_decoded > last_preview): # truncated stream
+            im_hat = await loop.run_in_executor(executor, decoder.preview, t)
+            yield decoder.num_decoded, im_hat[:, :, :img_h, :img_w]
+    finally:
+        receiving.cancel()
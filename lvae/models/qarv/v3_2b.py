@@ -12,6 +12,8 @@ import torchvision.transforms.functional as tvf
 from lvae.models.registry import register_model
 import lvae.models.common as cm
 import lvae.utils.coding as coding
+import lvae.utils.container as container
+import lvae.models.qarv.bit_strings as bit_strings
 import lvae.models.entropy_coding as entropy_coding
 
 
@@ -49,10 +51,10 @@ class PriorBlock(LatentVariableBlock):
 
         pm, pv = self.get_prior(feature)
 
-        if mode == 'trainval': # training or validation
+        if mode in ('trainval', 'estimate'): # training, validation, or rate estimation
             assert qm is not None # posterior mean
             # qm = fdict['all_features'][f'{self.name}_qm']
-            if self.training: # if training, then use additive uniform noise
+            if self.training and (mode == 'trainval'): # if training, then use additive uniform noise
                 z = qm + torch.empty_like(qm).uniform_(-0.5, 0.5)
                 log_prob = entropy_coding.gaussian_log_prob_mass(pm, pv, x=z, bin_size=1.0, prob_clamp=1e-6)
                 kl = -1.0 * log_prob
@@ -260,7 +262,7 @@ class VariableRateLossyVAE(nn.Module):
 
         for i, block in enumerate(self.em_blocks):
             if isinstance(block, LatentVariableBlock):
-                qm = self.posteriors[block.name](fdict) if mode in ['trainval', 'compress'] else None
+                qm = self.posteriors[block.name](fdict) if mode in ['trainval', 'compress', 'estimate'] else None
                 fdict = block(fdict, qm=qm)
             elif getattr(block, 'requires_embedding', False):
                 fdict['em_feature'] = block(fdict['em_feature'], fdict['lmb_emb'])
@@ -325,36 +327,111 @@ class VariableRateLossyVAE(nn.Module):
                 block.update()
 
     @torch.inference_mode()
-    def compress(self, im):
+    def compress(self, im, lmb=None):
         assert im.shape[0] == 1, f'Right now only support a single image; got {im.shape=}'
+        lmb = self.default_lmb if (lmb is None) else lmb # if no lmb is provided, use the default one
+        return self.compress_batch(im, lmbs=lmb)[0]
 
-        lmb = torch.full((1,), self.default_lmb, device=self._dummy.device) # use the default lambda
-        fdict, _ = self.forward_bottomup(im, lmb)
+    @torch.inference_mode()
+    def decompress(self, string):
+        return self.decompress_batch([string])
+
+    @torch.inference_mode()
+    def encode_ladder(self, im, lmbs):
+        """ Encode an image at several lambdas (e.g., the rungs of a rate ladder) in one \
+            batched forward pass, with the image replicated along the batch dimension.
+
+        Args:
+            im   (torch.Tensor): an image, (1, 3, H, W), values between (0, 1)
+            lmbs (list[float]): the lambdas of the rungs
+
+        Returns:
+            list[bytes]: one bit string per lambda
+        """
+        assert im.shape[0] == 1, f'Right now only support a single image; got {im.shape=}'
+        return self.compress_batch(im.expand(len(lmbs), -1, -1, -1), lmbs=list(lmbs))
+
+    @torch.inference_mode()
+    def estimate_bits(self, ims, lmbs=None, breakdown=False):
+        """ Estimate the number of bits of each image from the probabilities of the latent \
+            variables, without entropy coding. Only the encoder and the entropy model branch \
+            (`self.em_blocks`) are executed; the decoder branch is skipped.
+
+        Args:
+            ims  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            lmbs (torch.Tensor, list, or float): lambda for each image, shape (N,). \
+                A single value is shared by all images. Defaults to `self.default_lmb`.
+            breakdown (bool): if True, also return bits per latent block and per channel. \
+                See `entropy_coding.nats_to_bits()`.
+
+        Returns:
+            torch.Tensor: estimated bits of each image, shape (N,), excluding the container header
+        """
+        nB = ims.shape[0]
+        lmbs = cm.lmbs_to_tensor(lmbs, nB, default=self.default_lmb, device=self._dummy.device)
+        fdict, _ = self.forward_bottomup(ims.to(self._dummy.device), lmbs)
+        fdict = self.forward_em(fdict, mode='estimate')
+        return entropy_coding.nats_to_bits(fdict['kl_divs'], breakdown=breakdown)
+
+    @torch.inference_mode()
+    def compress_batch(self, ims, lmbs=None, img_hws=None):
+        """ Compress a batch of same-size images in one forward pass. Each image can have \
+            its own lambda, and each image is encoded into an independent bit string.
+
+        Args:
+            ims  (torch.Tensor): a batch of images, (N, 3, H, W), values between (0, 1)
+            lmbs (torch.Tensor, list, or float): lambda for each image, shape (N,). \
+                A single value is shared by all images. Defaults to `self.default_lmb`.
+            img_hws (list[tuple], optional): original (height, width) of each image before \
+                padding, which is stored in the bit string. Defaults to (H, W).
+
+        Returns:
+            list[bytes]: N bit strings (see `lvae.utils.container`), each of which can be \
+                decoded by `self.decompress()`
+        """
+        nB, _, imH, imW = ims.shape
+        lmbs = cm.lmbs_to_tensor(lmbs, nB, default=self.default_lmb, device=self._dummy.device)
+        fdict, _ = self.forward_bottomup(ims, lmbs)
         fdict = self.forward_em(fdict, mode='compress')
 
         assert len(fdict['bit_strings']) == self.num_latents
-        all_lv_strings = [strings[0] for strings in fdict['bit_strings']]
-        string = coding.pack_byte_strings(all_lv_strings)
-        # encode lambda and image shape in the header
-        nB, _, imH, imW = im.shape
-        header1 = struct.pack('f', lmb)
-        header2 = struct.pack('3H', nB, imH//self.max_stride, imW//self.max_stride)
-        string = header1 + header2 + string
-        return string
+        img_hws = [(imH, imW)] * nB if (img_hws is None) else img_hws
+        grid_hw = (imH // self.max_stride, imW // self.max_stride)
+        strings = []
+        for i in range(nB):
+            all_lv_strings = [strs_batch[i] for strs_batch in fdict['bit_strings']]
+            strings.append(container.pack(all_lv_strings, img_hw=img_hws[i], grid_hw=grid_hw,
+                                          lmb=lmbs[i].item()))
+        return strings
+
+    def _parse_string(self, string):
+        """ Parse a bit string, see `bit_strings.parse_string()`. The latent strings are \
+            zero-copy views of `string`.
+        """
+        return bit_strings.parse_string(string, self.max_stride)
 
     @torch.inference_mode()
-    def decompress(self, string):
-        # extract lambda
-        _len = 4
-        lmb, string = struct.unpack('f', string[:_len])[0], string[_len:]
-        # extract shape
-        _len = 2 * 3
-        (nB, nH, nW), string = struct.unpack('3H', string[:_len]), string[_len:]
-        all_lv_strings = coding.unpack_byte_string(string)
-
-        lmb = torch.full((1,), lmb, device=self._dummy.device) # use the default lambda
+    def decompress_batch(self, strings):
+        """ Decompress a list of bit strings in one forward pass. All bit strings should \
+            come from images of the same (padded) size.
+
+        Args:
+            strings (list[bytes]): bit strings given by `self.compress()` or `self.compress_batch()`
+
+        Returns:
+            torch.Tensor: reconstructed images, (N, 3, H, W), values between (0, 1)
+        """
+        infos = [self._parse_string(string) for string in strings]
+        shapes = set([info['grid_hw'] for info in infos])
+        assert len(shapes) == 1, f'All images should have the same size, got {shapes=}'
+        nB, (nH, nW) = len(strings), shapes.pop()
+        lmbs = [info['lmb'] for info in infos]
+        all_lv_strings = [info['strings'] for info in infos]
+
+        lmb = torch.tensor(lmbs, dtype=torch.float, device=self._dummy.device)
         fdict = self.get_initial_fdict(lmb, bias_bhw=(nB, nH, nW))
-        fdict['bit_strings'] = [[s,] for s in all_lv_strings] # add batch dimension to each string
+        # group the strings by latent variables, each group has one string per image
+        fdict['bit_strings'] = [list(strs_batch) for strs_batch in zip(*all_lv_strings)]
         fdict = self.forward_topdown(fdict, mode='decompress')
         assert len(fdict['bit_strings']) == 0
         im_hat = self.postprocess(fdict['x_hat'])
@@ -367,21 +444,14 @@ class VariableRateLossyVAE(nn.Module):
         img_padded = coding.pad_divisible_by(img, div=self.max_stride)
         im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=self._dummy.device)
         # compress by model
-        body_str = self.compress(im)
-        header_str = struct.pack('2H', img.height, img.width)
+        string = self.compress_batch(im, img_hws=[(img.height, img.width)])[0]
         # save bits to file
         with open(output_path, 'wb') as f:
-            f.write(header_str + body_str)
+            f.write(string)
 
     @torch.inference_mode()
     def decompress_file(self, bits_path):
-        # read from file
-        with open(bits_path, 'rb') as f:
-            header_str = f.read(4)
-            body_str = f.read()
-        img_h, img_w = struct.unpack('2H', header_str)
-        # decompress by model
-        im_hat = self.decompress(body_str)
+        im_hat, (img_h, img_w) = bit_strings.decompress_file(self, bits_path)
         return im_hat[:, :, :img_h, :img_w]
 
     @torch.inference_mode()
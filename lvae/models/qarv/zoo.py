@@ -1,13 +1,19 @@
+from pathlib import Path
 import torch
+import torch.nn as nn
 from torch.hub import load_state_dict_from_url
 
 from lvae.models.registry import register_model
+from lvae.models.mlp_pruning import match_mlp_shapes
 import lvae.models.common as common
 import lvae.models.qarv.model as qarv
 
 
 @register_model
-def qarv_base(lmb_range=(16,2048), pretrained=False):
+def qarv_base(lmb_range=(16,2048), pretrained=False, thumbnail_heads=False):
+    """ `thumbnail_heads`: False, True (untrained heads), or the path to the heads trained by \
+        `scripts/qarv/train-thumbnail-heads.py`. See `VariableRateLossyVAE.decompress(scale=...)`.
+    """
     cfg = dict()
 
     # mean and std computed on imagenet
@@ -86,14 +92,150 @@ def qarv_base(lmb_range=(16,2048), pretrained=False):
         *[res_block(dec_dims[4], kernel_size=7, mlp_ratio=1.5) for _ in range(8)],
         common.patch_upsample(dec_dims[4], im_channels, rate=4)
     ]
+    if thumbnail_heads:
+        # side heads after the stride-16 and stride-8 stages, i.e., right before the 3rd and
+        # the 4th upsampling layers, for 1/8 and 1/4 scale thumbnails
+        ups = [i for i, b in enumerate(cfg['dec_blocks'])
+               if isinstance(b, nn.Sequential) and isinstance(b[-1], nn.PixelShuffle)]
+        cfg['thumbnail_heads'] = {
+            8: (ups[2] - 1, qarv.ThumbnailHead(dec_dims[2], rate=2)),
+            4: (ups[3] - 1, qarv.ThumbnailHead(dec_dims[3], rate=2)),
+        }
 
     model = qarv.VariableRateLossyVAE(cfg)
 
     if pretrained is True:
         url = 'https://huggingface.co/duanzh0/my-model-weights/resolve/main/qarv_base-2022-dec-12.pt'
         msd = load_state_dict_from_url(url)['model']
-        model.load_state_dict(msd)
+        _load_without_heads(model, msd)
     elif pretrained: # str or Path
         msd = torch.load(pretrained)['model']
-        model.load_state_dict(msd)
+        _load_without_heads(model, msd)
+    if isinstance(thumbnail_heads, (str, Path)):
+        model.thumbnail_heads.load_state_dict(torch.load(thumbnail_heads)['thumbnail_heads'])
+    return model
+
+
+
+def _load_without_heads(model, msd):
+    """ Load the weights of a model, which may or may not contain the thumbnail heads, and \
+        may have pruned or factorized MLPs (see `lvae/models/mlp_pruning.py`)
+    """
+    match_mlp_shapes(model, msd)
+    missing, unexpected = model.load_state_dict(msd, strict=False)
+    assert all([k.startswith('thumbnail_heads.') for k in missing]), f'{missing=}'
+    assert len(unexpected) == 0, f'{unexpected=}'
+
+
+
+@register_model
+def qarv_base_fastdec(lmb_range=(16,2048), pretrained=False, tail=None, width=64, depth=4):
+    """ `qarv_base` with a thinner synthesis tail (the blocks after `CompresionStopFlag`) for \
+        faster decoding. The blocks up to the stop flag are those of `qarv_base`, so it decodes \
+        the bit strings of `qarv_base` without re-encoding.
+
+    `pretrained`: as in `qarv_base`, for the blocks up to the stop flag. `tail`: None (untrained \
+    tail) or the path to the tail distilled by `scripts/qarv/train-fastdec.py`.
+    """
+    model = qarv_base(lmb_range=lmb_range, pretrained=pretrained)
+
+    res_block = common.ConvNeXtBlockAdaLN
+    stop = [i for i, b in enumerate(model.dec_blocks) if isinstance(b, common.CompresionStopFlag)][0]
+    in_ch = model.dec_blocks[stop - 1].out_channels
+    fast_tail = [
+        # 8x8, directly upsampled
+        common.patch_upsample(in_ch, width, rate=2),
+        # 16x16
+        *[res_block(width, kernel_size=5, mlp_ratio=1.5) for _ in range(depth)],
+        common.patch_upsample(width, 3, rate=4)
+    ]
+    model.dec_blocks = nn.ModuleList(list(model.dec_blocks[:stop+1]) + fast_tail)
+
+    if tail is not None:
+        model.synthesis_tail.load_state_dict(torch.load(tail)['tail'])
+    return model
+
+
+@register_model
+def qarv_small(lmb_range=(16,2048), pretrained=False):
+    """ A smaller and faster version of `qarv_base` for CPU decoding, trained by distillation \
+        from `qarv_base` (see `scripts/qarv/train-distill.py`). The latent blocks have the \
+        same resolutions and dimensions as `qarv_base`, while the network is narrower and shallower.
+
+    `pretrained`: False, or the path to a local checkpoint. There are no released weights.
+    """
+    cfg = dict()
+
+    # mean and std computed on imagenet
+    cfg['im_shift'] = -0.4546259594901961
+    cfg['im_scale'] = 3.67572653978347
+    # maximum downsampling factor
+    cfg['max_stride'] = 64
+    # images used during training for logging
+    cfg['log_images'] = ['collie64.png', 'gun128.png', 'motor256.png']
+
+    # variable-rate
+    cfg['lmb_range'] = (float(lmb_range[0]), float(lmb_range[1]))
+    cfg['lmb_embed_dim'] = (256, 256)
+    cfg['sin_period'] = 64
+
+    # model configuration
+    ch = 64
+    enc_dims = [ch*2, ch*3, ch*4, ch*4, ch*4]
+
+    res_block = common.ConvNeXtBlockAdaLN
+    res_block.default_embedding_dim = cfg['lmb_embed_dim'][1]
+
+    im_channels = 3
+    cfg['enc_blocks'] = [
+        # 64x64
+        common.patch_downsample(im_channels, enc_dims[0], rate=4),
+        # 16x16
+        *[res_block(enc_dims[0], kernel_size=7) for _ in range(2)],
+        common.patch_downsample(enc_dims[0], enc_dims[1]),
+        # 8x8
+        *[res_block(enc_dims[1], kernel_size=7) for _ in range(2)],
+        common.SetKey('enc_s8'),
+        common.patch_downsample(enc_dims[1], enc_dims[2]),
+        # 4x4
+        *[res_block(enc_dims[2], kernel_size=5) for _ in range(2)],
+        common.SetKey('enc_s16'),
+        common.patch_downsample(enc_dims[2], enc_dims[3]),
+        # 2x2
+        *[res_block(enc_dims[3], kernel_size=3) for _ in range(2)],
+        common.SetKey('enc_s32'),
+        common.patch_downsample(enc_dims[3], enc_dims[4]),
+        # 1x1
+        *[res_block(enc_dims[4], kernel_size=1) for _ in range(2)],
+        common.SetKey('enc_s64'),
+    ]
+
+    dec_dims = [ch*4, ch*4, ch*3, ch*2, ch*1]
+    z_dims = [32, 32, 96, 8]
+    cfg['dec_blocks'] = [
+        # 1x1
+        *[qarv.VRLVBlockBase(dec_dims[0], z_dims[0], enc_key='enc_s64', enc_width=enc_dims[-1], kernel_size=1, mlp_ratio=2) for _ in range(1)],
+        common.patch_upsample(dec_dims[0], dec_dims[1], rate=2),
+        # 2x2
+        *[qarv.VRLVBlockBase(dec_dims[1], z_dims[1], enc_key='enc_s32', enc_width=enc_dims[-2], kernel_size=3, mlp_ratio=2) for _ in range(2)],
+        common.patch_upsample(dec_dims[1], dec_dims[2], rate=2),
+        # 4x4
+        *[qarv.VRLVBlockBase(dec_dims[2], z_dims[2], enc_key='enc_s16', enc_width=enc_dims[-3], kernel_size=5, mlp_ratio=1.5) for _ in range(3)],
+        common.patch_upsample(dec_dims[2], dec_dims[3], rate=2),
+        # 8x8
+        *[qarv.VRLVBlockBase(dec_dims[3], z_dims[3], enc_key='enc_s8', enc_width=enc_dims[-4], kernel_size=7, mlp_ratio=1.5) for _ in range(3)],
+        common.CompresionStopFlag(), # no need to execute remaining blocks when compressing
+        common.patch_upsample(dec_dims[3], dec_dims[4], rate=2),
+        # 16x16
+        *[res_block(dec_dims[4], kernel_size=5, mlp_ratio=1.5) for _ in range(4)],
+        common.patch_upsample(dec_dims[4], im_channels, rate=4)
+    ]
+
+    model = qarv.VariableRateLossyVAE(cfg)
+
+    if pretrained: # no released weights; a checkpoint given by, e.g., scripts/qarv/train-distill.py
+        assert isinstance(pretrained, (str, Path)), \
+            f'qarv_small only accepts the path to a local checkpoint as pretrained, got {pretrained=}'
+        msd = torch.load(pretrained)['model']
+        _load_without_heads(model, msd)
     return model
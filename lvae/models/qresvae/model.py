@@ -1,5 +1,5 @@
 import pickle
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from PIL import Image
 import math
 import torch
@@ -10,9 +10,23 @@ import torchvision.transforms.functional as tvf
 from compressai.entropy_models import GaussianConditional
 
 import lvae.models.common as common
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+import lvae.models.entropy_coding as entropy_coding
 from lvae.models.entropy_coding import gaussian_log_prob_mass
 
 
+def _coding_prior(entropy_model, pm, plogv, frac_bits=None):
+    """ The prior means and the CDF indexes used for entropy coding. If `frac_bits` is not \
+        None, the means and log-scales are snapped to a fixed-point grid (see \
+        `HierarchicalVAE.set_fixed_point_prior()`).
+    """
+    if frac_bits is None:
+        return pm, entropy_coding.build_indexes(entropy_model, torch.exp(plogv))
+    pm = entropy_coding.quantize_means(pm, frac_bits)
+    return pm, entropy_coding.build_indexes_fixed_point(entropy_model, plogv, frac_bits)
+
+
 class GaussianNLLOutputNet(nn.Module):
     def __init__(self, conv_mean, conv_scale, bin_size=1/127.5):
         super().__init__()
@@ -20,6 +34,8 @@ class GaussianNLLOutputNet(nn.Module):
         self.conv_scale = conv_scale
         self.bin_size = bin_size
         self.loss_name = 'nll'
+        self.prior_frac_bits = None # see `HierarchicalVAE.set_fixed_point_prior()`
+        self.max_scale = 20 # the largest scale in the scale table of entropy coding
 
     def forward_loss(self, feature, x_tgt):
         """ compute negative log-likelihood loss
@@ -57,14 +73,13 @@ class GaussianNLLOutputNet(nn.Module):
         return samples
 
     def update(self):
-        self.discrete_gaussian = GaussianConditional(None, scale_bound=0.11)
+        if not hasattr(self, 'discrete_gaussian'): # only construct it once
+            self.discrete_gaussian = GaussianConditional(None, scale_bound=0.11)
         device = next(self.parameters()).device
         self.discrete_gaussian = self.discrete_gaussian.to(device=device)
         lower = self.discrete_gaussian.lower_bound_scale.bound.item()
-        max_scale = 20
-        scale_table = torch.exp(torch.linspace(math.log(lower), math.log(max_scale), steps=128))
-        updated = self.discrete_gaussian.update_scale_table(scale_table)
-        self.discrete_gaussian.update()
+        scale_table = torch.exp(torch.linspace(math.log(lower), math.log(self.max_scale), steps=128))
+        entropy_coding.update_shared(self.discrete_gaussian, scale_table)
 
     def _preapre_codec(self, feature, x=None):
         assert not feature.requires_grad
@@ -78,18 +93,33 @@ class GaussianNLLOutputNet(nn.Module):
             x = x / self.bin_size
         return pm, plogv, x
 
+    def coding_nll(self, feature, x_tgt):
+        """ Negative log-likelihood (in nats) of each pixel when coded by `self.compress()`, \
+            i.e., from the same prior, quantized CDF tables, and escape coding as the coder \
+            (see `entropy_coding.coding_bits()`). Requires `self.update()`.
+
+        Args:
+            feature (torch.Tensor): feature given by the top-down decoder
+            x_tgt (torch.Tensor): original image, preprocessed by `preprocess_target()`
+        """
+        assert hasattr(self, 'discrete_gaussian'), 'Call `compress_mode()` of the model first.'
+        pm, plogv, x = self._preapre_codec(feature, x_tgt)
+        pm, indexes = _coding_prior(self.discrete_gaussian, pm, plogv, self.prior_frac_bits)
+        bits = entropy_coding.coding_bits(self.discrete_gaussian, x, indexes, means=pm)
+        return bits * math.log(2)
+
     def compress(self, feature, x):
         pm, plogv, x = self._preapre_codec(feature, x)
         # compress
-        indexes = self.discrete_gaussian.build_indexes(torch.exp(plogv))
-        strings = self.discrete_gaussian.compress(x, indexes, means=pm)
+        pm, indexes = _coding_prior(self.discrete_gaussian, pm, plogv, self.prior_frac_bits)
+        strings = entropy_coding.compress_buffers(self.discrete_gaussian, x, indexes, means=pm)
         return strings
 
     def decompress(self, feature, strings):
         pm, plogv, _ = self._preapre_codec(feature)
         # decompress
-        indexes = self.discrete_gaussian.build_indexes(torch.exp(plogv))
-        x_hat = self.discrete_gaussian.decompress(strings, indexes, means=pm)
+        pm, indexes = _coding_prior(self.discrete_gaussian, pm, plogv, self.prior_frac_bits)
+        x_hat = entropy_coding.decompress_buffers(self.discrete_gaussian, strings, indexes, means=pm)
         x_hat = x_hat * self.bin_size
         return x_hat
 
@@ -238,6 +268,7 @@ class QLatentBlockX(nn.Module):
             common.conv_k1s1(hidden//2, width),
         )
         self.discrete_gaussian = GaussianConditional(None)
+        self.prior_frac_bits = None # see `HierarchicalVAE.set_fixed_point_prior()`
 
     def residual_scaling(self, N):
         self.z_proj[2].weight.data.mul_(math.sqrt(1 / 3*N))
@@ -321,8 +352,7 @@ class QLatentBlockX(nn.Module):
         max_scale = 20
         log_scales = torch.linspace(math.log(min_scale), math.log(max_scale), steps=64)
         scale_table = torch.exp(log_scales)
-        updated = self.discrete_gaussian.update_scale_table(scale_table)
-        self.discrete_gaussian.update()
+        entropy_coding.update_shared(self.discrete_gaussian, scale_table)
 
     def compress(self, feature, enc_feature):
         """ Forward pass, compression (encoding) mode.
@@ -335,8 +365,8 @@ class QLatentBlockX(nn.Module):
         # posterior q(z|x)
         qm = self.posterior(torch.cat([feature, enc_feature], dim=1))
         # compress
-        indexes = self.discrete_gaussian.build_indexes(torch.exp(plogv))
-        strings = self.discrete_gaussian.compress(qm, indexes, means=pm)
+        pm, indexes = _coding_prior(self.discrete_gaussian, pm, plogv, self.prior_frac_bits)
+        strings = entropy_coding.compress_buffers(self.discrete_gaussian, qm, indexes, means=pm)
         zhat = self.discrete_gaussian.quantize(qm, mode='dequantize', means=pm)
         # add the new information to feature
         feature = feature + self.z_proj(zhat)
@@ -352,8 +382,8 @@ class QLatentBlockX(nn.Module):
         """
         feature, pm, plogv = self.transform_prior(feature)
         # decompress
-        indexes = self.discrete_gaussian.build_indexes(torch.exp(plogv))
-        zhat = self.discrete_gaussian.decompress(strings, indexes, means=pm)
+        pm, indexes = _coding_prior(self.discrete_gaussian, pm, plogv, self.prior_frac_bits)
+        zhat = entropy_coding.decompress_buffers(self.discrete_gaussian, strings, indexes, means=pm)
         # add the new information to feature
         feature = feature + self.z_proj(zhat)
         feature = self.resnet_end(feature)
@@ -376,11 +406,15 @@ class TopDownDecoder(nn.Module):
             if hasattr(block, 'residual_scaling'):
                 block.residual_scaling(total_blocks)
 
-    def forward(self, enc_features, get_latents=False):
+    def forward(self, enc_features, get_latents=False, skip_synthesis=False):
         stats = []
         min_res = min(enc_features.keys())
         feature = self.bias.expand(enc_features[min_res].shape)
+        last_latent = max([i for i, b in enumerate(self.dec_blocks) if hasattr(b, 'forward_train')])
         for i, block in enumerate(self.dec_blocks):
+            if skip_synthesis and (i > last_latent):
+                # the remaining blocks do not change the rate
+                break
             if hasattr(block, 'forward_train'):
                 res = int(feature.shape[2])
                 f_enc = enc_features[res]
@@ -480,6 +514,8 @@ class HierarchicalVAE(nn.Module):
         self._stats_log = dict()
         self._flops_mode = False
         self.compressing = False
+        # fractional bits of the fixed-point prior parameters. See `set_fixed_point_prior()`.
+        self.prior_frac_bits = None
 
     def preprocess_input(self, im: torch.Tensor):
         """ Shift and scale the input image
@@ -602,6 +638,34 @@ class HierarchicalVAE(nn.Module):
         im_samples = self.process_output(x_samples)
         return im_samples
 
+    @torch.no_grad()
+    def estimate_bits(self, ims, breakdown=False):
+        """ Estimate the number of bits of each image from the probabilities of the latent \
+            variables, without entropy coding. For lossy models, the decoder blocks after the \
+            last latent block are skipped. For lossless models, the full decoder is executed, \
+            and the rate of the pixels, computed from the CDF tables of the coder, is included \
+            as the last block (which requires `self.compress_mode()`). The model must be in \
+            eval mode, where the latents are quantized as in compression.
+
+        Args:
+            ims (torch.Tensor): a batch of images, (N, C, H, W), values between (0, 1)
+            breakdown (bool): if True, also return bits per latent block and per channel. \
+                See `entropy_coding.nats_to_bits()`.
+
+        Returns:
+            torch.Tensor: estimated bits of each image, shape (N,), excluding the container header
+        """
+        assert not self.training, 'The rate is only estimated in eval mode, i.e., with quantized latents.'
+        ims = ims.to(self._dummy.device)
+        x = self.preprocess_input(ims)
+        enc_features = self.encoder(x)
+        lossless = hasattr(self.out_net, 'compress')
+        feature, stats_all = self.decoder(enc_features, skip_synthesis=not lossless)
+        nlls = [stat['kl'] for stat in stats_all]
+        if lossless:
+            nlls.append(self.out_net.coding_nll(feature, self.preprocess_target(ims)))
+        return entropy_coding.nats_to_bits(nlls, breakdown=breakdown)
+
     def forward_get_latents(self, im):
         """ forward pass and return all the latent variables
         """
@@ -637,13 +701,37 @@ class HierarchicalVAE(nn.Module):
             im_input[:, :, h_slice, w_slice] = im_sample[:, :, h_slice, w_slice]
         return im_sample
 
-    def compress_mode(self, mode=True):
+    def set_fixed_point_prior(self, frac_bits=8):
+        """ Snap the prior means and log-scales to a fixed-point grid with `frac_bits` \
+            fractional bits before CDF index selection and mean subtraction, and select the \
+            indexes by integer comparison, such that the decoder is not tied to the thread \
+            count, batch size, or SIMD path of the encoder (up to values that land exactly \
+            on a rounding point).
+
+        Args:
+            frac_bits (int or None): number of fractional bits. None disables the fixed-point mode.
+        """
+        assert (frac_bits is None) or (0 <= frac_bits <= 16), f'{frac_bits=}'
+        for module in self.modules():
+            if hasattr(module, 'prior_frac_bits'):
+                module.prior_frac_bits = frac_bits
+
+    def compress_mode(self, mode=True, cdf_tables=False):
         """ Prepare for entropy coding. Musted be called before compression.
+
+        Args:
+            mode (bool): whether to enter the compression mode
+            cdf_tables (str, Path, or bool): file of the persisted (memory-mapped) CDF tables, \
+                which is read if it exists and written otherwise. True means \
+                `entropy_coding.default_cdf_tables_path()`. False (default) means to always \
+                compute the tables, without touching any file.
         """
         if mode:
-            self.decoder.update()
-            if hasattr(self.out_net, 'compress'):
-                self.out_net.update()
+            def _update_all():
+                self.decoder.update()
+                if hasattr(self.out_net, 'compress'):
+                    self.out_net.update()
+            entropy_coding.update_with_cdf_tables(_update_all, path=cdf_tables)
         self.compressing = mode
 
     @torch.no_grad()
@@ -686,6 +774,107 @@ class HierarchicalVAE(nn.Module):
         im_hat = self.process_output(x_hat)
         return im_hat
 
+    def _num_latent_strings(self, compressed_obj):
+        # compressed_obj = [latent strings..., feature_shape, (optional) final strings]
+        return len(compressed_obj) - (2 if hasattr(self.out_net, 'compress') else 1)
+
+    @torch.no_grad()
+    def compress_batch(self, ims):
+        """ compress a batch of same-size images in one forward pass, and split the result \
+            into one independent compressed object per image
+
+        Args:
+            ims (torch.Tensor): a batch of images, (N, C, H, W), values between (0, 1)
+
+        Returns:
+            list: N compressed objects, each in the same format as `self.compress()` of one image
+        """
+        compressed_obj = self.compress(ims)
+        num = self._num_latent_strings(compressed_obj)
+        _, fC, fH, fW = compressed_obj[num]
+        objects = []
+        for i in range(ims.shape[0]):
+            obj = [[strs_batch[i]] for strs_batch in compressed_obj[:num]]
+            obj.append((1, fC, fH, fW))
+            if hasattr(self.out_net, 'compress'): # lossless compression
+                obj.append([compressed_obj[-1][i]])
+            objects.append(obj)
+        return objects
+
+    @torch.no_grad()
+    def decompress_batch(self, objects):
+        """ decompress a list of compressed objects (of same-size images) in one forward pass
+
+        Args:
+            objects (list): a list of outputs of `self.compress()` or `self.compress_batch()`
+
+        Returns:
+            torch.Tensor: a batch of reconstructed images, (N, C, H, W), values between (0, 1)
+        """
+        num = self._num_latent_strings(objects[0])
+        shapes = set([tuple(obj[num][1:]) for obj in objects])
+        assert len(shapes) == 1, f'All images should have the same size, got {shapes=}'
+        fC, fH, fW = shapes.pop()
+        # merge the strings of all images into one batch
+        merged = [[s for obj in objects for s in obj[k]] for k in range(num)]
+        merged.append((len(objects), fC, fH, fW))
+        if hasattr(self.out_net, 'compress'): # lossless compression
+            merged.append([s for obj in objects for s in obj[-1]])
+        return self.decompress(merged)
+
+    def pack(self, compressed_obj, img_hw):
+        """ Pack a single-image compressed object into a container (see `lvae.utils.container`)
+
+        Args:
+            compressed_obj (list): output of `self.compress()` for one image, or an element \
+                of the output of `self.compress_batch()`
+            img_hw (tuple): original (height, width) of the image before padding
+
+        Returns:
+            bytes: the container
+        """
+        num = self._num_latent_strings(compressed_obj)
+        nB, _, fH, fW = compressed_obj[num]
+        assert nB == 1, f'Only a single image can be packed, got {nB=}'
+        strings = [strs_batch[0] for strs_batch in compressed_obj[:num]]
+        if hasattr(self.out_net, 'compress'): # lossless compression
+            strings.append(compressed_obj[-1][0])
+        return container.pack(strings, img_hw=img_hw, grid_hw=(fH, fW),
+                              prior_frac_bits=self.prior_frac_bits)
+
+    def unpack(self, string, allow_pickle=False):
+        """ Unpack a container given by `self.pack()`. Files written by older versions \
+            (pickled objects) are also supported if `allow_pickle=True`.
+
+        Args:
+            string (bytes, memoryview, or mmap.mmap): the container
+            allow_pickle (bool, optional): accept the legacy format. Unpickling can execute \
+                arbitrary code, so only enable it for trusted files. Defaults to False.
+
+        Returns:
+            tuple: (compressed object, original (height, width) of the image). The latent \
+                strings are copied out of `string` as bytes, as required by the entropy coder.
+        """
+        if not container.is_container(string): # legacy format
+            if not allow_pickle:
+                raise ValueError('Not a container given by `pack()`. Bit strings of the legacy (pickle) format '
+                                 'can execute arbitrary code when loaded, and are only decoded with '
+                                 '`allow_pickle=True`, for trusted files.')
+            compressed_obj = pickle.loads(string)
+            img_hw = compressed_obj.pop()
+            return compressed_obj, img_hw
+        info = container.unpack(string)
+        assert info['prior_frac_bits'] == self.prior_frac_bits, f'The bit string is coded with ' \
+            f'{info["prior_frac_bits"]=} fixed-point prior, but the model uses {self.prior_frac_bits}.'
+        strings = [bytes(s) for s in info['strings']]
+        lossless = hasattr(self.out_net, 'compress')
+        num = len(strings) - 1 if lossless else len(strings)
+        compressed_obj = [[s] for s in strings[:num]]
+        compressed_obj.append((1, self.decoder.bias.shape[1], *info['grid_hw']))
+        if lossless:
+            compressed_obj.append([strings[-1]])
+        return compressed_obj, info['img_hw']
+
     @torch.no_grad()
     def compress_file(self, img_path, output_path):
         """ Compress an image file specified by `img_path` and save to `output_path`
@@ -701,29 +890,83 @@ class HierarchicalVAE(nn.Module):
         im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
         # compress by model
         compressed_obj = self.compress(im)
-        compressed_obj.append((img.height, img.width))
         # save bits to file
         with open(output_path, 'wb') as f:
-            pickle.dump(compressed_obj, file=f)
+            f.write(self.pack(compressed_obj, img_hw=(img.height, img.width)))
 
     @torch.no_grad()
-    def decompress_file(self, bits_path):
+    def decompress_file(self, bits_path, allow_pickle=False):
         """ Decompress a bits file specified by `bits_path`
 
         Args:
             bits_path (str): input bits path
+            allow_pickle (bool, optional): accept legacy (pickled) files. See `self.unpack()`.
 
         Returns:
             torch.Tensor: reconstructed image
         """
-        # read from file
-        with open(bits_path, 'rb') as f:
-            compressed_obj = pickle.load(file=f)
-        img_h, img_w = compressed_obj.pop()
+        # read from file. the file is memory-mapped, and only the latent strings are copied
+        with coding.mapped_file(bits_path) as buffer:
+            compressed_obj, (img_h, img_w) = self.unpack(buffer, allow_pickle=allow_pickle)
         # decompress by model
         im_hat = self.decompress(compressed_obj)
         return im_hat[:, :, :img_h, :img_w]
 
+    @torch.no_grad()
+    def compress_files(self, img_paths, output_paths, batch_size=16):
+        """ Compress multiple image files. Images that have the same size after padding \
+            are compressed together in batches.
+
+        Args:
+            img_paths    (list[str]): input image paths
+            output_paths (list[str]): output bits paths
+            batch_size   (int, optional): maximum number of images in a batch. Defaults to 16.
+        """
+        assert len(img_paths) == len(output_paths)
+        device = next(self.parameters()).device
+        # group images by padded size. PIL only reads the image header here.
+        groups = defaultdict(list)
+        for impath, outpath in zip(img_paths, output_paths):
+            with Image.open(impath) as img:
+                size = (math.ceil(img.height / self.max_stride), math.ceil(img.width / self.max_stride))
+            groups[size].append((impath, outpath))
+        for pairs in groups.values():
+            for i in range(0, len(pairs), batch_size):
+                chunk = pairs[i:i+batch_size]
+                imgs = [Image.open(impath) for impath, _ in chunk]
+                ims = [tvf.to_tensor(pad_divisible_by(img, div=self.max_stride)) for img in imgs]
+                ims = torch.stack(ims, dim=0).to(device=device)
+                objects = self.compress_batch(ims)
+                for img, (_, outpath), obj in zip(imgs, chunk, objects):
+                    with open(outpath, 'wb') as f:
+                        f.write(self.pack(obj, img_hw=(img.height, img.width)))
+
+    @torch.no_grad()
+    def decompress_files(self, bits_paths, batch_size=16, allow_pickle=False):
+        """ Decompress multiple bits files. Files of the same image size are decoded together.
+
+        Args:
+            bits_paths (list[str]): input bits paths
+            batch_size (int, optional): maximum number of images in a batch. Defaults to 16.
+            allow_pickle (bool, optional): accept legacy (pickled) files. See `self.unpack()`.
+
+        Returns:
+            list[torch.Tensor]: reconstructed images, in the same order as `bits_paths`
+        """
+        groups = defaultdict(list)
+        for idx, bits_path in enumerate(bits_paths):
+            with coding.mapped_file(bits_path) as buffer:
+                obj, img_hw = self.unpack(buffer, allow_pickle=allow_pickle)
+            groups[tuple(obj[self._num_latent_strings(obj)])].append((idx, img_hw, obj))
+        results = [None] * len(bits_paths)
+        for items in groups.values():
+            for i in range(0, len(items), batch_size):
+                chunk = items[i:i+batch_size]
+                im_hats = self.decompress_batch([obj for _, _, obj in chunk])
+                for (idx, (img_h, img_w), _), im_hat in zip(chunk, im_hats):
+                    results[idx] = im_hat[:, :img_h, :img_w].unsqueeze(0)
+        return results
+
 
 def pad_divisible_by(img, div=64):
     """ Pad an PIL.Image at right and bottom border \
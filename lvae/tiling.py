@@ -0,0 +1,259 @@
+'''
+Tiled image coding with bounded memory.
+
+A large image is split into tiles that are aligned to `model.max_stride`. Each tile is
+compressed by `model.compress()` into an independent sub-stream, and all sub-streams are
+stored in a single container. The peak memory of the neural network is therefore bounded by
+the tile size rather than the image size. Tiles can optionally overlap each other, in which
+case the decoder blends the overlapping regions with linear weights.
+
+Container format: see `lvae.utils.container`. The image size, the tile grid size, the tile
+size and overlap are stored in the header, followed by the tile sub-streams in row-major
+order.
+
+The lengths of all sub-streams are stored before any payload, so they serve as a byte-offset
+index of the tiles. `decompress_region()` reads only this index and the tiles that overlap
+the requested region, which lets a viewer decode a viewport without touching the full image.
+'''
+from PIL import Image
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import os
+import torch
+import torchvision.transforms.functional as tvf
+
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+
+Image.MAX_IMAGE_PIXELS = None # allow gigapixel images
+
+def get_tile_boxes(img_hw, tile_size, overlap=0):
+    """ Split an image into a grid of tiles, in row-major order.
+
+    Args:
+        img_hw    (tuple): image (height, width)
+        tile_size (int):   tile size, should be divisible by the model's max_stride
+        overlap   (int):   number of pixels that each tile extends into its neighbors
+
+    Returns:
+        list[tuple]: for each tile, ((y0, x0, y1, x1) of the core region, \
+            (y0, x0, y1, x1) of the coded region). The coded region is the core region \
+            extended by `overlap` and clipped to the image.
+    """
+    imH, imW = img_hw
+    boxes = []
+    for y0 in range(0, imH, tile_size):
+        for x0 in range(0, imW, tile_size):
+            y1, x1 = min(y0 + tile_size, imH), min(x0 + tile_size, imW)
+            core = (y0, x0, y1, x1)
+            coded = (max(y0 - overlap, 0), max(x0 - overlap, 0),
+                     min(y1 + overlap, imH), min(x1 + overlap, imW))
+            boxes.append((core, coded))
+    return boxes
+
+
+def _blending_weights_1d(start, end, core_start, core_end, overlap):
+    """ 1-D blending weights of a tile covering [start, end). The weights of two neighboring
+    tiles sum up to one in their overlapping region.
+    """
+    pos = torch.arange(start, end, dtype=torch.float) + 0.5
+    weights = torch.ones(end - start)
+    if overlap > 0:
+        if start < core_start: # has a neighbor before it
+            weights = torch.minimum(weights, (pos - start) / (2 * overlap))
+        if end > core_end: # has a neighbor after it
+            weights = torch.minimum(weights, (end - pos) / (2 * overlap))
+    return weights
+
+
+def _compress_tile(model, tile_img, lmb):
+    img_padded = coding.pad_divisible_by(tile_img, div=model.max_stride)
+    device = next(model.parameters()).device
+    im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
+    string = model.compress(im) if (lmb is None) else model.compress(im, lmb=lmb)
+    assert isinstance(string, bytes), f'model.compress() should return bytes, got {type(string)}'
+    return string
+
+
+def _decompress_tile(model, string, tile_hw):
+    im_hat = model.decompress(string)
+    return im_hat[:, :, :tile_hw[0], :tile_hw[1]].cpu()
+
+
+# ================ process pool workers ================
+_worker_model = None
+
+def _init_worker(model, num_threads):
+    global _worker_model
+    torch.set_num_threads(num_threads)
+    _worker_model = model
+
+@torch.no_grad()
+def _worker_compress_tile(tile_img, lmb):
+    return _compress_tile(_worker_model, tile_img, lmb)
+
+@torch.no_grad()
+def _worker_decompress_tile(string, tile_hw):
+    return _decompress_tile(_worker_model, string, tile_hw)
+
+
+def _make_pool(model, workers):
+    """ Each worker process holds a copy of the model, and the CPU threads are split evenly
+    """
+    assert next(model.parameters()).device.type == 'cpu', 'The process pool only supports CPU models'
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    return ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(model, num_threads))
+
+
+@torch.no_grad()
+def compress_tiled(model, img, tile_size=1024, overlap=0, lmb=None, workers=0):
+    """ Compress an image tile by tile.
+
+    Args:
+        model (torch.nn.Module): a model whose `compress()` returns bytes. Should be \
+            in compression mode, i.e., `model.compress_mode(True)` has been called.
+        img (PIL.Image or str): image or image path
+        tile_size (int, optional): tile size. Should be divisible by `model.max_stride`.
+        overlap   (int, optional): pixels that each tile extends into its neighbors.
+        lmb     (float, optional): lambda for variable-rate models. Defaults to None.
+        workers   (int, optional): number of worker processes. 0 means no process pool.
+
+    Returns:
+        bytes: the compressed container
+    """
+    if not isinstance(img, Image.Image):
+        img = Image.open(img)
+    assert tile_size % model.max_stride == 0, f'{tile_size=} should be divisible by {model.max_stride}'
+    assert 0 <= overlap < tile_size, f'Invalid {overlap=}'
+    boxes = get_tile_boxes((img.height, img.width), tile_size, overlap)
+    # PIL crop box: left, top, right, bottom
+    crops = ((x0, y0, x1, y1) for _, (y0, x0, y1, x1) in boxes)
+
+    if workers > 0:
+        with _make_pool(model, workers) as pool:
+            futures = [pool.submit(_worker_compress_tile, img.crop(c), lmb) for c in crops]
+            tile_strings = [f.result() for f in futures]
+    else:
+        tile_strings = [_compress_tile(model, img.crop(c), lmb) for c in crops]
+
+    grid_hw = (len(range(0, img.height, tile_size)), len(range(0, img.width, tile_size)))
+    return container.pack(tile_strings, img_hw=(img.height, img.width), grid_hw=grid_hw,
+                          tiles=(tile_size, overlap))
+
+
+def read_tile_index(buffer):
+    """ Read the header and the tile index of a container produced by `compress_tiled()`. \
+        Only the header bytes are accessed, so `buffer` can be a memory-mapped file.
+
+    Args:
+        buffer (bytes, memoryview, or mmap.mmap): the compressed container
+
+    Returns:
+        dict: image size, tile size, overlap, and the (offset, length) of each tile in `buffer`
+    """
+    assert container.is_container(buffer), 'Not a container'
+    info = container.unpack(buffer, verify=False)
+    assert info['tiles'] is not None, 'Not a tiled container'
+    tile_size, overlap = info['tiles']
+    return dict(img_hw=info['img_hw'], tile_size=tile_size, overlap=overlap, tiles=info['offsets'])
+
+
+def _decompress_region(model, buffer, box, workers):
+    index = read_tile_index(buffer)
+    imH, imW = index['img_hw']
+    overlap = index['overlap']
+    boxes = get_tile_boxes((imH, imW), index['tile_size'], overlap)
+    assert len(boxes) == len(index['tiles']), f'{len(boxes)=}, {len(index["tiles"])=}'
+    left, top, right, bottom = box
+    assert 0 <= left < right <= imW and 0 <= top < bottom <= imH, f'Invalid {box=} for {imH=}, {imW=}'
+
+    # select the tiles that overlap the requested region
+    selected = [i for i, (_, (y0, x0, y1, x1)) in enumerate(boxes)
+                if (y0 < bottom) and (y1 > top) and (x0 < right) and (x1 > left)]
+    view = memoryview(buffer)
+    # zero-copy views of the tiles, except for worker processes, which need picklable bytes
+    _read = (lambda o, l: bytes(view[o:o+l])) if (workers > 0) else (lambda o, l: view[o:o+l])
+    tile_strings = [_read(o, l) for o, l in (index['tiles'][i] for i in selected)]
+    tile_hws = [(y1-y0, x1-x0) for _, (y0, x0, y1, x1) in (boxes[i] for i in selected)]
+
+    if workers > 0:
+        pool = _make_pool(model, workers)
+        tiles = pool.map(_worker_decompress_tile, tile_strings, tile_hws)
+    else:
+        pool = None
+        tiles = (_decompress_tile(model, s, hw) for s, hw in zip(tile_strings, tile_hws))
+
+    im_hat = torch.zeros(1, 3, bottom-top, right-left)
+    weight_sum = torch.zeros(1, 1, bottom-top, right-left) if (overlap > 0) else None
+    for i, tile in zip(selected, tiles):
+        (cy0, cx0, cy1, cx1), (y0, x0, y1, x1) = boxes[i]
+        # intersection of the tile and the region, in tile and in region coordinates
+        iy0, ix0, iy1, ix1 = max(y0, top), max(x0, left), min(y1, bottom), min(x1, right)
+        src = (slice(None), slice(None), slice(iy0-y0, iy1-y0), slice(ix0-x0, ix1-x0))
+        dst = (slice(None), slice(None), slice(iy0-top, iy1-top), slice(ix0-left, ix1-left))
+        if overlap > 0:
+            wy = _blending_weights_1d(y0, y1, cy0, cy1, overlap)
+            wx = _blending_weights_1d(x0, x1, cx0, cx1, overlap)
+            weights = (wy.view(1, 1, -1, 1) * wx.view(1, 1, 1, -1))[src]
+            im_hat[dst] += tile[src] * weights
+            weight_sum[dst] += weights
+        else:
+            im_hat[dst] = tile[src]
+    if pool is not None:
+        pool.shutdown()
+    del tile_strings, view, _read # release the views of `buffer`
+    if overlap > 0:
+        im_hat.div_(weight_sum)
+    return im_hat
+
+
+@torch.no_grad()
+def decompress_tiled(model, string, workers=0):
+    """ Decompress a container produced by `compress_tiled()`.
+
+    Args:
+        model (torch.nn.Module): the same model used for compression
+        string (bytes): compressed container
+        workers (int, optional): number of worker processes. 0 means no process pool.
+
+    Returns:
+        torch.Tensor: reconstructed image, (1, 3, H, W), values between (0, 1)
+    """
+    imH, imW = read_tile_index(string)['img_hw']
+    return _decompress_region(model, string, box=(0, 0, imW, imH), workers=workers)
+
+
+@torch.no_grad()
+def decompress_region(model, bits, box, workers=0):
+    """ Decode only a region of a tiled container. Only the tiles that overlap `box` are read \
+        and decoded, so the latency scales with the region size instead of the image size.
+
+    Args:
+        model (torch.nn.Module): the same model used for compression
+        bits (str, Path, or bytes): path to a file produced by `compress_file_tiled()`, \
+            which is memory-mapped, or the compressed container itself.
+        box (tuple): (left, top, right, bottom) in pixels, same as `PIL.Image.crop()`
+        workers (int, optional): number of worker processes. 0 means no process pool.
+
+    Returns:
+        torch.Tensor: reconstructed region, (1, 3, bottom-top, right-left), values between (0, 1)
+    """
+    if not isinstance(bits, (str, Path)):
+        return _decompress_region(model, bits, box, workers)
+    with coding.mapped_file(bits) as buffer:
+        return _decompress_region(model, buffer, box, workers)
+
+
+def compress_file_tiled(model, img_path, output_path, **kwargs):
+    """ Compress an image file tile by tile. See `compress_tiled()` for the arguments.
+    """
+    string = compress_tiled(model, img_path, **kwargs)
+    with open(output_path, 'wb') as f:
+        f.write(string)
+
+
+def decompress_file_tiled(model, bits_path, **kwargs):
+    """ Decompress a file produced by `compress_file_tiled()`.
+    """
+    with coding.mapped_file(bits_path) as buffer:
+        return decompress_tiled(model, buffer, **kwargs)
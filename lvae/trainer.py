@@ -431,8 +431,11 @@ class BaseTrainingWrapper():
         n = len(str(cfg.iterations))
         self.stats_table['Iter'] = f'{self._cur_iter:>{n}}/{cfg.iterations-1}'
 
-        mem = torch.cuda.max_memory_allocated(self.device) / 1e9
-        torch.cuda.reset_peak_memory_stats()
+        if self.device.type == 'cuda':
+            mem = torch.cuda.max_memory_allocated(self.device) / 1e9
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            mem = 0.0
         self.stats_table['GPU_mem'] = f'{mem:.3g}G'
 
         cur_lr = self.optimizer.param_groups[0]['lr']
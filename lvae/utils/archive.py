@@ -0,0 +1,188 @@
+'''
+Multi-image archive: many compressed images in a single file, with O(1) random access by key.
+
+Layout:
+    header  magic b'LVAR', version (uint8), 3 padding bytes, number of entries (uint64),
+            number of index slots (uint64), index offset (uint64), followed by the model name
+            (varint length + utf-8) and the sha256 hash of the model weights (32 bytes)
+    records one per image: key (varint length + utf-8) followed by the compressed image
+            (varint length + bytes, e.g., a container given by `lvae.utils.container`)
+    index   an open-addressing hash table (linear probing) of `num_slots` slots. Each slot is
+            (64-bit key hash, record offset, record length) as 3 x uint64. Empty slots are all 0.
+
+All integers in the fixed-size header and the index are little-endian. A reader memory-maps
+the file, hashes the key, and probes the slots, so a lookup touches O(1) pages of the file
+regardless of the number of images.
+'''
+from pathlib import Path
+import hashlib
+import mmap
+import struct
+
+from lvae.utils.container import encode_varint, decode_varint
+
+MAGIC = b'LVAR'
+VERSION = 1
+
+_HEADER_FORMAT = '<4sB3xQQQ'
+_HEADER_LEN = struct.calcsize(_HEADER_FORMAT)
+_SLOT_FORMAT = '<QQQ'
+_SLOT_LEN = struct.calcsize(_SLOT_FORMAT)
+_MAX_LOAD_FACTOR = 0.5
+
+
+def _hash_key(key: str):
+    """ 64-bit hash of a key. 0 is reserved for empty slots. """
+    h = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+    return h or 1
+
+
+def weights_hash(model):
+    """ sha256 hash of the model parameters, in the order of `model.named_parameters()`
+
+    Returns:
+        bytes: 32 bytes
+    """
+    sha = hashlib.sha256()
+    for name, p in model.named_parameters():
+        sha.update(name.encode('utf-8'))
+        sha.update(p.detach().cpu().contiguous().numpy().tobytes())
+    return sha.digest()
+
+
+class ArchiveWriter():
+    """ Write an archive. Records are appended to the file as they are added, and the index \
+        is written when the writer is closed.
+
+    Example:
+        with ArchiveWriter('images.lvar', model_name='qarv_base', weights_hash=h) as writer:
+            writer.add('kodim01', string)
+    """
+    def __init__(self, path, model_name: str, weights_hash: bytes):
+        assert len(weights_hash) == 32, f'{len(weights_hash)=}, expected 32 bytes of sha256'
+        self.path = Path(path)
+        self._file = open(self.path, 'wb')
+        self._file.write(struct.pack(_HEADER_FORMAT, MAGIC, VERSION, 0, 0, 0)) # placeholder
+        _name = model_name.encode('utf-8')
+        self._file.write(encode_varint(len(_name)) + _name + weights_hash)
+        self._entries = dict() # key -> (hash, record offset, record length)
+
+    def add(self, key: str, string):
+        """ Add a compressed image
+
+        Args:
+            key (str): unique key of the image, e.g., its file name
+            string (bytes): the compressed image
+        """
+        assert key not in self._entries, f'Duplicate key {key}'
+        _key = key.encode('utf-8')
+        record = encode_varint(len(_key)) + _key + encode_varint(len(string)) + bytes(string)
+        offset = self._file.tell()
+        self._file.write(record)
+        self._entries[key] = (_hash_key(key), offset, len(record))
+
+    def close(self):
+        if self._file.closed:
+            return
+        # the hash table has at least twice as many slots as entries
+        num_slots = 1
+        while num_slots * _MAX_LOAD_FACTOR < max(len(self._entries), 1):
+            num_slots *= 2
+        slots = [None] * num_slots
+        for h, offset, length in self._entries.values():
+            i = h % num_slots
+            while slots[i] is not None:
+                i = (i + 1) % num_slots
+            slots[i] = (h, offset, length)
+        index_offset = self._file.tell()
+        empty = struct.pack(_SLOT_FORMAT, 0, 0, 0)
+        self._file.write(b''.join([empty if (s is None) else struct.pack(_SLOT_FORMAT, *s) for s in slots]))
+        # finalize the header
+        self._file.seek(0)
+        self._file.write(struct.pack(_HEADER_FORMAT, MAGIC, VERSION, len(self._entries),
+                                     num_slots, index_offset))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ArchiveReader():
+    """ Read an archive by memory-mapping it.
+
+    Example:
+        with ArchiveReader('images.lvar') as archive:
+            string = archive['kodim01'] # a zero-copy memoryview
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = open(self.path, 'rb')
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._buffer)
+        magic, version, num, num_slots, index_offset = struct.unpack_from(_HEADER_FORMAT, self._view, 0)
+        assert magic == MAGIC, 'Not an archive: invalid magic bytes'
+        assert version <= VERSION, f'Unsupported archive version {version}, expected <= {VERSION}'
+        self.num_entries, self._num_slots, self._index_offset = num, num_slots, index_offset
+        _len, pos = decode_varint(self._view, _HEADER_LEN)
+        self.model_name = bytes(self._view[pos:pos+_len]).decode('utf-8')
+        self.weights_hash = bytes(self._view[pos+_len:pos+_len+32])
+
+    def _read_slot(self, i):
+        return struct.unpack_from(_SLOT_FORMAT, self._view, self._index_offset + i * _SLOT_LEN)
+
+    def _read_record(self, offset):
+        """ Returns (key, compressed image) of the record at `offset` """
+        _len, pos = decode_varint(self._view, offset)
+        key = bytes(self._view[pos:pos+_len]).decode('utf-8')
+        _len, pos = decode_varint(self._view, pos + _len)
+        return key, self._view[pos:pos+_len]
+
+    def get(self, key, default=None):
+        """ Look up a compressed image by key. The returned memoryview is a view of the \
+            memory-mapped file, and should be released before the reader is closed.
+        """
+        h = _hash_key(key)
+        i = h % self._num_slots
+        while True:
+            slot_hash, offset, _ = self._read_slot(i)
+            if slot_hash == 0: # empty slot
+                return default
+            if slot_hash == h:
+                record_key, string = self._read_record(offset)
+                if record_key == key:
+                    return string
+            i = (i + 1) % self._num_slots
+
+    def __getitem__(self, key):
+        string = self.get(key)
+        if string is None:
+            raise KeyError(key)
+        return string
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.num_entries
+
+    def keys(self):
+        """ All keys, in the order of the records in the file """
+        slots = [self._read_slot(i) for i in range(self._num_slots)]
+        offsets = sorted([offset for h, offset, _ in slots if h != 0])
+        return [self._read_record(o)[0] for o in offsets]
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._view.release()
+        self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
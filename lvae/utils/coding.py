@@ -1,9 +1,14 @@
 import sys
 import json
 import math
+import mmap
 import pickle
 import struct
 import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+from PIL import Image
+import torch
 import torchvision.transforms.functional as tvf
 
 
@@ -23,6 +28,32 @@ def get_object_size(obj, unit='bits'):
         raise ValueError(f'Unknown unit {unit}')
 
 
+@contextmanager
+def mapped_file(path):
+    """ Memory-map a file for reading, such that parsing does not copy the payload.
+
+    The map is closed on exit if no memoryview of it is alive. Otherwise (e.g., the views are \
+        held by the traceback of an exception raised in the `with` block), it is closed when \
+        the views are garbage collected, so that the original exception is not masked by a \
+        `BufferError`.
+
+    Args:
+        path (str or Path): file path
+
+    Yields:
+        mmap.mmap: the read-only map
+    """
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield buffer
+    finally:
+        try:
+            buffer.close()
+        except BufferError:
+            pass
+
+
 def pack_byte_strings(list_of_strings):
     """ Pack a list of byte strings into a single byte string
 
@@ -52,21 +83,22 @@ def unpack_byte_string(string):
     The input byte string should be packed by `pack_byte_strings()`.
 
     Args:
-        string (str): a byte string packed by `pack_byte_strings()`
+        string (bytes, memoryview, or mmap.mmap): a byte string packed by `pack_byte_strings()`
 
     Returns:
-        List[str]: a list of byte strings
+        List[memoryview]: a list of byte strings, as zero-copy views of `string`
     """
+    view = memoryview(string)
     # read the number of latent variables
-    _len = 1
-    num, string = struct.unpack('B', string[:_len])[0], string[_len:]
+    pos = 1
+    num = struct.unpack_from('B', view, 0)[0]
     # read the lengths of each string
-    _len = num * 4
-    lengths, string = struct.unpack(f'{num}I', string[:_len]), string[_len:]
-    assert sum(lengths) == len(string), f'{sum(lengths)=} should equal to {len(string)=}'
+    lengths = struct.unpack_from(f'{num}I', view, pos)
+    pos += num * 4
+    assert sum(lengths) == len(view) - pos, f'{sum(lengths)=} should equal to {len(view) - pos=}'
     # split the string into num strings
-    edges = np.cumsum((0,) + lengths, dtype=np.uint32)
-    strings_all = [string[edges[i]:edges[i+1]] for i in range(num)]
+    edges = pos + np.cumsum((0,) + lengths, dtype=np.int64)
+    strings_all = [view[int(edges[i]):int(edges[i+1])] for i in range(num)]
     return strings_all
 
 
@@ -110,6 +142,48 @@ def crop_divisible_by(img, div=64):
     return cropped
 
 
+def load_images(img_dir, num=None, size=None, div=1, pad=False, repeat=False, device='cpu',
+                return_names=False):
+    """ Load the images in a directory (e.g., Kodak) for benchmarks and calibration. If there \
+        is no image (e.g., the dataset is not downloaded), random images with 8-bit pixel \
+        values, of size `size` x `size` or 512 x 768 (the size of Kodak images), are used.
+
+    Args:
+        img_dir (str or Path): image directory, searched recursively
+        num     (int, optional): number of images. Defaults to all images, or 4 random images.
+        size    (int, optional): center-crop the images to `size` x `size`
+        div     (int, optional): center-crop the images such that both sides are divisible by `div`
+        pad     (bool, optional): pad instead of crop to be divisible by `div`, see `pad_divisible_by()`
+        repeat  (bool, optional): repeat the images to get `num` images if there are fewer
+        device  (torch.device, optional): device of the returned tensors
+        return_names (bool, optional): also return the file names (`random-<i>` for random images)
+
+    Returns:
+        list[torch.Tensor]: images, each (1, 3, H, W), values between (0, 1)
+    """
+    img_paths = sorted(Path(img_dir).rglob('*.*'))
+    if len(img_paths) == 0:
+        print(f'No images found in {img_dir}. Using random images.')
+        hw = (size, size) if size else (512, 768)
+        imgs = [tvf.to_pil_image(torch.rand(3, *hw).mul_(255).round_().div_(255)) for _ in range(num or 4)]
+        names = [f'random-{i}' for i in range(len(imgs))]
+    else:
+        if repeat and (num is not None):
+            img_paths = [img_paths[i % len(img_paths)] for i in range(num)]
+        img_paths = img_paths[:num]
+        imgs = [Image.open(p).convert('RGB') for p in img_paths]
+        names = [p.name for p in img_paths]
+    ims = []
+    for img in imgs:
+        if size is not None:
+            img = tvf.center_crop(img, output_size=size)
+        img = pad_divisible_by(img, div=div) if pad else crop_divisible_by(img, div=div)
+        ims.append(tvf.to_tensor(img).unsqueeze_(0).to(device=device))
+    if return_names:
+        return ims, names
+    return ims
+
+
 def bd_rate(r1, psnr1, r2, psnr2):
     """ Compute average bit rate difference between RD-2 and RD-1. (RD-1 is the baseline)
 
@@ -0,0 +1,300 @@
+'''
+Versioned binary container for compressed images, shared by all models.
+
+Layout (integers are unsigned LEB128 varints unless noted):
+    magic       b'LV'
+    version     uint8
+    flags       uint8, a combination of the FLAG_* bits below
+    image size  height, width
+    grid size   height, width. The latent (or tile) grid size, model-specific.
+    [lambda]    float32, little-endian                                   if FLAG_LAMBDA
+    [model id]  length, utf-8 bytes                                      if FLAG_MODEL_ID
+    [tiles]     tile size, overlap                                       if FLAG_TILES
+    [layers]    number of strings per layer                              if FLAG_LAYERS
+    [mask id]   uint32 little-endian, identifies the channel masks used   if FLAG_CHANNEL_MASK
+    [coder]     entropy coder id, CDF precision in bits                  if FLAG_CODER
+    [prior]     fractional bits of the fixed-point prior parameters      if FLAG_FIXED_PRIOR
+    strings     count, followed by
+                - by default, all lengths and then all payloads
+                - with FLAG_LAYERS, (length, payload) of each string in turn, so that the
+                  container can be truncated after any layer by `truncate()`
+    [checksum]  crc32 of all preceding bytes, uint32 little-endian        if FLAG_CHECKSUM
+
+`unpack()` returns the strings as memoryview slices of the input buffer, so parsing never
+copies the payload and works on memory-mapped files. `read_header()` reads the header from a
+stream, and `header_parser()` is the underlying incremental parser, e.g., for async streams.
+'''
+import struct
+import zlib
+
+MAGIC = b'LV'
+VERSION = 1
+
+FLAG_LAMBDA   = 1 << 0
+FLAG_MODEL_ID = 1 << 1
+FLAG_TILES    = 1 << 2
+FLAG_LAYERS   = 1 << 3
+FLAG_CHECKSUM = 1 << 4
+FLAG_CHANNEL_MASK = 1 << 5
+FLAG_CODER    = 1 << 6
+FLAG_FIXED_PRIOR = 1 << 7
+_KNOWN_FLAGS = FLAG_LAMBDA | FLAG_MODEL_ID | FLAG_TILES | FLAG_LAYERS | FLAG_CHECKSUM | \
+    FLAG_CHANNEL_MASK | FLAG_CODER | FLAG_FIXED_PRIOR
+
+
+def encode_varint(value: int):
+    """ Encode a non-negative integer as an unsigned LEB128 varint
+    """
+    assert value >= 0, f'{value=} should be non-negative'
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(buffer, pos=0):
+    """ Decode an unsigned LEB128 varint starting at `pos`
+
+    Returns:
+        tuple: (value, position after the varint)
+    """
+    value, shift = 0, 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def is_container(buffer):
+    """ Check if `buffer` starts with a container header, i.e., the magic bytes, a supported \
+        version, and known flags. The version check rejects legacy bit strings that happen \
+        to start with the magic bytes.
+    """
+    return (len(buffer) >= 4) and (bytes(buffer[:2]) == MAGIC) and (1 <= buffer[2] <= VERSION) \
+        and (buffer[3] & ~_KNOWN_FLAGS == 0)
+
+
+def _check_prefix(magic, version, flags):
+    assert magic == MAGIC, 'Not a container: invalid magic bytes'
+    assert 1 <= version <= VERSION, f'Unsupported container version {version}, expected <= {VERSION}'
+    assert flags & ~_KNOWN_FLAGS == 0, f'Unknown container flags {flags:#04x}'
+
+
+def pack(strings, img_hw, grid_hw=(0, 0), lmb=None, model_id=None, tiles=None, layers=None,
+         mask_id=None, coder=None, prior_frac_bits=None, checksum=False):
+    """ Pack byte strings and their meta data into a container.
+
+    Args:
+        strings (list[bytes]): byte strings, e.g., one per latent block
+        img_hw  (tuple): image (height, width)
+        grid_hw (tuple): latent or tile grid (height, width)
+        lmb (float, optional): lambda of variable-rate models
+        model_id (str, optional): name of the model
+        tiles (tuple, optional): (tile size, overlap) of tiled coding
+        layers (int, optional): number of strings per layer. If provided, the container \
+            can be truncated after any layer.
+        mask_id (int, optional): a 32-bit id of the latent channel masks, if the encoder \
+            skipped some latent channels. The decoder must use the same masks.
+        coder (tuple, optional): (coder id, CDF precision) of the entropy coder, if not the \
+            default rANS coder of compressai. See `lvae.models.entropy_coding.get_entropy_coder()`.
+        prior_frac_bits (int, optional): number of fractional bits of the fixed-point prior \
+            parameters, if the encoder snapped them to a grid. The decoder must do the same.
+        checksum (bool): whether to append a crc32 checksum
+
+    Returns:
+        bytes: the container
+    """
+    flags = 0
+    fields = [encode_varint(v) for v in (*img_hw, *grid_hw)]
+    if lmb is not None:
+        flags |= FLAG_LAMBDA
+        fields.append(struct.pack('<f', float(lmb)))
+    if model_id is not None:
+        flags |= FLAG_MODEL_ID
+        _id = model_id.encode('utf-8')
+        fields.extend([encode_varint(len(_id)), _id])
+    if tiles is not None:
+        flags |= FLAG_TILES
+        fields.extend([encode_varint(v) for v in tiles])
+    if layers is not None:
+        flags |= FLAG_LAYERS
+        fields.append(encode_varint(layers))
+    if mask_id is not None:
+        flags |= FLAG_CHANNEL_MASK
+        fields.append(struct.pack('<I', mask_id))
+    if coder is not None:
+        flags |= FLAG_CODER
+        fields.extend([encode_varint(v) for v in coder])
+    if prior_frac_bits is not None:
+        flags |= FLAG_FIXED_PRIOR
+        fields.append(encode_varint(prior_frac_bits))
+    if checksum:
+        flags |= FLAG_CHECKSUM
+
+    fields.append(encode_varint(len(strings)))
+    if layers is not None: # interleaved lengths and payloads
+        for s in strings:
+            fields.extend([encode_varint(len(s)), s])
+    else:
+        fields.extend([encode_varint(len(s)) for s in strings])
+        fields.extend(strings)
+    packed = MAGIC + struct.pack('2B', VERSION, flags) + b''.join(fields)
+    if checksum:
+        packed += struct.pack('<I', zlib.crc32(packed))
+    return packed
+
+
+def varint_parser():
+    """ Incremental version of `decode_varint()`. See `header_parser()`.
+    """
+    value, shift = 0, 0
+    while True:
+        byte = (yield 1)[0]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value
+        shift += 7
+
+
+def header_parser():
+    """ Incremental parser of the container header, up to and including the number of strings. \
+        A generator that yields the number of bytes it needs next, and is sent these bytes. \
+        See `read_header()` for how to drive it.
+
+    Returns:
+        dict: meta data, and `num_strings`
+    """
+    magic, version, flags = struct.unpack('2s2B', (yield 4))
+    _check_prefix(magic, version, flags)
+    values = []
+    for _ in range(4):
+        values.append((yield from varint_parser()))
+    info = dict(version=version, flags=flags, img_hw=tuple(values[:2]), grid_hw=tuple(values[2:]),
+                lmb=None, model_id=None, tiles=None, layers=None, mask_id=None,
+                coder=None, prior_frac_bits=None)
+    if flags & FLAG_LAMBDA:
+        info['lmb'] = struct.unpack('<f', (yield 4))[0]
+    if flags & FLAG_MODEL_ID:
+        _len = yield from varint_parser()
+        info['model_id'] = bytes((yield _len)).decode('utf-8')
+    if flags & FLAG_TILES:
+        tile_size = yield from varint_parser()
+        overlap = yield from varint_parser()
+        info['tiles'] = (tile_size, overlap)
+    if flags & FLAG_LAYERS:
+        info['layers'] = yield from varint_parser()
+    if flags & FLAG_CHANNEL_MASK:
+        info['mask_id'] = struct.unpack('<I', (yield 4))[0]
+    if flags & FLAG_CODER:
+        coder_id = yield from varint_parser()
+        precision = yield from varint_parser()
+        info['coder'] = (coder_id, precision)
+    if flags & FLAG_FIXED_PRIOR:
+        info['prior_frac_bits'] = yield from varint_parser()
+    info['num_strings'] = yield from varint_parser()
+    return info
+
+
+def read_header(read_fn):
+    """ Read the container header, up to and including the number of strings.
+
+    Args:
+        read_fn (callable): `read_fn(n)` returns the next `n` bytes, e.g., `file.read`
+
+    Returns:
+        dict: meta data, `num_strings`, and `header_len` (number of bytes read)
+    """
+    parser = header_parser()
+    header_len = 0
+    try:
+        n = next(parser)
+        while True:
+            data = read_fn(n)
+            assert len(data) == n, f'Incomplete container header: expected {n} bytes, got {len(data)}'
+            header_len += n
+            n = parser.send(data)
+    except StopIteration as stop:
+        info = stop.value
+    info['header_len'] = header_len
+    return info
+
+
+def unpack(buffer, verify=True):
+    """ Parse a container produced by `pack()`. A container with FLAG_LAYERS may be truncated, \
+        in which case only the complete strings are returned.
+
+    Args:
+        buffer (bytes, memoryview, or mmap.mmap): the container
+        verify (bool): whether to verify the checksum, if any. Verifying reads the whole buffer.
+
+    Returns:
+        dict: meta data, `strings` (list of memoryview), and `offsets` ((offset, length) \
+            of each string in `buffer`)
+    """
+    view = memoryview(buffer)
+    assert len(view) >= 4, 'Not a container: too short'
+    version, flags = view[2], view[3]
+    _check_prefix(bytes(view[:2]), version, flags)
+    end = len(view)
+    if flags & FLAG_CHECKSUM:
+        end -= 4
+        if verify:
+            expected = struct.unpack_from('<I', view, end)[0]
+            assert zlib.crc32(view[:end]) == expected, 'Checksum mismatch'
+
+    pos = 0
+    def _read(n):
+        nonlocal pos
+        pos += n
+        return view[pos-n:min(pos, end)]
+    info = read_header(_read)
+    num = info['num_strings']
+    offsets = []
+    if flags & FLAG_LAYERS:
+        while (len(offsets) < num) and (pos < end):
+            _len, pos = decode_varint(view, pos)
+            if pos + _len > end: # incomplete string
+                break
+            offsets.append((pos, _len))
+            pos += _len
+        # drop incomplete layers
+        num_complete = len(offsets) - len(offsets) % info['layers']
+        offsets = offsets[:num_complete]
+    else:
+        lengths = []
+        for _ in range(num):
+            _len, pos = decode_varint(view, pos)
+            lengths.append(_len)
+        for _len in lengths:
+            offsets.append((pos, _len))
+            pos += _len
+        assert pos == end, f'Corrupted container: expected {pos} bytes, got {end}'
+    info['truncated'] = len(offsets) < num
+    info['offsets'] = offsets
+    info['strings'] = [view[o:o+l] for o, l in offsets]
+    return info
+
+
+def truncate(buffer, num_layers):
+    """ Keep the first `num_layers` layers of a container packed with `layers`. \
+        Only the header and the string lengths are read. The checksum, if any, is dropped.
+
+    Args:
+        buffer (bytes): the container
+        num_layers (int): number of layers to keep
+
+    Returns:
+        bytes: the truncated container
+    """
+    info = unpack(buffer, verify=False)
+    assert info['layers'] is not None, 'The container is not truncatable'
+    keep = info['offsets'][:num_layers * info['layers']]
+    pos = (keep[-1][0] + keep[-1][1]) if len(keep) > 0 else info['header_len']
+    flags = info['flags'] & ~FLAG_CHECKSUM
+    return MAGIC + struct.pack('2B', info['version'], flags) + bytes(buffer[4:pos])
+
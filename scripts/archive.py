@@ -0,0 +1,144 @@
+import argparse
+import math
+from pathlib import Path
+from time import time
+from multiprocessing import Pool
+from PIL import Image
+import torch
+import torchvision.transforms.functional as tvf
+
+from lvae.models.registry import get_model
+from lvae.utils.archive import ArchiveWriter, ArchiveReader, weights_hash
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+
+_BLOCK_SIZE = 4096 # typical file system block size, for estimating the per-file layout
+
+
+def load_model(name, kwargs):
+    torch.manual_seed(0) # identical weights in all processes, even if not pretrained
+    model = get_model(name, **eval(f'dict({kwargs})'))
+    model.eval()
+    model.compress_mode()
+    return model
+
+
+@torch.no_grad()
+def compress_image(model, img_path, lmb=None):
+    img = Image.open(img_path)
+    img_padded = coding.pad_divisible_by(img, div=model.max_stride)
+    im = tvf.to_tensor(img_padded).unsqueeze_(0)
+    if hasattr(model, 'pack'): # qresvae
+        return model.pack(model.compress(im), img_hw=(img.height, img.width))
+    return model.compress_batch(im, lmbs=lmb, img_hws=[(img.height, img.width)])[0]
+
+
+@torch.no_grad()
+def decompress_image(model, string):
+    if hasattr(model, 'unpack'): # qresvae
+        compressed_obj, (img_h, img_w) = model.unpack(string)
+        im_hat = model.decompress(compressed_obj)
+    else:
+        img_h, img_w = container.unpack(string, verify=False)['img_hw']
+        im_hat = model.decompress(string)
+    return im_hat[:, :, :img_h, :img_w]
+
+
+# ================ process pool workers ================
+_worker = dict()
+
+def _init_worker(name, kwargs, archive_path=None):
+    torch.set_num_threads(1)
+    _worker['model'] = load_model(name, kwargs)
+    if archive_path is not None:
+        _worker['archive'] = ArchiveReader(archive_path)
+
+def _worker_compress(args):
+    img_path, lmb = args
+    return Path(img_path).name, compress_image(_worker['model'], img_path, lmb)
+
+def _worker_extract(args):
+    key, output_dir = args
+    string = _worker['archive'][key]
+    im_hat = decompress_image(_worker['model'], string)
+    del string # release the view of the memory-mapped archive
+    tvf.to_pil_image(im_hat.squeeze(0)).save(Path(output_dir) / f'{Path(key).stem}.png')
+    return key
+
+
+def build(args):
+    img_paths = sorted([p for p in Path(args.input).rglob('*.*') if p.suffix.lower() in ('.png', '.jpg', '.jpeg')])
+    model = load_model(args.model, args.kwargs)
+    t_start = time()
+    with ArchiveWriter(args.output, model_name=args.model, weights_hash=weights_hash(model)) as writer:
+        tasks = [(p, args.lmb) for p in img_paths]
+        payload = []
+        if args.workers > 0:
+            with Pool(args.workers, initializer=_init_worker, initargs=(args.model, args.kwargs)) as pool:
+                for key, string in pool.imap(_worker_compress, tasks, chunksize=4):
+                    writer.add(key, string)
+                    payload.append(len(string))
+        else:
+            _worker['model'] = model
+            for key, string in map(_worker_compress, tasks):
+                writer.add(key, string)
+                payload.append(len(string))
+    elapsed = time() - t_start
+    # compare with one file per image
+    archive_bytes = Path(args.output).stat().st_size
+    per_file_disk = sum([math.ceil(n / _BLOCK_SIZE) * _BLOCK_SIZE for n in payload])
+    print(f'{len(img_paths)} images -> {args.output} in {elapsed:.1f}s')
+    print(f'archive: 1 file, {archive_bytes} bytes, '
+          f'{(archive_bytes - sum(payload)) / max(len(payload), 1):.1f} bytes/img of overhead')
+    print(f'one file per image: {len(payload)} files (inodes), {sum(payload)} bytes, '
+          f'~{per_file_disk} bytes on disk with {_BLOCK_SIZE}-byte blocks')
+
+
+def extract(args):
+    with ArchiveReader(args.input) as archive:
+        model_name, keys = archive.model_name, archive.keys()
+        hash_expected = archive.weights_hash
+    assert model_name == args.model, f'The archive was built by {model_name}, not {args.model}'
+    model = load_model(args.model, args.kwargs)
+    assert weights_hash(model) == hash_expected, 'The model weights differ from the ones used to build the archive'
+    if args.keys is not None:
+        keys = args.keys
+    Path(args.output).mkdir(parents=True, exist_ok=True)
+
+    t_start = time()
+    tasks = [(key, args.output) for key in keys]
+    if args.workers > 0:
+        initargs = (args.model, args.kwargs, args.input)
+        with Pool(args.workers, initializer=_init_worker, initargs=initargs) as pool:
+            done = list(pool.imap_unordered(_worker_extract, tasks, chunksize=4))
+    else:
+        _worker['model'], _worker['archive'] = model, ArchiveReader(args.input)
+        done = [_worker_extract(t) for t in tasks]
+        _worker.pop('archive').close()
+    print(f'{len(done)} images -> {args.output} in {time() - t_start:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ['build', 'extract']:
+        sub = subparsers.add_parser(command)
+        sub.add_argument('-i', '--input',   type=str, required=True,
+                         help='image directory for build, archive file for extract')
+        sub.add_argument('-o', '--output',  type=str, required=True,
+                         help='archive file for build, image directory for extract')
+        sub.add_argument('-m', '--model',   type=str, default='qarv_base')
+        sub.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+        sub.add_argument('-w', '--workers', type=int, default=4)
+    subparsers.choices['build'].add_argument('-l', '--lmb', type=float, default=None)
+    subparsers.choices['extract'].add_argument('-k', '--keys', type=str, default=None, nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args)
+    else:
+        extract(args)
+
+
+if __name__ == '__main__':
+    main()
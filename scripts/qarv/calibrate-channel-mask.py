@@ -0,0 +1,119 @@
+import argparse
+import math
+from pathlib import Path
+from time import time
+from collections import defaultdict
+from PIL import Image
+import torch
+import torch.nn.functional as tnf
+import torchvision.transforms.functional as tvf
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+import lvae.utils.coding as coding
+
+
+def load_images(img_dir, div, device):
+    """ Returns a list of (image, padded image) tensors """
+    img_paths = sorted(Path(img_dir).rglob('*.*'))
+    assert len(img_paths) > 0, f'No images found in {img_dir}'
+    ims = []
+    for p in img_paths:
+        img = Image.open(p).convert('RGB')
+        im = tvf.to_tensor(img).unsqueeze_(0).to(device=device)
+        x = tvf.to_tensor(coding.pad_divisible_by(img, div=div)).unsqueeze_(0).to(device=device)
+        ims.append((im, x))
+    return ims
+
+
+@torch.inference_mode()
+def channel_bpps(model, ims, lmb):
+    """ Average bits per pixel of each latent channel, estimated from the KL terms
+
+    Returns:
+        list[torch.Tensor]: for each latent block, a (zdim,) tensor
+    """
+    sums = defaultdict(float)
+    for im, x in ims:
+        _, _, imgh, imgw = im.shape
+        fdict = model.forward_end2end(x, lmb=model.expand_to_tensor(lmb, n=1))
+        for i, kl in enumerate(fdict['kl_divs']):
+            sums[i] = sums[i] + kl.sum(dim=(2,3)).mean(0).cpu() / (imgh * imgw) * model.log2_e
+    return [sums[i] / len(ims) for i in range(len(sums))]
+
+
+@torch.inference_mode()
+def evaluate(model, ims, lmb, repeat):
+    """ Real bpp, psnr, encoding time, and decoding time, averaged over images """
+    stats = defaultdict(float)
+    for im, x in ims:
+        _, _, imgh, imgw = im.shape
+        t_start = time()
+        for _ in range(repeat):
+            string = model.compress_batch(x, lmbs=lmb, img_hws=[(imgh, imgw)])[0]
+        stats['enc'] += (time() - t_start) / repeat
+        t_start = time()
+        for _ in range(repeat):
+            im_hat = model.decompress(string)[:, :, :imgh, :imgw]
+        stats['dec'] += (time() - t_start) / repeat
+        stats['bpp'] += len(string) * 8 / (imgh * imgw)
+        mse = tnf.mse_loss(im_hat, im).item()
+        stats['psnr'] += -10 * math.log10(mse)
+    return {k: v / len(ims) for k, v in stats.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',     type=str,   default='qarv_base')
+    parser.add_argument('-a', '--kwargs',    type=str,   default='pretrained=True')
+    parser.add_argument('-i', '--calib_dir', type=str,   default=str(known_datasets['kodak']),
+                        help='images for calibration')
+    parser.add_argument('-e', '--eval_dir',  type=str,   default=str(known_datasets['kodak']),
+                        help='images for reporting the time saved and the RD impact')
+    parser.add_argument('-t', '--threshold', type=float, default=1e-4,
+                        help='a channel is dead if its bpp is below this value at all lambdas')
+    parser.add_argument('-s', '--steps',     type=int,   default=8, help='number of lambdas')
+    parser.add_argument('-r', '--repeat',    type=int,   default=1)
+    parser.add_argument('-o', '--output',    type=str,   default=None,
+                        help='defaults to checkpoints/<model>-channel-mask.pt')
+    parser.add_argument('-d', '--device',    type=str,   default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model = model.to(device=device)
+    model.eval()
+    model.compress_mode()
+
+    # ---------------- calibration ----------------
+    start, end = model.lmb_range
+    lambdas = torch.linspace(math.log(start), math.log(end), steps=args.steps).exp().tolist()
+    ims = load_images(args.calib_dir, model.max_stride, device)
+    max_bpps = None
+    for lmb in lambdas:
+        bpps = channel_bpps(model, ims, lmb)
+        max_bpps = bpps if (max_bpps is None) else [torch.maximum(a, b) for a, b in zip(max_bpps, bpps)]
+    masks = [bpp >= args.threshold for bpp in max_bpps]
+    for i, (mask, bpp) in enumerate(zip(masks, max_bpps)):
+        print(f'latent block {i}: {int((~mask).sum())}/{len(mask)} dead channels, '
+              f'{bpp[~mask].sum().item():.6f} bpp (max over lambdas) not coded')
+    output = Path(args.output or f'checkpoints/{args.model}-channel-mask.pt')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    torch.save({'model': args.model, 'threshold': args.threshold, 'lambdas': lambdas,
+                'max_channel_bpps': max_bpps, 'masks': masks}, output)
+    print(f'Saved channel masks to {output}')
+
+    # ---------------- time saved and RD impact ----------------
+    ims = load_images(args.eval_dir, model.max_stride, device)
+    print(f'{"lambda":>8s} | {"bpp":>15s} | {"psnr":>15s} | {"enc ms":>15s} | {"dec ms":>15s}  (all / masked)')
+    for lmb in lambdas:
+        model.set_channel_masks(None)
+        full = evaluate(model, ims, lmb, args.repeat)
+        model.set_channel_masks(masks)
+        skip = evaluate(model, ims, lmb, args.repeat)
+        print(f'{lmb:>8.1f} | {full["bpp"]:>7.4f} {skip["bpp"]:>7.4f} | {full["psnr"]:>7.3f} {skip["psnr"]:>7.3f} | '
+              f'{full["enc"]*1000:>7.1f} {skip["enc"]*1000:>7.1f} | {full["dec"]*1000:>7.1f} {skip["dec"]*1000:>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import json
+import math
+from pathlib import Path
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.models.qarv.lmb_predictor import LambdaPredictor, image_features
+from lvae.utils.coding import load_images
+
+
+def load_model(args):
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model = model.to(device=torch.device(args.device))
+    model.eval()
+    model.compress_mode()
+    return model
+
+
+@torch.no_grad()
+def collect(args):
+    """ Encode images at several lambdas, and append (features, lambda, bytes) records to a \
+        cache file (one JSON object per line). Results of earlier runs are kept.
+    """
+    model = load_model(args)
+    low, high = model.lmb_range
+    ref_lmb = args.ref_lmb or math.sqrt(low * high)
+    lambdas = torch.linspace(math.log(low), math.log(high), steps=args.steps).exp().tolist()
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    num = 0
+    with open(args.output, 'a') as f:
+        ims, names = load_images(args.input, div=model.max_stride, pad=True, device=model._dummy.device,
+                                 return_names=True)
+        for name, x in zip(names, ims):
+            features = image_features(model, x, ref_lmb=ref_lmb)[0].tolist()
+            strings = model.encode_ladder(x, lambdas)
+            for lmb, string in zip(lambdas, strings):
+                record = {'model': args.model, 'image': name, 'hw': list(x.shape[2:4]),
+                          'ref_lmb': ref_lmb, 'features': features, 'lmb': lmb, 'bytes': len(string)}
+                f.write(json.dumps(record) + '\n')
+            num += 1
+    print(f'Appended {num * len(lambdas)} records of {num} images to {args.output}')
+
+
+def load_records(paths, model_name):
+    records = []
+    for path in paths:
+        with open(path, 'r') as f:
+            records.extend([json.loads(line) for line in f if line.strip()])
+    records = [r for r in records if r['model'] == model_name]
+    assert len(records) > 0, f'No records of {model_name} in {paths}'
+    ref_lmbs = set([r['ref_lmb'] for r in records])
+    assert len(ref_lmbs) == 1, f'The records are collected with different reference lambdas {ref_lmbs}'
+    return records
+
+
+def to_tensors(records):
+    features = torch.tensor([r['features'] for r in records], dtype=torch.double)
+    bpps = torch.tensor([r['bytes'] * 8 / (r['hw'][0] * r['hw'][1]) for r in records], dtype=torch.double)
+    lmbs = torch.tensor([r['lmb'] for r in records], dtype=torch.double)
+    return features, bpps, lmbs
+
+
+def fit(args):
+    """ Fit the predictor from cached records, and report the error of log lambda on \
+        held-out images (every 5-th image) before fitting on all images.
+    """
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    records = load_records(args.input, args.model)
+    ref_lmb = records[0]['ref_lmb']
+    names = sorted(set([r['image'] for r in records]))
+    held_out = set(names[::5]) if len(names) >= 5 else set()
+    train = [r for r in records if r['image'] not in held_out]
+    _fit = lambda rs: LambdaPredictor.fit(*to_tensors(rs), lmb_range=model.lmb_range, ref_lmb=ref_lmb,
+                                          ridge=args.ridge, model_name=args.model)
+    if len(held_out) > 0:
+        predictor = _fit(train)
+        features, bpps, lmbs = to_tensors([r for r in records if r['image'] in held_out])
+        error = torch.log(predictor.predict(features, bpps).double()) - torch.log(lmbs)
+        print(f'{len(held_out)} held-out images: RMSE of log lambda = {error.pow(2).mean().sqrt():.4f}, '
+              f'median |error| = {error.abs().median():.4f}')
+    predictor = _fit(records)
+    output = Path(args.output or f'checkpoints/{args.model}-lmb-predictor.pt')
+    predictor.save(output)
+    print(f'Fitted on {len(records)} records of {len(names)} images. Saved to {output}')
+
+
+@torch.no_grad()
+def evaluate(args):
+    """ Compare `compress_to_size()` with and without the predictor on a set of images """
+    model = load_model(args)
+    predictor = LambdaPredictor.load(args.predictor or f'checkpoints/{args.model}-lmb-predictor.pt')
+    stats = {'search': [0, 0, 0.0], 'predictor': [0, 0, 0.0]} # hits in one encode, encodes, time
+    num = 0
+    ims = load_images(args.input, div=model.max_stride, pad=True, device=model._dummy.device)
+    for x in ims:
+        for bpp in args.bpps:
+            max_bytes = round(bpp * x.shape[2] * x.shape[3] / 8)
+            for key, p in [('search', None), ('predictor', predictor)]:
+                model.set_lmb_predictor(p)
+                t_start = time()
+                string, info = model.compress_to_size(x, max_bytes, tol=args.tol, return_info=True)
+                elapsed = time() - t_start
+                hit = (info['num_encodes'] == 1) and ((1 - args.tol) * max_bytes <= len(string) <= max_bytes)
+                stats[key] = [stats[key][0] + int(hit), stats[key][1] + info['num_encodes'],
+                              stats[key][2] + elapsed]
+            num += 1
+    model.set_lmb_predictor(None)
+    print(f'{args.model}, {num} (image, target bpp) pairs, tol={args.tol}')
+    for key, (hits, encodes, elapsed) in stats.items():
+        print(f'{key:<9s}: within tolerance in a single encode {hits/num*100:.1f}%, '
+              f'encodes per image {encodes/num:.2f}, time per image {elapsed/num:.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ['collect', 'fit', 'evaluate']:
+        sub = subparsers.add_parser(command)
+        sub.add_argument('-m', '--model',   type=str, default='qarv_base')
+        sub.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+        sub.add_argument('-d', '--device',  type=str, default='cpu')
+    sub = subparsers.choices['collect']
+    sub.add_argument('-i', '--input',     type=str,   default=str(known_datasets['kodak']), help='image directory')
+    sub.add_argument('-o', '--output',    type=str,   default='runs/lmb-predictor-cache.jsonl')
+    sub.add_argument('-s', '--steps',     type=int,   default=16, help='number of lambdas')
+    sub.add_argument('--ref_lmb',         type=float, default=None,
+                     help='lambda of the coarse rate feature. Defaults to the middle of the range.')
+    sub = subparsers.choices['fit']
+    sub.add_argument('-i', '--input',     type=str,   default=['runs/lmb-predictor-cache.jsonl'], nargs='+')
+    sub.add_argument('-o', '--output',    type=str,   default=None,
+                     help='defaults to checkpoints/<model>-lmb-predictor.pt')
+    sub.add_argument('--ridge',           type=float, default=1e-3)
+    sub = subparsers.choices['evaluate']
+    sub.add_argument('-i', '--input',     type=str,   default=str(known_datasets['kodak']), help='image directory')
+    sub.add_argument('-p', '--predictor', type=str,   default=None,
+                     help='defaults to checkpoints/<model>-lmb-predictor.pt')
+    sub.add_argument('-b', '--bpps',      type=float, default=[0.25, 0.5, 1.0], nargs='+')
+    sub.add_argument('-t', '--tol',       type=float, default=0.02)
+    args = parser.parse_args()
+
+    if args.command == 'collect':
+        collect(args)
+    elif args.command == 'fit':
+        fit(args)
+    else:
+        evaluate(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import logging
+import copy
+import math
+from pathlib import Path
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from lvae.paths import known_datasets
+from lvae.trainer import BaseTrainingWrapper
+from lvae.datasets import get_image_dateset
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+from lvae.models.qarv.distill import bpp_lmb_range, bpp_lmb_scale, forward_with_stats, \
+    Distillation, evaluate_rd, bd_rate_over
+import lvae.models.mlp_pruning as pruning
+
+
+def count_decode_flops(model, im):
+    model = copy.deepcopy(model)
+    model.requires_grad_(False) # for FlopCounterMode
+    model.compress_mode()
+    string = model.compress(im, model.lmb_range[1])
+    with FlopCounterMode(display=False) as counter:
+        model.decompress(string)
+    return counter.get_total_flops()
+
+
+class FinetuneWrapper(BaseTrainingWrapper):
+    """ Short fine-tuning of a compressed model by distillation from the original model """
+    def __init__(self, cfg, teacher, student, val_ims, lambdas, teacher_rd):
+        super().__init__(cfg)
+        self.teacher = teacher
+        self.student = student
+        self.val_ims = val_ims
+        self.lambdas = lambdas
+        self.teacher_rd = teacher_rd
+
+    def set_device(self):
+        self.device = torch.device(self.cfg.device)
+
+    def set_dataset(self):
+        cfg = self.cfg
+        trainset = get_image_dateset(cfg.trainset, transform_cfg=f'crop={cfg.crop},hflip=True')
+        self.make_training_loader(trainset)
+        logging.info(f'Fine-tuning on {len(trainset)} images in {trainset.root} \n')
+
+    def set_model(self):
+        model = Distillation(self.teacher, self.student, w_recon=1.0, w_stats=0.1)
+        self.model = model.to(self.device).train()
+
+    @torch.no_grad()
+    def eval_model(self, model):
+        bdr = bd_rate_over(self.teacher_rd, evaluate_rd(model.student, self.val_ims, self.lambdas))
+        return {'loss': bdr, 'bd-rate': bdr}
+
+
+def finetune(args, teacher, student, val_ims, lambdas, teacher_rd):
+    cfg = argparse.Namespace(
+        wbproject='qarv-mlp-prune', wbentity=None, wbgroup=None, wbtags=None, wbnote=None, wbmode='disabled',
+        name=None, model=f'{args.model}-mlp-{args.method}', resume=None, weights=None, load_optim=False,
+        trainset=args.trainset, crop=args.calib_crop, batch_size=args.batch_size, accum_num=1,
+        optimizer='adam', lr=args.lr, lr_sched='cosine', lrf_min=0.01, lr_warmup=0, grad_clip=2.0,
+        wdecay=0.0, iterations=args.iterations, eval_first=False, amp=False, compile=False,
+        ema=False, ema_decay=0.9999, ema_warmup=None, fixseed=True, workers=args.workers, device=args.device,
+        wandb_log_interval=100, model_log_interval=args.iterations, model_val_interval=0,
+    )
+    trainer = FinetuneWrapper(cfg, teacher, student, val_ims, lambdas, teacher_rd)
+    trainer.main()
+    return trainer.model.student.eval()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',    type=str,   default='qarv_base')
+    parser.add_argument('-a', '--kwargs',   type=str,   default='pretrained=True')
+    parser.add_argument('--method',         type=str,   default='prune', choices=['prune', 'lowrank'])
+    parser.add_argument('-b', '--budget',   type=float, default=1.0,
+                        help='maximum BD-rate (%%) over the original model, after fine-tuning')
+    parser.add_argument('--search_budget',  type=float, default=3.0,
+                        help='maximum BD-rate (%%) before fine-tuning, for the search of the ratio')
+    parser.add_argument('--ratio',          type=float, default=None,
+                        help='fraction of hidden channels (prune) or of ranks (lowrank) to be removed. '
+                             'If given, the search is skipped.')
+    parser.add_argument('--max_ratio',      type=float, default=0.9)
+    parser.add_argument('--search_steps',   type=int,   default=6)
+    parser.add_argument('--backoff',        type=float, default=0.75,
+                        help='the ratio is multiplied by this if the fine-tuned model exceeds the budget')
+    parser.add_argument('--max_tries',      type=int,   default=3)
+    parser.add_argument('-c', '--calib',    type=str,   default=str(known_datasets['coco-val2017']),
+                        help='calibration image directory')
+    parser.add_argument('--calib_num',      type=int,   default=64)
+    parser.add_argument('--calib_crop',     type=int,   default=256)
+    parser.add_argument('-i', '--input',    type=str,   default=str(known_datasets['kodak']),
+                        help='validation image directory, for the BD-rate')
+    parser.add_argument('-n', '--num',      type=int,   default=24)
+    parser.add_argument('--steps',          type=int,   default=6, help='number of lambdas')
+    # fine-tuning
+    parser.add_argument('--trainset',       type=str,   default='coco-train2017')
+    parser.add_argument('--iterations',     type=int,   default=5000, help='fine-tuning iterations, 0 to skip')
+    parser.add_argument('--batch_size',     type=int,   default=16)
+    parser.add_argument('--lr',             type=float, default=2e-5)
+    parser.add_argument('--workers',        type=int,   default=4)
+    parser.add_argument('-d', '--device',   type=str,   default='cuda:0')
+    parser.add_argument('-o', '--output',   type=str,   default=None,
+                        help='defaults to checkpoints/<model>-mlp-<method>.pt')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})')).to(device=device)
+    model.eval()
+    low, high = bpp_lmb_range(model)
+    lambdas = torch.linspace(math.log(low), math.log(high), steps=args.steps).exp().tolist()
+    calib_ims = load_images(args.calib, args.calib_num, args.calib_crop, div=model.max_stride, device=device)
+    val_ims = load_images(args.input, args.num, div=model.max_stride, device=device)
+
+    # ======== calibration: activation statistics over images and lambdas ========
+    def _run_calibration():
+        for lmb in lambdas:
+            for im in calib_ims:
+                lmb_model = torch.full((1,), lmb / bpp_lmb_scale(model), device=device)
+                forward_with_stats(model, im, lmb_model)
+    activations = pruning.collect_mlp_activations(model, _run_calibration)
+    scores = pruning.channel_scores(model, activations)
+    ref_rd = evaluate_rd(model, val_ims, lambdas)
+    num_mlp = pruning.mlp_parameters(model)
+    print(f'{args.model}: {len(scores)} MLPs, {num_mlp/1e6:.2f}M of {sum([p.numel() for p in model.parameters()])/1e6:.2f}M '
+          f'parameters. Calibrated on {len(calib_ims)} images x {len(lambdas)} lambdas.')
+
+    def _try(ratio):
+        compressed, summary = pruning.compressed_copy(model, args.method, ratio, scores, activations)
+        bdr = bd_rate_over(ref_rd, evaluate_rd(compressed, val_ims, lambdas))
+        print(f'ratio={ratio:.4f}: MLP parameters {pruning.mlp_parameters(compressed)/1e6:.2f}M, '
+              f'BD-rate {bdr:.3f}% (before fine-tuning)')
+        return bdr
+
+    # ======== the most aggressive ratio within the search budget, by bisection ========
+    if args.ratio is not None:
+        ratio = args.ratio
+    elif _try(args.max_ratio) <= args.search_budget:
+        ratio = args.max_ratio
+    else:
+        lo, hi = 0.0, args.max_ratio
+        for _ in range(args.search_steps):
+            mid = (lo + hi) / 2
+            if _try(mid) <= args.search_budget: # False for nan
+                lo = mid
+            else:
+                hi = mid
+        ratio = lo
+    if ratio == 0:
+        print(f'No ratio is within the search budget ({args.search_budget}%). Nothing is saved.')
+        return
+
+    # ======== fine-tune, and back off the ratio until the fine-tuned model is within budget ========
+    for _ in range(args.max_tries):
+        compressed, summary = pruning.compressed_copy(model, args.method, ratio, scores, activations)
+        if args.iterations > 0:
+            compressed = finetune(args, model, compressed, val_ims, lambdas, ref_rd)
+        bdr = bd_rate_over(ref_rd, evaluate_rd(compressed, val_ims, lambdas))
+        print(f'ratio={ratio:.4f}: BD-rate {bdr:.3f}% after {args.iterations} fine-tuning iterations '
+              f'(budget {args.budget}%)')
+        if bdr <= args.budget: # False for nan
+            break
+        ratio = ratio * args.backoff
+    else:
+        print(f'No fine-tuned model is within the budget after {args.max_tries} tries. Nothing is saved.')
+        return
+
+    flops = [count_decode_flops(m, val_ims[0]) for m in (model, compressed)]
+    print(f'Selected ratio={ratio:.4f} ({len(summary)} layers changed), BD-rate {bdr:.3f}% '
+          f'(budget {args.budget}%), decode GFLOPs {flops[0]/1e9:.2f} -> {flops[1]/1e9:.2f} '
+          f'for a {val_ims[0].shape[2]}x{val_ims[0].shape[3]} image')
+    output = Path(args.output or f'checkpoints/{args.model}-mlp-{args.method}.pt')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    checkpoint = {'model': compressed.state_dict(), 'method': args.method, 'ratio': ratio,
+                  'bd_rate': bdr, 'summary': summary}
+    torch.save(checkpoint, output)
+    print(f'Saved to {output}. Load by get_model(\'{args.model}\', pretrained=\'{output}\').')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import math
+from pathlib import Path
+from time import time
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+from lvae.models.qarv.distill import bpp_lmb_range, bpp_lmb_scale, bd_rate_over
+
+
+def psnr(a, b):
+    mse = torch.mean((a - b) ** 2).item()
+    return -10 * math.log10(mse) if (mse > 0) else float('inf')
+
+
+def count_flops(func):
+    with FlopCounterMode(display=False) as counter:
+        func()
+    return counter.get_total_flops()
+
+
+@torch.no_grad()
+def evaluate(model, ims, steps):
+    """ Real bpp and PSNR at `steps` lambdas over the range of the model, and the average \
+        encoding and decoding time per image
+    """
+    low, high = bpp_lmb_range(model)
+    lambdas = torch.linspace(math.log(low), math.log(high), steps=steps).exp().tolist()
+    rd = {'lambda': lambdas, 'bpp': [], 'psnr': []}
+    enc_time, dec_time = 0.0, 0.0
+    for lmb in lambdas:
+        bpps, psnrs = [], []
+        for im in ims:
+            t_start = time()
+            string = model.compress(im, lmb / bpp_lmb_scale(model))
+            t_mid = time()
+            im_hat = model.decompress(string)
+            enc_time, dec_time = enc_time + t_mid - t_start, dec_time + time() - t_mid
+            bpps.append(len(string) * 8 / (im.shape[2] * im.shape[3]))
+            psnrs.append(psnr(im_hat, im))
+        rd['bpp'].append(sum(bpps) / len(bpps))
+        rd['psnr'].append(sum(psnrs) / len(psnrs))
+    num = len(lambdas) * len(ims)
+    return rd, enc_time / num, dec_time / num
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--teacher',      type=str, default='qarv_base')
+    parser.add_argument('--teacher_args',       type=str, default='pretrained=True')
+    parser.add_argument('-m', '--models',       type=str, default=['qarv_small'], nargs='+', help='students')
+    parser.add_argument('-a', '--kwargs',       type=str, default=None, nargs='+',
+                        help='one for each student, e.g., "pretrained=\'runs/.../student_ema.pt\'"')
+    parser.add_argument('-i', '--input',        type=str, default=str(known_datasets['kodak']), help='image directory')
+    parser.add_argument('-n', '--num',          type=int, default=24, help='maximum number of images')
+    parser.add_argument('--steps',              type=int, default=6, help='number of lambdas')
+    parser.add_argument('-d', '--device',       type=str, default='cpu')
+    parser.add_argument('-o', '--output',       type=str, default=None, help='save the report as a json file')
+    args = parser.parse_args()
+    kwargs = args.kwargs or [''] * len(args.models)
+    assert len(kwargs) == len(args.models), f'{args.kwargs=} and {args.models=} should match'
+
+    device = torch.device(args.device)
+    names = [args.teacher] + args.models
+    models = []
+    for name, kw in zip(names, [args.teacher_args] + kwargs):
+        model = get_model(name, **eval(f'dict({kw})')).to(device=device)
+        model.eval()
+        model.requires_grad_(False) # for FlopCounterMode
+        model.compress_mode()
+        models.append(model)
+    div = max([m.max_stride for m in models])
+    ims = load_images(args.input, args.num, div=div, device=device)
+
+    report = dict()
+    for name, model in zip(names, models):
+        string = model.compress(ims[0], model.lmb_range[1])
+        flops = count_flops(lambda: model.decompress(string))
+        rd, enc_time, dec_time = evaluate(model, ims, args.steps)
+        report[name] = {'params': sum([p.numel() for p in model.parameters()]),
+                        'decode_flops': flops, 'encode_time': enc_time, 'decode_time': dec_time, 'rd': rd}
+
+    teacher = report[args.teacher]
+    print(f'{len(ims)} images, {args.steps} lambdas per model, real bit strings. '
+          f'BD-rate and speedup are w.r.t. the teacher ({args.teacher}). Time per image on {args.device}.')
+    print(f'{"model":<20s} | {"params":>7s} | {"decode GFLOPs":>13s} | {"encode":>7s} | {"decode":>7s} | '
+          f'{"decode speedup":>14s} | {"BD-rate":>8s}')
+    for name, r in report.items():
+        r['decode_speedup'] = teacher['decode_time'] / r['decode_time']
+        r['bd_rate'] = bd_rate_over(teacher['rd'], r['rd'])
+        # GFLOPs for the first image
+        print(f'{name:<20s} | {r["params"]/1e6:>6.2f}M | {r["decode_flops"]/1e9:>13.2f} | '
+              f'{r["encode_time"]:>6.3f}s | {r["decode_time"]:>6.3f}s | {r["decode_speedup"]:>13.2f}x | '
+              f'{r["bd_rate"]:>7.2f}%')
+    if args.output is not None:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
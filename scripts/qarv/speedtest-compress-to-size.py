@@ -0,0 +1,82 @@
+import argparse
+import math
+import tempfile
+from pathlib import Path
+from time import time
+from PIL import Image
+import torch
+import torchvision.transforms.functional as tvf
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def bisection_search(model, img_path, bits_path, tgt_bytes, max_iter=50, tol=1):
+    """ The search of `scripts/qarv/test-at-target-bytes.py`: bisect lambda in log space, \
+        with a full `compress_file()`, a disk write, and a decompression with PSNR in each \
+        iteration. Returns the number of bytes of the last encoding and the number of iterations.
+    """
+    lmb_min, lmb_max = model.lmb_range
+    lmb = math.exp((math.log(lmb_min) + math.log(lmb_max)) / 2)
+    real = tvf.to_tensor(Image.open(img_path)).unsqueeze_(0)
+    for i in range(max_iter):
+        model.compress_file(img_path, bits_path, lmb=lmb)
+        n_bytes = bits_path.stat().st_size
+        if n_bytes > tgt_bytes:
+            lmb_max = lmb
+        else:
+            lmb_min = lmb
+        lmb = math.exp((math.log(lmb_min) + math.log(lmb_max)) / 2)
+        fake = model.decompress_file(bits_path).cpu()
+        _psnr = -10 * math.log10(torch.mean((fake - real) ** 2).item())
+        if abs(n_bytes - tgt_bytes) <= tol:
+            break
+    return n_bytes, i + 1
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',   type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-n', '--num',     type=int, default=4)
+    parser.add_argument('-s', '--size',    type=int, default=512)
+    parser.add_argument('-b', '--bpps',    type=float, default=[0.25, 0.5, 1.0], nargs='+')
+    parser.add_argument('-t', '--tol',     type=float, default=0.02)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model = model.to(device=device)
+    model.eval()
+    model.compress_mode()
+
+    print(f'{args.model}, {args.num} images of size {args.size}x{args.size}, tol={args.tol}')
+    print(f'{"image":>5s} {"target":>7s} | {"bisection: iters":>16s} {"time":>7s} {"bytes/target":>12s} | '
+          f'{"compress_to_size: estimates":>27s} {"encodes":>7s} {"time":>7s} {"bytes/target":>12s}')
+    totals = [0.0, 0.0]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        img_path, bits_path = Path(tmp_dir) / 'image.png', Path(tmp_dir) / 'image.bits'
+        for k, im in enumerate(load_images(known_datasets['kodak'], args.num, args.size, device=device)):
+            tvf.to_pil_image(im[0]).save(img_path)
+            for bpp in args.bpps:
+                tgt_bytes = round(bpp * args.size * args.size / 8)
+                t_start = time()
+                old_bytes, old_iters = bisection_search(model, img_path, bits_path, tgt_bytes)
+                t_old = time() - t_start
+                t_start = time()
+                string, info = model.compress_to_size(im, tgt_bytes, tol=args.tol, return_info=True)
+                t_new = time() - t_start
+                totals = [totals[0] + t_old, totals[1] + t_new]
+                print(f'{k:>5d} {tgt_bytes:>7d} | {old_iters:>16d} {t_old:>6.2f}s {old_bytes/tgt_bytes:>12.4f} | '
+                      f'{info["num_estimates"]:>27d} {info["num_encodes"]:>7d} {t_new:>6.2f}s '
+                      f'{len(string)/tgt_bytes:>12.4f}')
+    num = args.num * len(args.bpps)
+    print(f'average time per image and target: bisection {totals[0]/num:.2f}s, '
+          f'compress_to_size {totals[1]/num:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import itertools
+from time import time
+from PIL import Image
+import torch
+import torchvision.transforms.functional as tvf
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+import lvae.models.entropy_coding as entropy_coding
+
+
+def load_image(size, device):
+    """ Load a center-cropped Kodak image, or a random image if Kodak is not available """
+    img_paths = sorted(known_datasets['kodak'].rglob('*.*'))
+    if len(img_paths) > 0:
+        img = Image.open(img_paths[0]).convert('RGB')
+        img = tvf.resize(img, size=size) if (min(img.height, img.width) < size) else img
+        im = tvf.to_tensor(tvf.center_crop(img, output_size=size))
+    else:
+        im = torch.rand(3, size, size)
+    return im.unsqueeze_(0).to(device=device)
+
+
+def record_coding_inputs(model, im):
+    """ Compress once and record the (entropy model, inputs, indexes, means) of every latent block """
+    records = []
+    _compress_buffers = entropy_coding.compress_buffers
+    def _recording_compress(entropy_model, inputs, indexes, means=None):
+        records.append((entropy_model, inputs, indexes, means))
+        return _compress_buffers(entropy_model, inputs, indexes, means=means)
+    entropy_coding.compress_buffers = _recording_compress
+    try:
+        model.compress(im)
+    finally:
+        entropy_coding.compress_buffers = _compress_buffers
+    return records
+
+
+def time_coder(records, coder, repeat):
+    """ Returns encoding time, decoding time, and the number of bytes """
+    enc_time, dec_time, num_bytes = 0.0, 0.0, 0
+    for dg, inputs, indexes, means in records:
+        for _ in range(repeat):
+            t_start = time()
+            strings = dg.compress(inputs, indexes, means=means, coder=coder)
+            enc_time += time() - t_start
+            t_start = time()
+            outputs = dg.decompress(strings, indexes, means=means, coder=coder)
+            dec_time += time() - t_start
+        expected = dg.quantize(inputs, mode='dequantize', means=means)
+        assert torch.equal(outputs, expected), 'Decoding is not lossless'
+        num_bytes += sum([len(s) for s in strings])
+    return enc_time / repeat, dec_time / repeat, num_bytes
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',     type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs',    type=str, default='pretrained=True')
+    parser.add_argument('-s', '--size',      type=int, default=2048)
+    parser.add_argument('-l', '--lanes',     type=int, default=[64, 256, 1024, 4096], nargs='+')
+    parser.add_argument('-n', '--min_lane_symbols', type=int, default=64)
+    parser.add_argument('-p', '--precision', type=int, default=[16, 12], nargs='+')
+    parser.add_argument('-t', '--layouts',   type=str, default=['lut', 'search'], nargs='+')
+    parser.add_argument('-r', '--repeat',    type=int, default=3)
+    parser.add_argument('-d', '--device',    type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model = model.to(device=device)
+    model.eval()
+    model.compress_mode()
+
+    im = load_image(args.size, device)
+    records = record_coding_inputs(model, im)
+    num_symbols = sum([inputs.numel() for _, inputs, _, _ in records])
+    print(f'{args.model}, image size {tuple(im.shape[2:])}, {num_symbols} symbols in {len(records)} latent blocks')
+    print(f'{"coder":<40s} | {"enc Msym/s":>10s} | {"dec Msym/s":>10s} | {"bytes":>9s}')
+
+    configs = [('compressai rANS', None)]
+    for lanes, precision, layout in itertools.product(args.lanes, args.precision, args.layouts):
+        coder = entropy_coding.InterleavedRansCoder(num_lanes=lanes, min_lane_symbols=args.min_lane_symbols,
+                                                    precision=precision, table_layout=layout)
+        configs.append((f'interleaved, {lanes=}, {precision=}, {layout}', coder))
+    for name, coder in configs:
+        time_coder(records[:1], coder, repeat=1) # warm up, e.g., build the tables
+        enc_time, dec_time, num_bytes = time_coder(records, coder, args.repeat)
+        print(f'{name:<40s} | {num_symbols/enc_time/1e6:>10.2f} | {num_symbols/dec_time/1e6:>10.2f} | {num_bytes:>9d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import math
+from time import time
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def psnr(a, b):
+    mse = torch.mean((a - b) ** 2).item()
+    return -10 * math.log10(mse) if (mse > 0) else float('inf')
+
+
+def count_flops(func):
+    with FlopCounterMode(display=False) as counter:
+        func()
+    return counter.get_total_flops()
+
+
+def load_model(name, kwargs, device):
+    model = get_model(name, **eval(f'dict({kwargs})'))
+    model = model.to(device=device)
+    model.eval()
+    model.requires_grad_(False) # for FlopCounterMode
+    model.compress_mode()
+    return model
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base', 'qarv_base_fastdec'], nargs='+',
+                        help='the first model encodes, and all models decode the same bit strings')
+    parser.add_argument('-a', '--kwargs',  type=str, default=['pretrained=True', 'pretrained=True'], nargs='+')
+    parser.add_argument('-n', '--num',     type=int, default=4)
+    parser.add_argument('-s', '--size',    type=int, default=512)
+    parser.add_argument('-l', '--lmbs',    type=float, default=[16, 128, 1024], nargs='+')
+    parser.add_argument('-r', '--repeat',  type=int, default=2)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+    assert len(args.kwargs) == len(args.models), f'{args.kwargs=} and {args.models=} should match'
+
+    device = torch.device(args.device)
+    models = [load_model(name, kwargs, device) for name, kwargs in zip(args.models, args.kwargs)]
+    ims = torch.cat(load_images(known_datasets['kodak'], args.num, args.size, device=device), dim=0)
+    strings = [[models[0].compress(ims[i:i+1], lmb=lmb) for i in range(args.num)] for lmb in args.lmbs]
+    bpps = [sum([len(s) for s in ss]) * 8 / (args.num * args.size ** 2) for ss in strings]
+
+    print(f'Bit strings of {args.models[0]}: {args.num} images of size {args.size}x{args.size}, '
+          f'lambdas={args.lmbs}, bpp={[round(b, 4) for b in bpps]}')
+    print(f'{"model":<20s} | {"GFLOPs":>7s} | {"time":>7s} | {"speedup":>7s} | PSNR per lambda')
+    ref_time = None
+    for name, model in zip(args.models, models):
+        flops = count_flops(lambda: model.decompress(strings[0][0]))
+        t_start = time()
+        for _ in range(args.repeat):
+            ims_hat = [[model.decompress(s) for s in ss] for ss in strings]
+        elapsed = (time() - t_start) / args.repeat / args.num / len(args.lmbs)
+        ref_time = ref_time or elapsed
+        psnrs = [sum([psnr(im_hat, ims[i:i+1]) for i, im_hat in enumerate(ii)]) / args.num for ii in ims_hat]
+        print(f'{name:<20s} | {flops/1e9:>7.2f} | {elapsed:>6.3f}s | {ref_time/elapsed:>6.2f}x | '
+              f'{", ".join([f"{p:.2f}" for p in psnrs])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def encode_latency(model, ims, pipelined):
+    """ Average per-image encoding latency, and the bit strings """
+    model.pipelined_coding = pipelined
+    strings = []
+    t_start = time()
+    for im in ims:
+        strings.append(model.compress(im))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time() - t_start) / len(ims), strings
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-n', '--num',     type=int, default=8)
+    parser.add_argument('-s', '--size',    type=int, default=512)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.workers is not None:
+        torch.set_num_threads(args.workers)
+    print(f'pytorch = {torch.__version__}, device = {device}, {torch.get_num_threads()} CPU threads')
+    ims = load_images(known_datasets['kodak'], args.num, args.size, repeat=True, device=device)
+    print(f'{args.num} images of size {args.size}x{args.size}')
+    print('--------------------------------')
+
+    for name in args.models:
+        kwargs = eval(f'dict({args.kwargs})')
+        model = get_model(name, **kwargs)
+        model = model.to(device=device)
+        model.eval()
+        model.compress_mode()
+
+        print(f'{name}, {type(model)}, device={device}')
+        _ = encode_latency(model, ims[:1], pipelined=True) # warm up
+        t_seq, strings_seq = encode_latency(model, ims, pipelined=False)
+        t_pip, strings_pip = encode_latency(model, ims, pipelined=True)
+        assert strings_seq == strings_pip, 'The pipelined bit strings should be identical'
+        print(f'sequential: {t_seq*1000:.1f} ms/img, pipelined: {t_pip*1000:.1f} ms/img, '
+              f'reduction: {(1 - t_pip/t_seq)*100:.1f}%')
+        print()
+
+
+if __name__ == '__main__':
+    main()
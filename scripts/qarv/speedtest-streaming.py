@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import tempfile
+from pathlib import Path
+from time import time
+from PIL import Image
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.models.qarv.streaming import decompress_stream
+
+
+async def throttled_stream(data, kbps, chunk_size=1024):
+    """ A local stand-in for a slow link: yields `data` in chunks at `kbps` kilobits per second """
+    seconds_per_chunk = chunk_size * 8 / (kbps * 1000)
+    for i in range(0, len(data), chunk_size):
+        await asyncio.sleep(seconds_per_chunk)
+        yield data[i:i+chunk_size]
+
+
+async def download_then_decode(model, data, kbps, bits_path):
+    t_start = time()
+    received = b''.join([chunk async for chunk in throttled_stream(data, kbps)])
+    bits_path.write_bytes(received)
+    im_hat = await asyncio.get_running_loop().run_in_executor(None, model.decompress_file, bits_path)
+    return time() - t_start, im_hat
+
+
+async def streaming_decode(model, data, kbps):
+    t_start = time()
+    first_preview, im_hat = None, None
+    async for num_decoded, im_hat in decompress_stream(model, throttled_stream(data, kbps)):
+        if first_preview is None:
+            first_preview = time() - t_start
+    return first_preview, time() - t_start, im_hat
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',   type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-i', '--image',   type=str, default=None)
+    parser.add_argument('-l', '--lmb',     type=float, default=None)
+    parser.add_argument('-k', '--kbps',    type=float, default=[64, 256, 1024], nargs='+')
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.workers is not None:
+        torch.set_num_threads(args.workers)
+    print(f'pytorch = {torch.__version__}, device = {device}, {torch.get_num_threads()} CPU threads')
+
+    kwargs = eval(f'dict({args.kwargs})')
+    model = get_model(args.model, **kwargs)
+    model = model.to(device=device)
+    model.eval()
+    model.compress_mode()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        img_path = args.image
+        if img_path is None:
+            img_paths = sorted(known_datasets['kodak'].rglob('*.*'))
+            if len(img_paths) > 0:
+                img_path = img_paths[0]
+            else: # no dataset available. use a random image
+                img_path = tmp_dir / 'random.png'
+                Image.fromarray(torch.randint(0, 256, (512, 768, 3), dtype=torch.uint8).numpy()).save(img_path)
+        model.compress_file(img_path, tmp_dir / 'image.bits', lmb=args.lmb)
+        data = (tmp_dir / 'image.bits').read_bytes()
+        print(f'{img_path}, {len(data)} bytes')
+        print('--------------------------------')
+
+        for kbps in args.kbps:
+            t_full, im_full = asyncio.run(download_then_decode(model, data, kbps, tmp_dir / 'received.bits'))
+            t_first, t_total, im_stream = asyncio.run(streaming_decode(model, data, kbps))
+            assert torch.equal(im_full, im_stream), 'The streaming decoder should give the same image'
+            print(f'{kbps:.0f} kbps: download-then-decode: {t_full:.3f}s, streaming: '
+                  f'first preview {t_first:.3f}s, total {t_total:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def record_coding_inputs(model, im):
+    """ Run the encoder once and record the (symbols, indexes, means) of every latent block """
+    records = []
+    for block in model.dec_blocks:
+        if not getattr(block, 'is_latent_block', False):
+            continue
+        dg = block.discrete_gaussian
+        def _recording_compress(inputs, indexes, means=None, _dg=dg, **kwargs):
+            records.append((_dg, inputs, indexes, means))
+            return type(_dg).compress(_dg, inputs, indexes, means=means, **kwargs)
+        dg.compress = _recording_compress
+    model.compress(im)
+    for block in model.dec_blocks:
+        if getattr(block, 'is_latent_block', False):
+            del block.discrete_gaussian.compress
+    return records
+
+
+def time_entropy_coding(records, num_streams, repeat):
+    enc_time, dec_time, num_bytes = 0.0, 0.0, 0
+    for _ in range(repeat):
+        for dg, inputs, indexes, means in records:
+            t_start = time()
+            strings = dg.compress_substreams(inputs, indexes, means=means, num_streams=num_streams)
+            t_enc_finish = time()
+            z = dg.decompress_substreams(strings, indexes, means=means)
+            t_dec_finish = time()
+            enc_time += (t_enc_finish - t_start)
+            dec_time += (t_dec_finish - t_enc_finish)
+            num_bytes += sum([len(s) for s in strings[0]])
+    return enc_time / repeat, dec_time / repeat, num_bytes // repeat
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-k', '--streams', type=int, default=[1, 2, 4, 8, 16], nargs='+')
+    parser.add_argument('-s', '--size',    type=int, default=1024)
+    parser.add_argument('-r', '--repeat',  type=int, default=3)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.workers is not None:
+        torch.set_num_threads(args.workers)
+    print(f'pytorch = {torch.__version__}, device = {device}, {torch.get_num_threads()} CPU threads')
+    im = load_images(known_datasets['kodak'], 1, args.size, device=device)[0]
+    print(f'image size {args.size}x{args.size}')
+    print('--------------------------------')
+
+    for name in args.models:
+        kwargs = eval(f'dict({args.kwargs})')
+        model = get_model(name, **kwargs)
+        model = model.to(device=device)
+        model.eval()
+        model.compress_mode()
+
+        print(f'{name}, {type(model)}, device={device}')
+        records = record_coding_inputs(model, im)
+        num_symbols = sum([inputs.numel() for _, inputs, _, _ in records])
+        print(f'{len(records)} latent blocks, {num_symbols} symbols in total')
+        _ = time_entropy_coding(records, num_streams=1, repeat=1) # warm up
+        for k in args.streams:
+            enc_time, dec_time, num_bytes = time_entropy_coding(records, k, args.repeat)
+            msg = f'substreams={k:<3d} entropy encode: {enc_time*1000:.1f} ms, ' \
+                  f'entropy decode: {dec_time*1000:.1f} ms, payload: {num_bytes} bytes'
+            print(msg)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import math
+from time import time
+import torch
+import torch.nn.functional as tnf
+from torch.utils.flop_counter import FlopCounterMode
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def psnr(a, b):
+    mse = torch.mean((a - b) ** 2).item()
+    return -10 * math.log10(mse) if (mse > 0) else float('inf')
+
+
+def decode_full_then_downscale(model, string, d):
+    """ The previous way of making a thumbnail: full-resolution decoding, then downscaling """
+    return tnf.avg_pool2d(model.decompress(string), kernel_size=d)
+
+
+def count_flops(func):
+    with FlopCounterMode(display=False) as counter:
+        func()
+    return counter.get_total_flops()
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',   type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True, thumbnail_heads=True')
+    parser.add_argument('-n', '--num',     type=int, default=4)
+    parser.add_argument('-s', '--size',    type=int, default=512)
+    parser.add_argument('-l', '--lmb',     type=float, default=64)
+    parser.add_argument('-r', '--repeat',  type=int, default=2)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model = model.to(device=device)
+    model.eval()
+    model.requires_grad_(False) # for FlopCounterMode
+    model.compress_mode()
+    ims = torch.cat(load_images(known_datasets['kodak'], args.num, args.size, device=device), dim=0)
+    strings = [model.compress(ims[i:i+1], lmb=args.lmb) for i in range(args.num)]
+
+    print(f'{args.model}, {args.num} images of size {args.size}x{args.size}, lambda={args.lmb}. '
+          f'PSNR is w.r.t. the downscaled original image.')
+    print(f'{"scale":>5s} | {"method":<30s} | {"GFLOPs":>7s} | {"time":>7s} | {"PSNR":>6s}')
+    for d in [1] + sorted(model.thumbnail_points.keys()):
+        methods = [('decompress()', lambda s: model.decompress(s))] if (d == 1) else [
+            ('decompress() + downscale', lambda s: decode_full_then_downscale(model, s, d)),
+            (f'decompress(scale=1/{d})', lambda s: model.decompress(s, scale=1/d)),
+        ]
+        for name, func in methods:
+            flops = count_flops(lambda: func(strings[0]))
+            t_start = time()
+            for _ in range(args.repeat):
+                ims_hat = [func(s) for s in strings]
+            elapsed = (time() - t_start) / args.repeat / args.num
+            targets = tnf.avg_pool2d(ims, kernel_size=d) if (d > 1) else ims
+            _psnr = sum([psnr(im_hat, targets[i:i+1]) for i, im_hat in enumerate(ims_hat)]) / args.num
+            print(f'{"1/"+str(d):>5s} | {name:<30s} | {flops/1e9:>7.2f} | {elapsed:>6.3f}s | {_psnr:>6.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import itertools
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+class LatentRecorder():
+    """ Record the latent variables z of all latent blocks, in both encoding and decoding """
+    def __init__(self, model):
+        self.zs = []
+        for block in model.dec_blocks:
+            if getattr(block, 'is_latent_block', False):
+                block.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, fdict):
+        self.zs.append(fdict['zs'][-1].clone())
+
+    def pop(self):
+        """ Returns the recorded latents as a list (one per latent block) of (N, C, h, w) tensors """
+        zs, self.zs = self.zs, []
+        return zs
+
+
+def encode(model, recorder, ims, lmb, threads):
+    """ Returns the bit strings and the latents used by the encoder """
+    torch.set_num_threads(threads)
+    strings = [model.compress(ims[i:i+1], lmb=lmb) for i in range(ims.shape[0])]
+    zs = recorder.pop()
+    num = len(zs) // ims.shape[0]
+    zs = [torch.cat(zs[k::num], dim=0) for k in range(num)]
+    return strings, zs
+
+
+def decode(model, recorder, strings, threads, batch):
+    """ Returns the decoded latents and the decoding time """
+    torch.set_num_threads(threads)
+    t_start = time()
+    if batch:
+        model.decompress_batch(strings)
+    else:
+        for s in strings:
+            model.decompress(s)
+    elapsed = time() - t_start
+    zs = recorder.pop()
+    num = len(zs) if batch else len(zs) // len(strings)
+    zs = zs if batch else [torch.cat(zs[k::num], dim=0) for k in range(num)]
+    return zs, elapsed
+
+
+def compare(zs_dec, zs_enc):
+    """ Number of latent elements that differ from the encoder's, and the number of them that \
+        differ by more than 0.5, i.e., the decoded symbol is wrong (mis-decoded bit string).
+    """
+    num_diff, num_wrong = 0, 0
+    for z_dec, z_enc in zip(zs_dec, zs_enc):
+        diff = (z_dec - z_enc).abs()
+        num_diff += int((diff > 0).sum())
+        num_wrong += int((diff > 0.5).sum())
+    return num_diff, num_wrong
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',     type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs',    type=str, default='pretrained=True')
+    parser.add_argument('-n', '--num',       type=int, default=8)
+    parser.add_argument('-s', '--size',      type=int, default=256)
+    parser.add_argument('-l', '--lmb',       type=float, default=64)
+    parser.add_argument('-t', '--threads',   type=int, default=[1, 2, 4, 8], nargs='+')
+    parser.add_argument('-f', '--frac_bits', type=int, default=8)
+    parser.add_argument('-d', '--device',    type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model = model.to(device=device)
+    model.eval()
+    model.compress_mode()
+    ims = torch.cat(load_images(known_datasets['kodak'], args.num, args.size, device=device), dim=0)
+    num_threads = torch.get_num_threads()
+
+    recorder = LatentRecorder(model)
+    print(f'{args.model}, {args.num} images of size {args.size}x{args.size}, lambda={args.lmb}')
+    print('diff: latent elements that are not bit-identical to the encoder. '
+          'wrong: latent elements with a wrong symbol, i.e., the bit string is mis-decoded.')
+    for frac_bits in [None, args.frac_bits]:
+        model.set_fixed_point_prior(frac_bits)
+        mode = 'float prior' if frac_bits is None else f'fixed-point prior, {frac_bits=}'
+        print(f'\n{mode}')
+        print(f'{"encoder threads":>15s} | {"decoder threads":>15s} | {"batch":>5s} | {"bytes":>8s} | '
+              f'{"diff":>9s} | {"wrong":>9s} | {"dec time":>8s}')
+        for enc_threads in args.threads:
+            strings, zs_enc = encode(model, recorder, ims, args.lmb, enc_threads)
+            num_bytes = sum([len(s) for s in strings])
+            for dec_threads, batch in itertools.product(args.threads, [False, True]):
+                zs_dec, dec_time = decode(model, recorder, strings, dec_threads, batch)
+                num_diff, num_wrong = compare(zs_dec, zs_enc)
+                print(f'{enc_threads:>15d} | {dec_threads:>15d} | {str(batch):>5s} | {num_bytes:>8d} | '
+                      f'{num_diff:>9d} | {num_wrong:>9d} | {dec_time:>7.3f}s')
+    torch.set_num_threads(num_threads)
+
+
+if __name__ == '__main__':
+    main()
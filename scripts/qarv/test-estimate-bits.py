@@ -0,0 +1,68 @@
+import argparse
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+class LatentRecorder():
+    """ Record the latent variables z of all latent blocks """
+    def __init__(self, model):
+        self.zs = []
+        for block in model.dec_blocks:
+            if getattr(block, 'is_latent_block', False):
+                block.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, fdict):
+        self.zs.append(fdict['zs'][-1].clone())
+
+    def pop(self):
+        zs, self.zs = self.zs, []
+        return zs
+
+
+@torch.no_grad()
+def main():
+    """ `estimate_bits()` should use the same latents as `compress()`, including with the \
+        fixed-point prior, and its estimate should be close to the real size.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',     type=str,   default='qarv_base')
+    parser.add_argument('-a', '--kwargs',    type=str,   default='pretrained=True')
+    parser.add_argument('-n', '--num',       type=int,   default=4)
+    parser.add_argument('-s', '--size',      type=int,   default=256)
+    parser.add_argument('-l', '--lmb',       type=float, default=64)
+    parser.add_argument('-f', '--frac_bits', type=int,   default=8)
+    parser.add_argument('--tol',             type=float, default=0.05, help='max relative error of the estimate')
+    parser.add_argument('-d', '--device',    type=str,   default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(args.model, **eval(f'dict({args.kwargs})')).to(device=device)
+    model.eval()
+    model.compress_mode()
+    ims = load_images(known_datasets['kodak'], args.num, args.size, device=device)
+    recorder = LatentRecorder(model)
+
+    for frac_bits in [None, args.frac_bits]:
+        model.set_fixed_point_prior(frac_bits)
+        num_diff, est_bits, real_bits = 0, 0.0, 0
+        for im in ims:
+            est_bits += model.estimate_bits(im, lmbs=args.lmb).item()
+            zs_est = recorder.pop()
+            string = model.compress(im, lmb=args.lmb)
+            zs_enc = recorder.pop()
+            real_bits += sum([len(s) for s in model._parse_string(string)['strings']]) * 8
+            num_diff += sum([int((a != b).sum()) for a, b in zip(zs_est, zs_enc)])
+        error = (est_bits - real_bits) / real_bits
+        mode = 'float prior' if frac_bits is None else f'fixed-point prior, {frac_bits=}'
+        print(f'{mode}: {num_diff} latent elements differ from compress(), estimated {est_bits:.0f} bits, '
+              f'real {real_bits} bits (latent strings only), error {error*100:.2f}%')
+        assert num_diff == 0, f'{mode}: estimate_bits() uses different latents from compress()'
+        assert abs(error) <= args.tol, f'{mode}: the estimate is off by {error*100:.2f}%'
+    print('Passed.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import argparse
+import torch
+
+from lvae.models.registry import get_model
+from lvae.models.qarv.distill import Distillation
+import lvae.models.mlp_pruning as pruning
+
+
+def trainable(model):
+    """ (number of trainable parameters, total number of parameters) """
+    num = sum([p.numel() for p in model.parameters() if p.requires_grad])
+    return num, sum([p.numel() for p in model.parameters()])
+
+
+def main():
+    """ The fine-tuning in `prune-mlp.py` backs off the ratio and compresses the original model \
+        again, after the original model has been frozen as the teacher of the previous attempt. \
+        Check that the student is fully trainable in every attempt.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',  type=str,   default='qarv_base')
+    parser.add_argument('-a', '--kwargs', type=str,   default='pretrained=False')
+    parser.add_argument('--method',       type=str,   default='prune', choices=['prune', 'lowrank'])
+    parser.add_argument('--ratio',        type=float, default=0.5)
+    parser.add_argument('--backoff',      type=float, default=0.75)
+    parser.add_argument('--tries',        type=int,   default=3)
+    args = parser.parse_args()
+
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    model.eval()
+    # random scores, as the calibration is irrelevant to this test
+    scores = {name: torch.rand(block.mlp.fc1.out_features) for name, block in pruning.mlp_blocks(model)}
+
+    ratio = args.ratio
+    for i in range(args.tries):
+        student, summary = pruning.compressed_copy(model, args.method, ratio, scores)
+        Distillation(model, student) # freezes the teacher, i.e., the original model
+        num, total = trainable(student)
+        print(f'attempt {i}: ratio={ratio:.4f}, {len(summary)} layers changed, '
+              f'{num:,} of {total:,} student parameters trainable')
+        assert num == total, f'attempt {i}: the student is not fully trainable'
+        assert trainable(model)[0] == 0, 'the teacher is not frozen'
+        ratio = ratio * args.backoff
+    print('Passed.')
+
+
+if __name__ == '__main__':
+    main()
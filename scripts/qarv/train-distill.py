@@ -0,0 +1,145 @@
+import logging
+import argparse
+from PIL import Image
+import torch
+import torchvision.transforms.functional as tvf
+from timm.utils import unwrap_model
+
+from lvae.paths import known_datasets
+from lvae.trainer import BaseTrainingWrapper
+from lvae.models.registry import get_model
+from lvae.models.qarv.distill import Distillation, common_bpp_lambdas, evaluate_rd, bd_rate_over
+from lvae.datasets import get_image_dateset
+
+
+def parse_args():
+    # ====== set the run settings ======
+    parser = argparse.ArgumentParser()
+    # wandb setting
+    parser.add_argument('--wbproject',  type=str,  default='qarv-distill')
+    parser.add_argument('--wbentity',   type=str,  default='prof-zhu-compression')
+    parser.add_argument('--wbgroup',    type=str,  default='distillation')
+    parser.add_argument('--wbtags',     type=str,  default=None, nargs='+')
+    parser.add_argument('--wbnote',     type=str,  default=None)
+    parser.add_argument('--wbmode',     type=str,  default='disabled')
+    parser.add_argument('--name',       type=str,  default=None)
+    # model setting
+    parser.add_argument('--teacher',      type=str,  default='qarv_base')
+    parser.add_argument('--teacher_args', type=str,  default='pretrained=True')
+    parser.add_argument('--model',        type=str,  default='qarv_small')
+    parser.add_argument('--model_args',   type=str,  default='')
+    parser.add_argument('--w_recon',      type=float,default=1.0,
+                        help='weight of the distortion w.r.t. the reconstruction of the teacher')
+    parser.add_argument('--w_stats',      type=float,default=0.1,
+                        help='weight of the MSE of the latent block statistics')
+    # resume setting
+    parser.add_argument('--resume',     type=str,  default=None)
+    parser.add_argument('--weights',    type=str,  default=None)
+    parser.add_argument('--load_optim', action=argparse.BooleanOptionalAction, default=False)
+    # data setting
+    parser.add_argument('--trainset',   type=str,  default='coco-train2017')
+    parser.add_argument('--transform',  type=str,  default='crop=256,hflip=True')
+    parser.add_argument('--valset',     type=str,  default='kodak')
+    parser.add_argument('--val_steps',  type=int,  default=6)
+    # optimization setting
+    parser.add_argument('--batch_size', type=int,  default=16)
+    parser.add_argument('--accum_num',  type=int,  default=1)
+    parser.add_argument('--optimizer',  type=str,  default='adam')
+    parser.add_argument('--lr',         type=float,default=2e-4)
+    parser.add_argument('--lr_sched',   type=str,  default='cosine')
+    parser.add_argument('--lrf_min',    type=float,default=0.01)
+    parser.add_argument('--lr_warmup',  type=int,  default=0)
+    parser.add_argument('--grad_clip',  type=float,default=2.0)
+    # training setting
+    parser.add_argument('--iterations', type=int,  default=1_000_000)
+    parser.add_argument('--eval_first', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--amp',        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--compile',    action=argparse.BooleanOptionalAction, default=False)
+    # exponential moving averaging (EMA)
+    parser.add_argument('--ema',        action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--ema_decay',  type=float,default=0.9999)
+    parser.add_argument('--ema_warmup', type=int,  default=10_000)
+    # device setting
+    parser.add_argument('--fixseed',    action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--workers',    type=int,  default=6)
+    cfg = parser.parse_args()
+
+    # default settings
+    cfg.wdecay = 0.0
+    cfg.wandb_log_interval = 100
+    cfg.model_log_interval = 2000
+    cfg.model_val_interval = 2000
+    return cfg
+
+
+class TrainWrapper(BaseTrainingWrapper):
+    def set_dataset(self):
+        cfg = self.cfg
+
+        logging.info('==== Datasets and Dataloaders ====')
+        trainset = get_image_dateset(cfg.trainset, transform_cfg=cfg.transform)
+        self.make_training_loader(trainset)
+
+        logging.info(f'Training root: {trainset.root}')
+        logging.info(f'Number of training images = {len(trainset)}')
+        logging.info(f'Validation root: {known_datasets[cfg.valset]} \n')
+
+    def set_model(self):
+        cfg = self.cfg
+
+        teacher = get_model(cfg.teacher, **eval(f'dict({cfg.teacher_args})'))
+        kwargs = eval(f'dict({cfg.model_args})')
+        student = get_model(cfg.model, **kwargs)
+        model = Distillation(teacher, student, w_recon=cfg.w_recon, w_stats=cfg.w_stats)
+
+        cfg.num_param = sum([p.numel() for p in student.parameters()])
+        logging.info('==== Model ====')
+        logging.info(f'Teacher = {cfg.teacher}, student = {cfg.model}, args = {kwargs}')
+        logging.info(f'Number of parameters: teacher = {sum([p.numel() for p in teacher.parameters()])/1e6} M, '
+                     f'student = {cfg.num_param/1e6} M \n')
+        self.model = model.to(self.device)
+        self._teacher_rd = None # RD curve of the teacher, computed at the first evaluation
+
+    @torch.no_grad()
+    def eval_model(self, model):
+        """ BD-rate of the student over the teacher on the validation images, used as the loss """
+        teacher, student = model.teacher, model.student
+        ims = []
+        for p in sorted(known_datasets[self.cfg.valset].rglob('*.*')):
+            im = tvf.to_tensor(Image.open(p).convert('RGB')).unsqueeze_(0)
+            div = max(teacher.max_stride, student.max_stride)
+            ims.append(tvf.center_crop(im, [im.shape[2] // div * div, im.shape[3] // div * div]))
+        lambdas = common_bpp_lambdas([teacher, student], steps=self.cfg.val_steps)
+        if self._teacher_rd is None:
+            self._teacher_rd = evaluate_rd(teacher, ims, lambdas)
+        rd = evaluate_rd(student, ims, lambdas)
+        bdr = bd_rate_over(self._teacher_rd, rd)
+        results = {'loss': bdr, 'bd-rate': bdr}
+        for idx in [0, len(lambdas)//2, -1]:
+            lmb = round(lambdas[idx])
+            results.update({
+                f'lmb{lmb}/bpp':  rd['bpp'][idx],
+                f'lmb{lmb}/psnr': rd['psnr'][idx],
+                f'lmb{lmb}/psnr-teacher': self._teacher_rd['psnr'][idx],
+            })
+        return results
+
+    @torch.no_grad()
+    def evaluate(self):
+        super().evaluate()
+        # the student only, which can be loaded by, e.g., `qarv_small(pretrained=path)`
+        student = unwrap_model(self.model).student
+        torch.save({'model': student.state_dict()}, self._log_dir / 'student.pt')
+        if self.cfg.ema:
+            student = self.ema.module.student
+            torch.save({'model': student.state_dict()}, self._log_dir / 'student_ema.pt')
+
+
+def main():
+    cfg = parse_args()
+    trainer = TrainWrapper(cfg)
+    trainer.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import math
+import logging
+import argparse
+from collections import OrderedDict, defaultdict
+from PIL import Image
+import torch
+import torch.nn as nn
+import torchvision.transforms.functional as tvf
+from timm.utils import unwrap_model
+
+from lvae.paths import known_datasets
+from lvae.trainer import BaseTrainingWrapper
+from lvae.models.registry import get_model
+from lvae.models.qarv.model import mse_loss
+from lvae.datasets import get_image_dateset
+
+
+def parse_args():
+    # ====== set the run settings ======
+    parser = argparse.ArgumentParser()
+    # wandb setting
+    parser.add_argument('--wbproject',  type=str,  default='qarv-fastdec')
+    parser.add_argument('--wbentity',   type=str,  default='prof-zhu-compression')
+    parser.add_argument('--wbgroup',    type=str,  default='tail-distillation')
+    parser.add_argument('--wbtags',     type=str,  default=None, nargs='+')
+    parser.add_argument('--wbnote',     type=str,  default=None)
+    parser.add_argument('--wbmode',     type=str,  default='disabled')
+    parser.add_argument('--name',       type=str,  default=None)
+    # model setting
+    parser.add_argument('--teacher',      type=str,  default='qarv_base')
+    parser.add_argument('--teacher_args', type=str,  default='pretrained=True')
+    parser.add_argument('--model',        type=str,  default='qarv_base_fastdec')
+    parser.add_argument('--model_args',   type=str,  default='pretrained=True')
+    parser.add_argument('--alpha',        type=float,default=0.1,
+                        help='weight of the distortion w.r.t. the image, relative to that w.r.t. the teacher')
+    # resume setting
+    parser.add_argument('--resume',     type=str,  default=None)
+    parser.add_argument('--weights',    type=str,  default=None)
+    parser.add_argument('--load_optim', action=argparse.BooleanOptionalAction, default=False)
+    # data setting
+    parser.add_argument('--trainset',   type=str,  default='coco-train2017')
+    parser.add_argument('--transform',  type=str,  default='crop=256,hflip=True')
+    parser.add_argument('--valset',     type=str,  default='kodak')
+    parser.add_argument('--val_steps',  type=int,  default=4)
+    # optimization setting
+    parser.add_argument('--batch_size', type=int,  default=16)
+    parser.add_argument('--accum_num',  type=int,  default=1)
+    parser.add_argument('--optimizer',  type=str,  default='adam')
+    parser.add_argument('--lr',         type=float,default=2e-4)
+    parser.add_argument('--lr_sched',   type=str,  default='cosine')
+    parser.add_argument('--lrf_min',    type=float,default=0.01)
+    parser.add_argument('--lr_warmup',  type=int,  default=0)
+    parser.add_argument('--grad_clip',  type=float,default=2.0)
+    # training setting
+    parser.add_argument('--iterations', type=int,  default=200_000)
+    parser.add_argument('--eval_first', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--amp',        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--compile',    action=argparse.BooleanOptionalAction, default=False)
+    # exponential moving averaging (EMA)
+    parser.add_argument('--ema',        action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--ema_decay',  type=float,default=0.999)
+    parser.add_argument('--ema_warmup', type=int,  default=1_000)
+    # device setting
+    parser.add_argument('--fixseed',    action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--workers',    type=int,  default=6)
+    cfg = parser.parse_args()
+
+    # default settings
+    cfg.wdecay = 0.0
+    cfg.wandb_log_interval = 100
+    cfg.model_log_interval = 2000
+    cfg.model_val_interval = 2000
+    return cfg
+
+
+class TailDistillation(nn.Module):
+    """ Train the synthesis tail (the blocks after `CompresionStopFlag`) of a student to \
+        match the reconstructions of a teacher, given the same quantized top-down features. \
+        The teacher is frozen and stays in eval mode, and only the tail of the student is kept.
+    """
+    def __init__(self, teacher, student, alpha=0.1):
+        super().__init__()
+        num_shared = len(teacher.dec_blocks) - len(teacher.synthesis_tail)
+        assert len(student.dec_blocks) - len(student.synthesis_tail) == num_shared, \
+            'The student and the teacher should share the blocks up to the stop flag'
+        self.teacher = teacher
+        for p in teacher.parameters():
+            p.requires_grad_(False)
+        self.tail = student.synthesis_tail
+        self.alpha = alpha
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.teacher.eval()
+        return self
+
+    def forward(self, im, lmb=None):
+        teacher = self.teacher
+        im = im.to(teacher._dummy.device)
+        nB = im.shape[0]
+        lmb = teacher.sample_lmb(n=nB) if (lmb is None) else teacher.expand_to_tensor(lmb, n=nB)
+        with torch.no_grad():
+            # the same features as in decompression
+            fdict = teacher.forward_end2end(im, lmb, mode='estimate')
+            x_teacher = teacher.forward_tail(fdict['feature'], fdict['lmb_emb'])
+            x_target = teacher.preprocess_target(im)
+        x_hat = teacher.forward_tail(fdict['feature'], fdict['lmb_emb'], tail=self.tail)
+        d_teacher = mse_loss(x_hat, x_teacher) # (B,)
+        d_image = mse_loss(x_hat, x_target) # (B,)
+        # the same weighting of the distortion as in the rate-distortion loss of the teacher
+        loss = lmb * (d_teacher + self.alpha * d_image)
+
+        metrics = OrderedDict()
+        metrics['loss'] = loss.mean(0)
+        with torch.no_grad():
+            _psnr = lambda x: -10 * math.log10(mse_loss(teacher.process_output(x.detach()), im).mean().item())
+            metrics['psnr'] = _psnr(x_hat)
+            metrics['psnr-teacher'] = _psnr(x_teacher)
+            # pixel values in (-1, 1), so the mse in (0, 1) is 1/4 of it
+            metrics['psnr-to-teacher'] = -10 * math.log10(d_teacher.mean().item() / 4)
+        return metrics
+
+
+class TrainWrapper(BaseTrainingWrapper):
+    def set_dataset(self):
+        cfg = self.cfg
+
+        logging.info('==== Datasets and Dataloaders ====')
+        trainset = get_image_dateset(cfg.trainset, transform_cfg=cfg.transform)
+        self.make_training_loader(trainset)
+
+        logging.info(f'Training root: {trainset.root}')
+        logging.info(f'Number of training images = {len(trainset)}')
+        logging.info(f'Validation root: {known_datasets[cfg.valset]} \n')
+
+    def set_model(self):
+        cfg = self.cfg
+
+        teacher = get_model(cfg.teacher, **eval(f'dict({cfg.teacher_args})'))
+        kwargs = eval(f'dict({cfg.model_args})')
+        student = get_model(cfg.model, **kwargs)
+        model = TailDistillation(teacher, student, alpha=cfg.alpha)
+
+        cfg.num_param = sum([p.numel() for p in model.parameters() if p.requires_grad])
+        logging.info('==== Model ====')
+        logging.info(f'Teacher = {cfg.teacher}, student = {cfg.model}, args = {kwargs}')
+        logging.info(f'Number of parameters of the tail: teacher = '
+                     f'{sum([p.numel() for p in teacher.synthesis_tail.parameters()])/1e6} M, '
+                     f'student = {cfg.num_param/1e6} M \n')
+        self.model = model.to(self.device)
+
+    @torch.no_grad()
+    def eval_model(self, model):
+        """ Average loss and PSNR over the validation images and `val_steps` lambdas """
+        teacher = model.teacher
+        img_paths = sorted(known_datasets[self.cfg.valset].rglob('*.*'))
+        low, high = teacher.lmb_range
+        lambdas = torch.linspace(math.log(low), math.log(high), steps=self.cfg.val_steps).exp().tolist()
+        stats = defaultdict(float)
+        for p in img_paths:
+            im = tvf.to_tensor(Image.open(p).convert('RGB')).unsqueeze_(0)
+            div = teacher.max_stride
+            im = tvf.center_crop(im, [im.shape[2] // div * div, im.shape[3] // div * div])
+            for lmb in lambdas:
+                metrics = model(im, lmb=lmb)
+                for k, v in metrics.items():
+                    stats[k] += float(v)
+        return {k: v / (len(img_paths) * len(lambdas)) for k, v in stats.items()}
+
+    @torch.no_grad()
+    def evaluate(self):
+        super().evaluate()
+        # the tail only, which can be loaded by, e.g., `qarv_base_fastdec(tail=path)`
+        tail = unwrap_model(self.model).tail
+        torch.save({'tail': tail.state_dict()}, self._log_dir / 'tail.pt')
+        if self.cfg.ema:
+            tail = self.ema.module.tail
+            torch.save({'tail': tail.state_dict()}, self._log_dir / 'tail_ema.pt')
+
+
+def main():
+    cfg = parse_args()
+    trainer = TrainWrapper(cfg)
+    trainer.main()
+
+
+if __name__ == '__main__':
+    main()
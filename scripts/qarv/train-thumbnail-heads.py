@@ -0,0 +1,156 @@
+import math
+import logging
+import argparse
+from collections import defaultdict
+from PIL import Image
+import torch
+import torch.nn as nn
+import torchvision.transforms.functional as tvf
+from timm.utils import unwrap_model
+
+from lvae.paths import known_datasets
+from lvae.trainer import BaseTrainingWrapper
+from lvae.models.registry import get_model
+from lvae.datasets import get_image_dateset
+
+
+def parse_args():
+    # ====== set the run settings ======
+    parser = argparse.ArgumentParser()
+    # wandb setting
+    parser.add_argument('--wbproject',  type=str,  default='qarv-thumbnails')
+    parser.add_argument('--wbentity',   type=str,  default='prof-zhu-compression')
+    parser.add_argument('--wbgroup',    type=str,  default='thumbnail-heads')
+    parser.add_argument('--wbtags',     type=str,  default=None, nargs='+')
+    parser.add_argument('--wbnote',     type=str,  default=None)
+    parser.add_argument('--wbmode',     type=str,  default='disabled')
+    parser.add_argument('--name',       type=str,  default=None)
+    # model setting
+    parser.add_argument('--model',      type=str,  default='qarv_base')
+    parser.add_argument('--model_args', type=str,  default='pretrained=True, thumbnail_heads=True')
+    # resume setting
+    parser.add_argument('--resume',     type=str,  default=None)
+    parser.add_argument('--weights',    type=str,  default=None)
+    parser.add_argument('--load_optim', action=argparse.BooleanOptionalAction, default=False)
+    # data setting
+    parser.add_argument('--trainset',   type=str,  default='coco-train2017')
+    parser.add_argument('--transform',  type=str,  default='crop=256,hflip=True')
+    parser.add_argument('--valset',     type=str,  default='kodak')
+    parser.add_argument('--val_steps',  type=int,  default=4)
+    # optimization setting
+    parser.add_argument('--batch_size', type=int,  default=16)
+    parser.add_argument('--accum_num',  type=int,  default=1)
+    parser.add_argument('--optimizer',  type=str,  default='adam')
+    parser.add_argument('--lr',         type=float,default=2e-4)
+    parser.add_argument('--lr_sched',   type=str,  default='cosine')
+    parser.add_argument('--lrf_min',    type=float,default=0.01)
+    parser.add_argument('--lr_warmup',  type=int,  default=0)
+    parser.add_argument('--grad_clip',  type=float,default=2.0)
+    # training setting
+    parser.add_argument('--iterations', type=int,  default=50_000)
+    parser.add_argument('--eval_first', action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--amp',        action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--compile',    action=argparse.BooleanOptionalAction, default=False)
+    # exponential moving averaging (EMA)
+    parser.add_argument('--ema',        action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--ema_decay',  type=float,default=0.999)
+    parser.add_argument('--ema_warmup', type=int,  default=1_000)
+    # device setting
+    parser.add_argument('--fixseed',    action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--workers',    type=int,  default=6)
+    cfg = parser.parse_args()
+
+    # default settings
+    cfg.wdecay = 0.0
+    cfg.wandb_log_interval = 100
+    cfg.model_log_interval = 2000
+    cfg.model_val_interval = 2000
+    return cfg
+
+
+class ThumbnailHeadsOnly(nn.Module):
+    """ Train only the thumbnail heads of a model. All other weights are frozen, and the \
+        top-down path stays in eval mode, i.e., the heads are trained on quantized latents, \
+        the same as in decompression.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        for p in model.parameters():
+            p.requires_grad_(False)
+        for p in model.thumbnail_heads.parameters():
+            p.requires_grad_(True)
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.model.eval()
+        self.model.thumbnail_heads.train(mode)
+        return self
+
+    def forward(self, im):
+        return self.model.forward_thumbnails(im)
+
+
+class TrainWrapper(BaseTrainingWrapper):
+    def set_dataset(self):
+        cfg = self.cfg
+
+        logging.info('==== Datasets and Dataloaders ====')
+        trainset = get_image_dateset(cfg.trainset, transform_cfg=cfg.transform)
+        self.make_training_loader(trainset)
+
+        logging.info(f'Training root: {trainset.root}')
+        logging.info(f'Number of training images = {len(trainset)}')
+        logging.info(f'Validation root: {known_datasets[cfg.valset]} \n')
+
+    def set_model(self):
+        cfg = self.cfg
+
+        kwargs = eval(f'dict({cfg.model_args})')
+        model = get_model(cfg.model, **kwargs)
+        assert len(model.thumbnail_heads) > 0, f'{cfg.model} with {kwargs} has no thumbnail heads'
+        model = ThumbnailHeadsOnly(model)
+
+        cfg.num_param = sum([p.numel() for p in model.parameters() if p.requires_grad])
+        logging.info('==== Model ====')
+        logging.info(f'Model name = {cfg.model}, args = {kwargs}')
+        logging.info(f'Number of learnable parameters (thumbnail heads) = {cfg.num_param/1e6} M \n')
+        self.model = model.to(self.device)
+
+    @torch.no_grad()
+    def eval_model(self, model):
+        """ Average loss and thumbnail PSNR over the validation images and `val_steps` lambdas """
+        model = model.model
+        img_paths = sorted(known_datasets[self.cfg.valset].rglob('*.*'))
+        low, high = model.lmb_range
+        lambdas = torch.linspace(math.log(low), math.log(high), steps=self.cfg.val_steps).exp().tolist()
+        stats = defaultdict(float)
+        for p in img_paths:
+            im = tvf.to_tensor(Image.open(p).convert('RGB')).unsqueeze_(0)
+            div = model.max_stride
+            im = tvf.center_crop(im, [im.shape[2] // div * div, im.shape[3] // div * div])
+            for lmb in lambdas:
+                metrics = model.forward_thumbnails(im, lmb=lmb)
+                for k, v in metrics.items():
+                    stats[k] += float(v)
+        return {k: v / (len(img_paths) * len(lambdas)) for k, v in stats.items()}
+
+    @torch.no_grad()
+    def evaluate(self):
+        super().evaluate()
+        # the heads only, which can be loaded by, e.g., `qarv_base(thumbnail_heads=path)`
+        heads = unwrap_model(self.model).model.thumbnail_heads
+        torch.save({'thumbnail_heads': heads.state_dict()}, self._log_dir / 'thumbnail_heads.pt')
+        if self.cfg.ema:
+            heads = self.ema.module.model.thumbnail_heads
+            torch.save({'thumbnail_heads': heads.state_dict()}, self._log_dir / 'thumbnail_heads_ema.pt')
+
+
+def main():
+    cfg = parse_args()
+    trainer = TrainWrapper(cfg)
+    trainer.main()
+
+
+if __name__ == '__main__':
+    main()
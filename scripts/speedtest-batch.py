@@ -0,0 +1,76 @@
+import argparse
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def speedtest(model, ims, batch_size):
+    cuda_sync = torch.cuda.is_available()
+    variable_rate = hasattr(model, 'lmb_range')
+    if variable_rate: # each image has its own lambda
+        low, high = model.lmb_range
+        lmbs = torch.linspace(low, high, steps=ims.shape[0])
+
+    encode_time, decode_time = 0.0, 0.0
+    for i in range(0, ims.shape[0], batch_size):
+        batch = ims[i:i+batch_size]
+        t_start = time()
+        if variable_rate:
+            strings = model.compress_batch(batch, lmbs[i:i+batch_size])
+        else:
+            strings = model.compress_batch(batch)
+        if cuda_sync:
+            torch.cuda.synchronize()
+        t_enc_finish = time()
+        output = model.decompress_batch(strings)
+        if cuda_sync:
+            torch.cuda.synchronize()
+        t_dec_finish = time()
+
+        encode_time += (t_enc_finish - t_start)
+        decode_time += (t_dec_finish - t_enc_finish)
+    return encode_time, decode_time
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-b', '--batch',   type=int, default=[1, 4, 16], nargs='+')
+    parser.add_argument('-n', '--num',     type=int, default=32)
+    parser.add_argument('-s', '--size',    type=int, default=256)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.workers is not None:
+        torch.set_num_threads(args.workers)
+    print(f'pytorch = {torch.__version__}, device = {device}, {torch.get_num_threads()} CPU threads')
+    ims = torch.cat(load_images(known_datasets['kodak'], args.num, args.size, repeat=True, device=device), dim=0)
+    print(f'{args.num} images of size {args.size}x{args.size}')
+    print('--------------------------------')
+
+    for name in args.models:
+        kwargs = eval(f'dict({args.kwargs})')
+        model = get_model(name, **kwargs)
+        model = model.to(device=device)
+        model.eval()
+        model.compress_mode()
+
+        print(f'{name}, {type(model)}, device={device}')
+        _ = speedtest(model, ims[:2], batch_size=2) # warm up
+        for bs in args.batch:
+            enc_time, dec_time = speedtest(model, ims, batch_size=bs)
+            msg = f'batch={bs:<3d} encode: {args.num/enc_time:.2f} img/s, ' \
+                  f'decode: {args.num/dec_time:.2f} img/s'
+            print(msg)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import argparse
+from time import time
+import torch
+from compressai.entropy_models import GaussianConditional
+
+from lvae.models.registry import get_model
+import lvae.models.entropy_coding as entropy_coding
+
+
+def record_scales(model, im):
+    """ Compress once and record the (entropy model, scales) of every `build_indexes()` call """
+    records = []
+    _build_indexes = entropy_coding.build_indexes
+    def _recording_build_indexes(entropy_model, scales):
+        records.append((entropy_model, scales))
+        return _build_indexes(entropy_model, scales)
+    entropy_coding.build_indexes = _recording_build_indexes
+    try:
+        model.compress(im)
+    finally:
+        entropy_coding.build_indexes = _build_indexes
+    return records
+
+
+def table_bytes(model):
+    """ Total and unique (i.e., not shared) bytes of the CDF tables of all entropy models """
+    total, unique = 0, dict()
+    for module in model.modules():
+        if not isinstance(module, GaussianConditional):
+            continue
+        for t in (module._quantized_cdf, module._offset, module._cdf_length):
+            num_bytes = t.numel() * t.element_size()
+            total += num_bytes
+            unique[t.data_ptr()] = num_bytes
+    return total, sum(unique.values())
+
+
+def time_func(func, records, repeat):
+    t_start = time()
+    for _ in range(repeat):
+        outputs = [func(em, scales) for em, scales in records]
+    return (time() - t_start) / repeat, outputs
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base', 'qres34m', 'qres34m_lossless'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-s', '--size',    type=int, default=1024)
+    parser.add_argument('-r', '--repeat',  type=int, default=5)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for name in args.models:
+        model = get_model(name, **eval(f'dict({args.kwargs})'))
+        model = model.to(device=device)
+        model.eval()
+        model.compress_mode()
+
+        im = torch.rand(1, 3, args.size, args.size, device=device)
+        records = record_scales(model, im)
+        t_old, old = time_func(GaussianConditional.build_indexes, records, args.repeat)
+        t_new, new = time_func(entropy_coding.build_indexes, records, args.repeat)
+        assert all([torch.equal(a, b) for a, b in zip(old, new)]), 'The indexes should be identical'
+        total, unique = table_bytes(model)
+        table_sizes = sorted(set([len(em.scale_table) for em, _ in records]))
+        print(f'{name}: {len(records)} calls, scale table sizes {table_sizes}. '
+              f'build_indexes {t_old*1000:.1f} ms -> {t_new*1000:.1f} ms. '
+              f'CDF tables {total/1024:.1f} KB -> {unique/1024:.1f} KB (shared)')
+
+
+if __name__ == '__main__':
+    main()
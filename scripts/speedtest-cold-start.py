@@ -0,0 +1,81 @@
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import time
+import torch
+import torchvision.transforms.functional as tvf
+
+from lvae.models.registry import get_model
+
+
+def load_model(name, kwargs):
+    torch.manual_seed(0) # such that the same weights are used when `pretrained=False`
+    model = get_model(name, **eval(f'dict({kwargs})'))
+    model.eval()
+    return model
+
+
+@torch.no_grad()
+def worker(args):
+    """ Time a fresh process from `get_model()` to its first decoded image """
+    t_start = time()
+    model = load_model(args.model, args.kwargs)
+    t_model = time()
+    cdf_tables = args.cdf_tables if args.cdf_tables else False
+    model.compress_mode(True, cdf_tables=cdf_tables)
+    t_update = time()
+    im = model.decompress_file(args.bits_path)
+    t_end = time()
+    assert im.dim() == 4
+    print(json.dumps({'get_model': t_model - t_start, 'compress_mode': t_update - t_model,
+                      'decode': t_end - t_update, 'total': t_end - t_start}))
+
+
+def run_worker(args, bits_path, cdf_tables):
+    cmd = [sys.executable, __file__, '--worker', '-m', args.model, '-a', args.kwargs,
+           '--bits_path', str(bits_path), '--cdf_tables', str(cdf_tables or '')]
+    output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',      type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs',     type=str, default='pretrained=True')
+    parser.add_argument('-s', '--size',       type=int, default=512)
+    parser.add_argument('-r', '--repeat',     type=int, default=3)
+    parser.add_argument('--worker',           action='store_true')
+    parser.add_argument('--bits_path',        type=str, default=None)
+    parser.add_argument('--cdf_tables',       type=str, default='')
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        img_path, bits_path = tmp_dir / 'image.png', tmp_dir / 'image.bits'
+        tvf.to_pil_image(torch.rand(3, args.size, args.size)).save(img_path)
+        model = load_model(args.model, args.kwargs)
+        model.compress_mode(True, cdf_tables=False)
+        model.compress_file(img_path, bits_path)
+        del model
+
+        table_path = tmp_dir / 'cdf-tables.pt'
+        run_worker(args, bits_path, table_path) # the first run computes and saves the tables
+        print(f'{args.model}, image size {args.size}x{args.size}, CDF tables file: '
+              f'{table_path.stat().st_size/1024:.1f} KB')
+        print(f'{"CDF tables":<10s} | {"get_model":>9s} | {"compress_mode":>13s} | {"decode":>7s} | {"total":>7s}')
+        for name, cdf_tables in [('computed', None), ('persisted', table_path)]:
+            results = [run_worker(args, bits_path, cdf_tables) for _ in range(args.repeat)]
+            mean = {k: sum([r[k] for r in results]) / len(results) for k in results[0].keys()}
+            print(f'{name:<10s} | {mean["get_model"]:>8.3f}s | {mean["compress_mode"]:>12.3f}s | '
+                  f'{mean["decode"]:>6.3f}s | {mean["total"]:>6.3f}s')
+
+
+if __name__ == '__main__':
+    main()
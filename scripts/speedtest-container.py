@@ -0,0 +1,85 @@
+import argparse
+import pickle
+import struct
+from time import time
+import torch
+import torchvision.transforms.functional as tvf
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+
+
+def legacy_string(model, string):
+    """ The same payload, in the format used before the container was introduced """
+    if hasattr(model, 'lmb_range'): # qarv: image size, lambda, shape, and pack_byte_strings()
+        info = container.unpack(string)
+        header = struct.pack('2H', *info['img_hw']) + struct.pack('f', info['lmb'])
+        header += struct.pack('3H', 1, *info['grid_hw'])
+        return header + coding.pack_byte_strings([bytes(s) for s in info['strings']])
+    else: # qresvae: pickled object
+        obj, img_hw = model.unpack(string)
+        return pickle.dumps(obj + [img_hw])
+
+
+def legacy_parse(model, string):
+    if hasattr(model, 'lmb_range'):
+        struct.unpack('2H', string[:4])
+        return model._parse_string(string[4:])
+    else:
+        return pickle.loads(string)
+
+
+def time_parse(func, strings, repeat):
+    t_start = time()
+    for _ in range(repeat):
+        for s in strings:
+            func(s)
+    return (time() - t_start) / (repeat * len(strings))
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base', 'qres34m'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-n', '--num',     type=int, default=24)
+    parser.add_argument('-r', '--repeat',  type=int, default=100)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    for name in args.models:
+        kwargs = eval(f'dict({args.kwargs})')
+        model = get_model(name, **kwargs)
+        model = model.to(device=device)
+        model.eval()
+        model.compress_mode()
+        print(f'{name}, {type(model)}, device={device}')
+
+        for case, size in [('kodak', None), ('64x64', 64)]:
+            strings = []
+            for im in load_images(known_datasets['kodak'], args.num, size, repeat=True):
+                img = tvf.to_pil_image(im[0])
+                img_padded = coding.pad_divisible_by(img, div=model.max_stride)
+                im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
+                if hasattr(model, 'lmb_range'):
+                    s = model.compress_batch(im, img_hws=[(img.height, img.width)])[0]
+                else:
+                    s = model.pack(model.compress(im), img_hw=(img.height, img.width))
+                strings.append(s)
+            legacy = [legacy_string(model, s) for s in strings]
+            new_bytes = sum([len(s) for s in strings]) / len(strings)
+            old_bytes = sum([len(s) for s in legacy]) / len(legacy)
+            t_new = time_parse(container.unpack, strings, args.repeat)
+            t_old = time_parse(lambda s: legacy_parse(model, s), legacy, args.repeat)
+            print(f'{case:<6s}: legacy {old_bytes:.1f} bytes/img, container {new_bytes:.1f} bytes/img, '
+                  f'saved {old_bytes - new_bytes:.1f} bytes/img ({(1-new_bytes/old_bytes)*100:.2f}%). '
+                  f'parse time: legacy {t_old*1e6:.1f} us, container {t_new*1e6:.1f} us')
+        print()
+
+
+if __name__ == '__main__':
+    main()
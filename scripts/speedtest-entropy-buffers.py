@@ -0,0 +1,93 @@
+import argparse
+import tracemalloc
+from time import time
+from PIL import Image
+import torch
+import torchvision.transforms.functional as tvf
+from compressai.entropy_models import GaussianConditional
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+import lvae.models.entropy_coding as entropy_coding
+
+
+def load_image(size, div):
+    """ Load a center-cropped Kodak image (upsampled if needed), or a random image if Kodak \
+        is not available
+    """
+    img_paths = sorted(known_datasets['kodak'].rglob('*.*'))
+    if len(img_paths) > 0:
+        img = Image.open(img_paths[0]).convert('RGB')
+        img = tvf.resize(img, size=size) if (min(img.height, img.width) < size) else img
+        im = tvf.to_tensor(tvf.center_crop(img, output_size=size))
+    else:
+        im = torch.rand(3, size, size)
+    size = size // div * div
+    return im[:, :size, :size].unsqueeze_(0)
+
+
+def record_coding_inputs(model, im):
+    """ Compress once and record the (entropy model, inputs, indexes, means) of every call """
+    records = []
+    _compress_buffers = entropy_coding.compress_buffers
+    def _recording_compress(entropy_model, inputs, indexes, means=None):
+        records.append((entropy_model, inputs, indexes, means))
+        return _compress_buffers(entropy_model, inputs, indexes, means=means)
+    entropy_coding.compress_buffers = _recording_compress
+    try:
+        model.compress(im)
+    finally:
+        entropy_coding.compress_buffers = _compress_buffers
+    return records
+
+
+def measure(func, *args, **kwargs):
+    """ Returns the output, time, and the peak memory allocated by Python """
+    tracemalloc.start()
+    t_start = time()
+    output = func(*args, **kwargs)
+    elapsed = time() - t_start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return output, elapsed, peak
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base', 'qres34m'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-s', '--size',    type=int, default=2048)
+    args = parser.parse_args()
+
+    print('Note: the rANS coder of compressai takes list[int], so the buffers are still converted '
+          'to Python ints element by element, and the decoder returns a list. The buffer path saves '
+          'the list construction and its peak memory, not the per-symbol conversion.')
+    for name in args.models:
+        model = get_model(name, **eval(f'dict({args.kwargs})'))
+        model.eval()
+        model.compress_mode()
+        im = load_image(args.size, div=model.max_stride)
+        print(f'{name}, image size {tuple(im.shape[2:])}')
+        print(f'{"block":>5s} {"symbols":>9s} | {"enc ms (list / buffer)":>24s} | {"enc peak MB":>15s} | '
+              f'{"dec ms (list / buffer)":>24s} | {"dec peak MB":>15s}')
+        totals = [0.0] * 4
+        for i, (dg, inputs, indexes, means) in enumerate(record_coding_inputs(model, im)):
+            # the list-based path of compressai
+            s_list, te_list, me_list = measure(GaussianConditional.compress, dg, inputs, indexes, means=means)
+            s_buf, te_buf, me_buf = measure(entropy_coding.compress_buffers, dg, inputs, indexes, means=means)
+            assert s_list == s_buf, 'The bit strings should be identical'
+            x_list, td_list, md_list = measure(GaussianConditional.decompress, dg, s_list, indexes, means=means)
+            x_buf, td_buf, md_buf = measure(entropy_coding.decompress_buffers, dg, s_buf, indexes, means=means)
+            assert torch.equal(x_list, x_buf), 'The decoded values should be identical'
+            print(f'{i:>5d} {inputs.numel():>9d} | {te_list*1000:>11.1f} {te_buf*1000:>11.1f}  | '
+                  f'{me_list/2**20:>7.2f} {me_buf/2**20:>7.2f} | {td_list*1000:>11.1f} {td_buf*1000:>11.1f}  | '
+                  f'{md_list/2**20:>7.2f} {md_buf/2**20:>7.2f}')
+            totals = [a + b for a, b in zip(totals, [te_list, te_buf, td_list, td_buf])]
+        print(f'total: encoding {totals[0]*1000:.1f} ms -> {totals[1]*1000:.1f} ms, '
+              f'decoding {totals[2]*1000:.1f} ms -> {totals[3]*1000:.1f} ms')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import argparse
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def encode(model, im, lmb):
+    """ Returns the bit string of a real encoding """
+    if hasattr(model, 'pack'): # qresvae models
+        return model.pack(model.compress(im), img_hw=im.shape[2:4])
+    return model.compress(im, lmb=lmb)
+
+
+def estimate(model, im, lmb, breakdown=False):
+    if hasattr(model, 'pack'): # qresvae models
+        return model.estimate_bits(im, breakdown=breakdown)
+    return model.estimate_bits(im, lmbs=lmb, breakdown=breakdown)
+
+
+def timeit(func, repeat):
+    t_start = time()
+    for _ in range(repeat):
+        func()
+    return (time() - t_start) / repeat
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-n', '--num',     type=int, default=4)
+    parser.add_argument('-s', '--size',    type=int, default=512)
+    parser.add_argument('-r', '--repeat',  type=int, default=2)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    ims = torch.cat(load_images(known_datasets['kodak'], args.num, args.size, device=device), dim=0)
+    print(f'{args.num} images of size {args.size}x{args.size}. Error: (estimated - real) / real file size')
+    print(f'{"model":<18s} | {"mean |error|":>12s} | {"max |error|":>11s} | {"estimate_bits":>13s} | '
+          f'{"forward":>8s} | {"compress":>8s} | {"speedup vs forward / compress":>29s}')
+    for name in args.models:
+        model = get_model(name, **eval(f'dict({args.kwargs})'))
+        model = model.to(device=device)
+        model.eval()
+        if hasattr(model, 'compress_mode'):
+            model.compress_mode()
+        else:
+            model.prepare_compression()
+        lmb = getattr(model, 'default_lmb', None)
+
+        errors, t_est, t_fwd, t_enc = [], 0.0, 0.0, 0.0
+        for i in range(args.num):
+            im = ims[i:i+1]
+            est_bytes = estimate(model, im, lmb).item() / 8
+            real_bytes = len(encode(model, im, lmb))
+            errors.append((est_bytes - real_bytes) / real_bytes)
+            t_est += timeit(lambda: estimate(model, im, lmb), args.repeat)
+            t_fwd += timeit(lambda: model.forward(im), args.repeat)
+            t_enc += timeit(lambda: encode(model, im, lmb), args.repeat)
+        abs_errors = [abs(e) for e in errors]
+        t_est, t_fwd, t_enc = t_est / args.num, t_fwd / args.num, t_enc / args.num
+        print(f'{name:<18s} | {sum(abs_errors)/len(errors)*100:>11.2f}% | {max(abs_errors)*100:>10.2f}% | '
+              f'{t_est:>12.3f}s | {t_fwd:>7.3f}s | {t_enc:>7.3f}s | '
+              f'{t_fwd/t_est:>14.2f}x / {t_enc/t_est:>5.2f}x')
+
+        breakdown = estimate(model, ims[:1], lmb, breakdown=True)
+        block_kb = [f'{b/8/1024:.2f}' for b in breakdown['block_bits'][0].tolist()]
+        print(f'{"":<18s}   KB per block of image 0: {", ".join(block_kb)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import math
+from time import time
+import torch
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.utils.coding import load_images
+
+
+def psnr(a, b):
+    mse = torch.mean((a - b) ** 2).item()
+    return -10 * math.log10(mse) if (mse > 0) else float('inf')
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',  type=str, default=['qarv_base'], nargs='+')
+    parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
+    parser.add_argument('-k', '--rungs',   type=int, default=8)
+    parser.add_argument('-n', '--num',     type=int, default=4)
+    parser.add_argument('-s', '--size',    type=int, default=512)
+    parser.add_argument('-d', '--device',  type=str, default='cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    ims = torch.cat(load_images(known_datasets['kodak'], args.num, args.size, device=device), dim=0)
+    for name in args.models:
+        model = get_model(name, **eval(f'dict({args.kwargs})'))
+        model = model.to(device=device)
+        model.eval()
+        if hasattr(model, 'compress_mode'):
+            model.compress_mode()
+        else:
+            model.prepare_compression()
+        low, high = model.lmb_range
+        lmbs = torch.linspace(math.log(low), math.log(high), steps=args.rungs).exp().tolist()
+        model.encode_ladder(ims[:1], lmbs[:2]) # warm up
+
+        t_seq, t_ladder, max_byte_diff, min_psnr = 0.0, 0.0, 0.0, float('inf')
+        for i in range(args.num):
+            im = ims[i:i+1]
+            t_start = time()
+            seq_strings = [model.compress(im, lmb=lmb) for lmb in lmbs]
+            t_seq += time() - t_start
+            t_start = time()
+            ladder_strings = model.encode_ladder(im, lmbs)
+            t_ladder += time() - t_start
+            # batched and single-image forward passes may differ in floating point, so the bit
+            # strings are not necessarily identical. check that they decode to the same images.
+            for s_seq, s_lad in zip(seq_strings, ladder_strings):
+                max_byte_diff = max(max_byte_diff, abs(len(s_lad) - len(s_seq)) / len(s_seq))
+                min_psnr = min(min_psnr, psnr(model.decompress(s_lad), model.decompress(s_seq)))
+        print(f'{name}: {args.rungs} rungs, image size {args.size}x{args.size}. Time per ladder: '
+              f'sequential compress() {t_seq/args.num:.3f}s, encode_ladder() {t_ladder/args.num:.3f}s '
+              f'({t_seq/t_ladder:.2f}x). Max relative size difference {max_byte_diff*100:.3f}%, '
+              f'min PSNR between the two decodings {min_psnr:.1f} dB')
+
+
+if __name__ == '__main__':
+    main()
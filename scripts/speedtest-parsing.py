@@ -0,0 +1,84 @@
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import time
+
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+
+
+def copying_parse(bits_path):
+    """ The parsing path before zero-copy parsing: read the whole file, and slice off \
+        each header field with `string = string[_len:]`, which copies the remaining buffer.
+    """
+    with open(bits_path, 'rb') as f:
+        string = f.read()
+    img_hw, string = struct.unpack('2H', string[:4]), string[4:]
+    lmb, string = struct.unpack('f', string[:4])[0], string[4:]
+    (nB, nH, nW), string = struct.unpack('3H', string[:6]), string[6:]
+    num, string = struct.unpack('B', string[:1])[0], string[1:]
+    lengths, string = struct.unpack(f'{num}I', string[:num*4]), string[num*4:]
+    strings, pos = [], 0
+    for _len in lengths:
+        strings.append(string[pos:pos+_len])
+        pos += _len
+    return sum([len(s) for s in strings])
+
+
+def zero_copy_parse(bits_path):
+    """ Memory-map the file and parse the container into memoryview slices """
+    with open(bits_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        info = container.unpack(buffer, verify=False)
+        num_bytes = sum([len(s) for s in info['strings']])
+        del info # release the views before closing the file
+    return num_bytes
+
+
+def benchmark(func, paths, repeat):
+    tracemalloc.start()
+    t_start = time()
+    for _ in range(repeat):
+        for p in paths:
+            func(p)
+    elapsed = (time() - t_start) / (repeat * len(paths))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sizes',   type=float, default=[1, 4, 16, 64], nargs='+', help='MB')
+    parser.add_argument('-l', '--latents', type=int,   default=12)
+    parser.add_argument('-n', '--num',     type=int,   default=8, help='files per size')
+    parser.add_argument('-r', '--repeat',  type=int,   default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in args.sizes:
+            # synthetic bit strings, most bytes in the last (finest) latent strings
+            weights = [2 ** i for i in range(args.latents)]
+            lengths = [int(size_mb * 2**20 * w / sum(weights)) for w in weights]
+            strings = [os.urandom(l) for l in lengths]
+            legacy_paths, new_paths = [], []
+            for i in range(args.num):
+                legacy = struct.pack('2H', 2048, 2048) + struct.pack('f', 64.0) \
+                       + struct.pack('3H', 1, 32, 32) + coding.pack_byte_strings(strings)
+                new = container.pack(strings, img_hw=(2048, 2048), grid_hw=(32, 32), lmb=64.0)
+                legacy_paths.append(Path(tmp_dir) / f'legacy-{size_mb}-{i}.bits')
+                new_paths.append(Path(tmp_dir) / f'new-{size_mb}-{i}.bits')
+                legacy_paths[-1].write_bytes(legacy)
+                new_paths[-1].write_bytes(new)
+
+            t_copy, mem_copy = benchmark(copying_parse, legacy_paths, args.repeat)
+            t_zero, mem_zero = benchmark(zero_copy_parse, new_paths, args.repeat)
+            print(f'{size_mb:>5.1f} MB: read + slicing {t_copy*1000:.3f} ms, peak {mem_copy/2**20:.1f} MB | '
+                  f'mmap + memoryview {t_zero*1000:.3f} ms, peak {mem_zero/2**20:.3f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import argparse
+import struct
+import torch
+
+from lvae.models.registry import get_model
+import lvae.utils.coding as coding
+import lvae.utils.container as container
+
+
+def legacy_qarv_string(lmb, grid_hw, strings):
+    """ A qarv bit string in the legacy format: lambda, (1, nH, nW), and pack_byte_strings() """
+    return struct.pack('f', lmb) + struct.pack('3H', 1, *grid_hw) + coding.pack_byte_strings(strings)
+
+
+@torch.no_grad()
+def main():
+    """ Legacy bit strings that start with the magic bytes should not be taken as containers
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',  type=str, default='qarv_base')
+    parser.add_argument('-a', '--kwargs', type=str, default='pretrained=False')
+    args = parser.parse_args()
+
+    strings = [b'abc', b'', b'defg']
+    packed = container.pack(strings, img_hw=(64, 96), grid_hw=(1, 2), lmb=64.0, checksum=True)
+    assert container.is_container(packed)
+    assert [bytes(s) for s in container.unpack(packed)['strings']] == strings
+
+    # a legacy qarv bit string whose lambda (a float32) starts with the magic bytes
+    lmb = struct.unpack('f', container.MAGIC + b'\x80\x42')[0]
+    legacy = legacy_qarv_string(lmb, (1, 2), strings)
+    print(f'legacy qarv bit string with lambda={lmb:.4f}: {legacy[:8]}...')
+    assert legacy[:2] == container.MAGIC
+    assert not container.is_container(legacy), 'A legacy bit string is taken as a container'
+
+    model = get_model(args.model, **eval(f'dict({args.kwargs})'))
+    info = model._parse_string(legacy)
+    assert info['lmb'] == lmb and info['grid_hw'] == (1, 2), f'{info["lmb"]=}, {info["grid_hw"]=}'
+    assert [bytes(s) for s in info['strings']] == strings
+    print(f'{args.model} decodes it as a legacy bit string.')
+
+    # other versions are not containers of this version
+    for version in [0, container.VERSION + 1]:
+        other = container.MAGIC + bytes([version]) + packed[3:]
+        assert not container.is_container(other), f'{version=} is taken as a container'
+    print('Passed.')
+
+
+if __name__ == '__main__':
+    main()